@@ -0,0 +1,308 @@
+import argparse
+import collections
+import logging
+import re
+import sys
+
+import benchmark
+import db
+import local_backend
+import rollups
+from sql_queries import analytic_queries, create_table_queries
+
+# Recommend SORTKEY, DISTKEY/DISTSTYLE and ENCODE choices for the tables in
+# create_table_queries from the workload that actually runs against them: the analytic
+# queries (and their rollup rewrites) plus, on Redshift, recent SELECTs in stl_query.
+# Column encodings come from ANALYZE COMPRESSION on Redshift and from type and
+# cardinality heuristics on the local stand-in. The result is written out as DDL that
+# benchmark.py can build the warehouse with.
+
+_CREATE = re.compile(r'^\s*CREATE TABLE (?P<exists>IF NOT EXISTS )?(?P<table>\w+)\s*\((?P<body>.*)\)(?P<attributes>[^)]*)$',
+                     re.I | re.S)
+_LAYOUT = re.compile(r'\s+(?:SORTKEY|DISTKEY|ENCODE\s+\w+)\b', re.I)
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.I)
+_JOIN = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+_FILTER = re.compile(r"(?:\b(\w+)\.)?\b(\w+)\s*(?:<=|>=|<>|=|<|>|\bBETWEEN\b|\bIN\b)\s*(?:'|\d|\(|%s|DATE\b|TIMESTAMP\b)",
+                     re.I)
+_NOT_ALIASES = {'on', 'where', 'join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'group',
+                'order', 'limit', 'using', 'union', 'having'}
+
+# Type families for the local encoding heuristics
+_AZ64_TYPES = ('smallint', 'integer', 'bigint', 'numeric', 'date', 'timestamp')
+_DICT_MAX_DISTINCT = 256
+
+
+def parse_create(ddl: str):
+    """Split a CREATE TABLE statement into its parts, dropping comments
+
+    Returns:
+        (table name, list of (column name, column definition), table attributes, IF NOT EXISTS)
+
+    """
+    match = _CREATE.match(ddl)
+    columns = []
+    depth, current = 0, ''
+    for char in re.sub(r'--[^\n]*', '', match.group('body')) + ',':
+        if char == ',' and depth == 0:
+            line = ' '.join(current.split())
+            if line:
+                columns.append((line.split()[0].lower(), line))
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    attributes = [' '.join(line.split()) for line in match.group('attributes').splitlines() if line.strip()]
+    return match.group('table'), columns, attributes, bool(match.group('exists'))
+
+
+def workload(conn, redshift: bool, days: int = 7, limit: int = 1000):
+    """Queries to tune for: the analytic queries, their rollup rewrites and recent SELECTs"""
+    queries = list(analytic_queries.values())
+    queries += [rollups.rewrite(q) for q in analytic_queries.values() if rollups.rewrite(q) != q]
+    if redshift:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT TRIM(querytxt)
+            FROM stl_query
+            WHERE userid > 1
+              AND starttime > DATEADD(day, -%s, GETDATE())
+              AND querytxt ILIKE 'select%%'
+            ORDER BY starttime DESC
+            LIMIT %s
+        """, (days, limit))
+        queries += [row[0] for row in cur.fetchall()]
+        conn.commit()
+    return queries
+
+
+def usage(queries: list, schemas: dict):
+    """Count how often each table is read and each column is joined or filtered on
+
+    Args:
+        queries (list): SQL text
+        schemas (dict): table -> list of column names
+
+    Returns:
+        (Counter of tables, Counter of (table, column) joins,
+         Counter of (table, column, other table) join edges, Counter of (table, column) filters)
+
+    """
+    reads, joins, edges, filters = (collections.Counter() for _ in range(4))
+    for query in queries:
+        aliases = {}
+        for table, alias in _TABLE_REF.findall(query):
+            table = table.lower()
+            if table not in schemas:
+                continue
+            reads[table] += 1
+            aliases[table] = table
+            if alias and alias.lower() not in _NOT_ALIASES:
+                aliases[alias.lower()] = table
+
+        for left_alias, left, right_alias, right in _JOIN.findall(query):
+            left_table, right_table = aliases.get(left_alias.lower()), aliases.get(right_alias.lower())
+            if left_table and right_table:
+                joins[(left_table, left.lower())] += 1
+                joins[(right_table, right.lower())] += 1
+                edges[(left_table, left.lower(), right_table)] += 1
+                edges[(right_table, right.lower(), left_table)] += 1
+
+        where = re.split(r'\bWHERE\b', query, maxsplit=1, flags=re.I)
+        for alias, column in _FILTER.findall(where[1] if len(where) > 1 else ''):
+            column = column.lower()
+            tables = [aliases[alias.lower()]] if alias and alias.lower() in aliases else \
+                     [t for t in set(aliases.values()) if column in schemas[t]]
+            for table in tables:
+                filters[(table, column)] += 1
+    return reads, joins, edges, filters
+
+
+def table_rows(conn, tables: list, redshift: bool):
+    cur = conn.cursor()
+    rows = {}
+    if redshift:
+        cur.execute('SELECT "table", tbl_rows FROM svv_table_info')
+        rows = {table: int(count) for table, count in cur.fetchall()}
+    else:
+        for table in tables:
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            rows[table] = cur.fetchone()[0]
+    conn.commit()
+    return {table: rows.get(table, 0) for table in tables}
+
+
+def column_encodings(conn, table: str, redshift: bool):
+    """Return column -> encoding, from ANALYZE COMPRESSION or the local heuristics"""
+    cur = conn.cursor()
+    if redshift:
+        # ANALYZE COMPRESSION can't run inside a transaction block
+        conn.autocommit = True
+        try:
+            cur.execute(f"ANALYZE COMPRESSION {table}")
+            return {column: encoding.upper() for _, column, encoding, _ in cur.fetchall()}
+        finally:
+            conn.autocommit = False
+
+    cur.execute("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_name = %s
+          AND table_schema = ANY(current_schemas(false))
+    """, (table,))
+    encodings = {}
+    for column, data_type in cur.fetchall():
+        if data_type.startswith(_AZ64_TYPES):
+            encodings[column] = 'AZ64'
+        elif data_type in ('real', 'double precision', 'boolean'):
+            encodings[column] = 'ZSTD' if data_type != 'boolean' else 'RAW'
+        else:
+            cur.execute(f"SELECT COUNT(DISTINCT {column}) FROM {table}")
+            encodings[column] = 'BYTEDICT' if cur.fetchone()[0] <= _DICT_MAX_DISTINCT else 'ZSTD'
+    conn.commit()
+    return encodings
+
+
+def recommend(tables: dict, rows: dict, reads, joins, edges, filters, all_max_rows: int):
+    """Pick a distribution style and sort key for every table the workload reads
+
+    - Tables of at most all_max_rows rows are copied to every node (DISTSTYLE ALL).
+    - A larger table is distributed on the column it is most often joined on to another
+      large table, so the join is collocated, and falls back to DISTSTYLE EVEN.
+    - The sort key is the most filtered column, otherwise the most joined one, so zone
+      maps can skip blocks and joins can merge.
+
+    Args:
+        tables (dict): table -> list of column names, the tables to consider
+        rows (dict):   table -> row count
+
+    Returns:
+        dict of table -> {'diststyle': 'ALL'|'KEY'|'EVEN', 'distkey': column, 'sortkey': column, 'reason': str}
+
+    """
+    recommendations = {}
+    for table, columns in tables.items():
+        if not reads[table]:
+            continue
+        small = rows[table] <= all_max_rows
+        recommendation = {'diststyle': 'ALL' if small else 'EVEN', 'distkey': None, 'sortkey': None}
+        reasons = [f"{rows[table]} rows"]
+
+        if not small:
+            candidates = collections.Counter()
+            for (left, column, right), count in edges.items():
+                if left == table and rows.get(right, 0) > all_max_rows:
+                    candidates[column] += count
+            if candidates:
+                column, count = candidates.most_common(1)[0]
+                recommendation.update(diststyle='KEY', distkey=column)
+                reasons.append(f"joined on {column} to large tables {count}x")
+
+        filtered = collections.Counter({c: n for (t, c), n in filters.items() if t == table and c in columns})
+        joined = collections.Counter({c: n for (t, c), n in joins.items() if t == table and c in columns})
+        if filtered:
+            column, count = filtered.most_common(1)[0]
+            reasons.append(f"filtered on {column} {count}x")
+        elif joined:
+            column, count = joined.most_common(1)[0]
+            reasons.append(f"joined on {column} {count}x")
+        else:
+            column = None
+        recommendation['sortkey'] = column
+        recommendation['reason'] = ', '.join(reasons)
+        recommendations[table] = recommendation
+    return recommendations
+
+
+def render(ddl: str, recommendation: dict, encodings: dict):
+    """Rewrite a CREATE TABLE statement with the recommended layout and encodings
+
+    Without a recommendation the table keeps its layout and columns that have no
+    encoding get one.
+    """
+    table, columns, attributes, exists = parse_create(ddl)
+    lines = []
+    for name, definition in columns:
+        if recommendation:
+            definition = _LAYOUT.sub('', ' ' + definition).strip()
+            # Zone maps on the leading sort key column work best uncompressed
+            encoding = 'RAW' if name == recommendation['sortkey'] else encodings.get(name)
+        else:
+            encoding = None if re.search(r'\bENCODE\b', definition, re.I) else \
+                       'RAW' if re.search(r'\bSORTKEY\b', definition, re.I) else encodings.get(name)
+        lines.append(f"    {definition}" + (f" ENCODE {encoding}" if encoding else ''))
+    if recommendation:
+        attributes = [f"DISTSTYLE {recommendation['diststyle']}"]
+        if recommendation['distkey']:
+            attributes.append(f"DISTKEY ({recommendation['distkey']})")
+        if recommendation['sortkey']:
+            attributes.append(f"SORTKEY ({recommendation['sortkey']})")
+    return "\nCREATE TABLE {}{} (\n{}\n)\n{}\n".format('IF NOT EXISTS ' if exists else '', table,
+                                                     ',\n'.join(lines), '\n'.join(attributes))
+
+
+def advise(conn, redshift: bool, all_max_rows: int = 1000000, days: int = 7):
+    """Build recommended DDL for every table in create_table_queries
+
+    Tables the workload doesn't read keep their layout and only get encodings.
+
+    Returns:
+        (recommended create_table_queries in the same order, recommendations by table)
+
+    """
+    parsed = [parse_create(ddl) for ddl in create_table_queries]
+    schemas = {table: [name for name, _ in columns] for table, columns, _, _ in parsed}
+    reads, joins, edges, filters = usage(workload(conn, redshift, days), schemas)
+    rows = table_rows(conn, list(schemas), redshift)
+    recommendations = recommend(schemas, rows, reads, joins, edges, filters, all_max_rows)
+    queries = [render(ddl, recommendations.get(table), column_encodings(conn, table, redshift))
+               for ddl, (table, _, _, _) in zip(create_table_queries, parsed)]
+    return queries, recommendations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommend sort keys, distribution and encodings from the workload')
+    parser.add_argument('--out', default='recommended_ddl.sql', help='File the recommended DDL is written to')
+    parser.add_argument('--all-max-rows', type=int, default=1000000,
+                        help='Tables up to this many rows are recommended DISTSTYLE ALL')
+    parser.add_argument('--days', type=int, default=7, help='Days of stl_query history to read on Redshift')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Rebuild and time the warehouse with the current and the recommended DDL')
+    benchmark.add_target_args(parser)
+    args = parser.parse_args(argv)
+
+    config = db.get_config()
+    # Fail before the analysis rather than after it when the benchmark has nowhere safe to run
+    target = benchmark.target_config(config, args.schema, args.allow_live) if args.benchmark else None
+    redshift = not local_backend.enabled(config)
+    conn = db.connect(config)
+    try:
+        queries, recommendations = advise(conn, redshift, args.all_max_rows, args.days)
+    finally:
+        conn.close()
+
+    for table, recommendation in recommendations.items():
+        logging.info(f"{table}: DISTSTYLE {recommendation['diststyle']}"
+                     f"{' DISTKEY ' + recommendation['distkey'] if recommendation['distkey'] else ''}"
+                     f"{' SORTKEY ' + recommendation['sortkey'] if recommendation['sortkey'] else ''}"
+                     f" ({recommendation['reason']})")
+    with open(args.out, 'w') as f:
+        f.write(';\n'.join(q.strip() for q in queries) + ';\n')
+    logging.info(f"Wrote recommended DDL to {args.out}")
+
+    if args.benchmark:
+        if not redshift:
+            logging.warning('The local backend ignores sort keys, distribution and encodings, '
+                            'so both runs should time the same')
+        before = benchmark.run_benchmark(target, 'current')
+        after = benchmark.run_benchmark(target, 'recommended', create_queries=queries)
+        if args.schema:
+            benchmark.drop_scratch(target)
+        for step, timing in before['timings'].items():
+            old, new = timing['seconds'], after['timings'][step]['seconds']
+            speedup = f" ({old / new:.2f}x)" if new else ''
+            logging.info(f"{step}: {old}s -> {new}s{speedup}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
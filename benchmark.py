@@ -0,0 +1,231 @@
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+import create_tables
+import db
+import generate_data
+import local_backend
+import rollups
+from metrics import query_stats, rows_affected
+from dag import topological_order
+from sql_queries import analytic_queries, create_table_queries, drop_table_queries, etl_steps
+
+
+def time_statements(conn, queries: list, redshift: bool):
+    """Run queries in one transaction, returning wall time, rows and per-statement stats
+
+    A step that runs a COPY reports the rows it loaded, any other step the total rows
+    its statements wrote.
+    """
+    cur = conn.cursor()
+    rows = 0
+    copied = None
+    stats = []
+    start = time.perf_counter()
+    for query in queries:
+        cur.execute(query)
+        affected = max(rows_affected(cur, query, redshift), 0)
+        if query.lstrip().upper().startswith('COPY'):
+            copied = (copied or 0) + affected
+        rows += affected
+        stats.append(query_stats(cur, redshift))
+    conn.commit()
+    seconds = time.perf_counter() - start
+    if copied is not None:
+        rows = copied
+    return {'seconds': round(seconds, 4),
+            'rows': rows,
+            'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+            'statements': [s for s in stats if s]}
+
+
+def time_query(conn, query: str, redshift: bool):
+    """Run an analytic query, fetching every row, and time it"""
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.execute(query)
+    rows = len(cur.fetchall())
+    seconds = time.perf_counter() - start
+    result = {'seconds': round(seconds, 4),
+              'rows': rows,
+              'rows_per_sec': round(rows / seconds, 1) if seconds else None}
+    result.update(query_stats(cur, redshift))
+    conn.commit()
+    return result
+
+
+def run_benchmark(config, scale, create_queries: list = None):
+    """Rebuild the warehouse and time every ETL step and analytic query one at a time
+
+    Steps are run sequentially in dependency order so their timings don't overlap.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        scale:                              Dataset scale, used as a label on Redshift
+        create_queries (list):              DDL to build with, create_table_queries by default
+
+    """
+    redshift = not local_backend.enabled(config)
+    conn = db.connect(config)
+    try:
+        cur = conn.cursor()
+        create_tables.create_schema(cur, conn, config)
+        for query in drop_table_queries + (create_queries or create_table_queries):
+            cur.execute(query)
+        conn.commit()
+
+        timings = {}
+        for name in topological_order(etl_steps):
+            query, _ = etl_steps[name]
+            timings[name] = time_statements(conn, [query] if isinstance(query, str) else query, redshift)
+            logging.info(f"scale {scale} {name}: {timings[name]['seconds']}s, {timings[name]['rows']} rows")
+        for name, query in analytic_queries.items():
+            timings[name] = time_query(conn, query, redshift)
+            logging.info(f"scale {scale} {name}: {timings[name]['seconds']}s")
+            # The same question answered from the rollup tables
+            if rollups.rewrite(query) != query:
+                timings[f"{name}_rollup"] = time_query(conn, rollups.rewrite(query), redshift)
+                logging.info(f"scale {scale} {name}_rollup: {timings[name + '_rollup']['seconds']}s")
+    finally:
+        conn.close()
+    return {'started_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'backend': 'redshift' if redshift else 'local',
+            'scale': scale,
+            'timings': timings}
+
+
+def target_config(config, schema: str = None, allow_live: bool = False):
+    """The config to benchmark with, since run_benchmark drops and recreates every table
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        schema (str):                       Scratch schema to build the tables in instead
+        allow_live (bool):                  Rebuild the tables [DB] SCHEMA points at on Redshift
+
+    Raises:
+        ValueError: Redshift without a scratch schema or allow_live, or a scratch schema that is the live one
+
+    """
+    if schema:
+        live = config.get('DB', 'SCHEMA', fallback='') or 'public'
+        if schema in (live, 'public'):
+            raise ValueError(f"The scratch schema must not be the live schema {live} or public")
+        scratch = copy.deepcopy(config)
+        if not scratch.has_section('DB'):
+            scratch.add_section('DB')
+        scratch['DB']['SCHEMA'] = schema
+        return scratch
+    if local_backend.enabled(config) or allow_live:
+        return config
+    raise ValueError('Benchmarking drops and recreates every table: pass --schema to build in a scratch schema, '
+                     'or --allow-live to rebuild the live warehouse')
+
+
+def drop_scratch(config):
+    """Drop the scratch schema a target_config() copy points at"""
+    conn = db.connect(config)
+    try:
+        conn.cursor().execute(f"DROP SCHEMA IF EXISTS {config['DB']['SCHEMA']} CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path: str, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def compare(runs: list, baseline: list, threshold: float, min_seconds: float = 0.05):
+    """Flag steps that got slower than the baseline run of the same backend and scale
+
+    Args:
+        runs (list):         Benchmark results to check
+        baseline (list):     Stored baseline results
+        threshold (float):   Allowed slowdown, 0.2 allows 20%
+        min_seconds (float): Steps faster than this in the baseline are too noisy to compare
+
+    Returns:
+        list of (backend, scale, step, baseline seconds, seconds) regressions
+
+    """
+    regressions = []
+    for run in runs:
+        base = next((b for b in baseline if b['backend'] == run['backend'] and b['scale'] == run['scale']), None)
+        if base is None:
+            logging.warning(f"No baseline for {run['backend']} scale {run['scale']}")
+            continue
+        for step, timing in run['timings'].items():
+            before = base['timings'].get(step)
+            if before and before['seconds'] >= min_seconds and timing['seconds'] > before['seconds'] * (1 + threshold):
+                regressions.append((run['backend'], run['scale'], step, before['seconds'], timing['seconds']))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Time every ETL step and analytic query across dataset scales')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1],
+                        help='Dataset scales to generate and load with the local backend')
+    parser.add_argument('--history', default='benchmark_history.json', help='JSON file every run is appended to')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='Fail if any step is slower than the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-seconds', type=float, default=0.05)
+    add_target_args(parser)
+    return parser.parse_args(argv)
+
+
+def add_target_args(parser):
+    """--schema and --allow-live, which pick the tables a benchmark may drop"""
+    parser.add_argument('--schema', help='Scratch schema to build and time the tables in, dropped afterwards')
+    parser.add_argument('--allow-live', action='store_true',
+                        help='On Redshift, drop and rebuild the live tables instead of using a scratch schema')
+
+
+def main(argv=None):
+    """Run the benchmark, append it to the history and compare it against the baseline"""
+    args = parse_args(argv)
+    config = target_config(db.get_config(), args.schema, args.allow_live)
+
+    runs = []
+    if local_backend.enabled(config):
+        for scale in args.scales:
+            scaled = copy.deepcopy(config)
+            data_dir = os.path.join(config.get('LOCAL', 'DATA_DIR', fallback='data'), f"scale-{scale:g}")
+            scaled['LOCAL']['DATA_DIR'] = data_dir
+            if not os.path.exists(data_dir):
+                generate_data.main(['--scale', str(scale), '--out', data_dir])
+            runs.append(run_benchmark(scaled, scale))
+    else:
+        runs.append(run_benchmark(config, 's3'))
+    if args.schema:
+        drop_scratch(config)
+
+    save_json(args.history, load_json(args.history, []) + runs)
+    if args.save_baseline:
+        save_json(args.baseline, runs)
+    if args.compare:
+        regressions = compare(runs, load_json(args.baseline, []), args.threshold, args.min_seconds)
+        for backend, scale, step, before, after in regressions:
+            logging.error(f"Regression: {backend} scale {scale} {step} {before}s -> {after}s")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
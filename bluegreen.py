@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import copy
+import logging
+import sys
+
+import create_tables
+import db
+import etl
+import metrics
+import quality
+import query_cache
+
+# Reload the warehouse without taking it away from readers. Sessions resolve table names
+# in [DB] SCHEMA (see db._setup_session), so the next generation is built and validated
+# in <schema>_next while queries keep reading <schema>. One transaction then renames
+# <schema> to <schema>_prev and <schema>_next to <schema>; queries already running finish
+# on the tables they started on. <schema>_prev is kept until the next reload, so
+# --rollback can swap it back.
+
+
+def schemas(config):
+    """Return the (live, shadow, previous) schema names for [DB] SCHEMA
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    live = config.get('DB', 'SCHEMA', fallback='')
+    if not live or live == 'public':
+        raise ValueError('Blue/green reloads need [DB] SCHEMA set to a schema other than public')
+    return live, f"{live}_next", f"{live}_prev"
+
+
+def schema_exists(cur, schema: str):
+    cur.execute("SELECT COUNT(*) FROM pg_namespace WHERE nspname = %s", (schema,))
+    return cur.fetchone()[0] > 0
+
+
+def table_exists(cur, schema: str, table: str):
+    cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = %s AND table_name = %s",
+                (schema, table))
+    return cur.fetchone()[0] > 0
+
+
+@contextlib.contextmanager
+def search_path(config, schema: str):
+    """Yield a copy of config whose connections resolve table names in another schema
+
+    create_tables.py and etl.py are handed the copy and build the other schema unmodified,
+    while config, and anyone else reading it, stays on the live schema. The pool is closed
+    on the way out so no connection keeps the other search_path.
+    """
+    other = copy.deepcopy(config)
+    other['DB']['SCHEMA'] = schema
+    try:
+        yield other
+    finally:
+        db.close_pool()
+
+
+def validate(config, live: str, shadow: str):
+    """Compare the shadow schema's size with the live one, and check it unless the load did
+
+    With [QUALITY] ENABLED etl.main() already ran every data-quality check on the shadow
+    schema as it loaded it, so they only run here when it didn't. config is the copy
+    search_path(config, shadow) yields.
+
+    Raises:
+        quality.DataQualityError: a check failed or songplay shrank below
+                                  [BLUEGREEN] MIN_ROW_FRACTION of the live row count
+
+    """
+    min_fraction = config.getfloat('BLUEGREEN', 'MIN_ROW_FRACTION', fallback=0.9)
+    with db.connection(config) as conn:
+        cur = conn.cursor()
+        # Unqualified names resolve in the shadow schema here, see search_path()
+        if not quality.enabled(config):
+            for table in quality.CHECKS:
+                quality.run_checks(cur, table, stage='bluegreen_validate')
+        cur.execute(f"SELECT COUNT(*) FROM {shadow}.songplay")
+        next_rows = cur.fetchone()[0]
+        live_rows = None
+        if table_exists(cur, live, 'songplay'):
+            cur.execute(f"SELECT COUNT(*) FROM {live}.songplay")
+            live_rows = cur.fetchone()[0]
+        conn.commit()
+    if live_rows and next_rows < live_rows * min_fraction:
+        raise quality.DataQualityError(f"{shadow}.songplay has {next_rows} rows, fewer than {min_fraction:.0%} "
+                                       f"of the {live_rows} in {live}.songplay")
+    logging.info(f"Validated {shadow}: {next_rows} songplay rows, {live_rows or 0} live")
+
+
+def swap(config, live: str, shadow: str, previous: str):
+    """Make the shadow schema live in one transaction, keeping the old one as previous"""
+    with db.connection(config) as conn:
+        cur = conn.cursor()
+        live_exists = schema_exists(cur, live)
+        metrics.execute(cur, f"DROP SCHEMA IF EXISTS {previous} CASCADE", 'bluegreen_swap', config=config)
+        if live_exists:
+            metrics.execute(cur, f"ALTER SCHEMA {live} RENAME TO {previous}", 'bluegreen_swap', config=config)
+        metrics.execute(cur, f"ALTER SCHEMA {shadow} RENAME TO {live}", 'bluegreen_swap', config=config)
+        conn.commit()
+    logging.info(f"Swapped {shadow} in as {live}" + (f", the old tables are in {previous}" if live_exists else ''))
+
+
+def reload(config=None):
+    """Build the star schema in the shadow schema, validate it and swap it in
+
+    A failed load or validation leaves the live schema untouched.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg, db.get_config() by default
+
+    """
+    config = config or db.get_config()
+    live, shadow, previous = schemas(config)
+    with db.connection(config) as conn:
+        cur = conn.cursor()
+        metrics.execute(cur, f"DROP SCHEMA IF EXISTS {shadow} CASCADE", 'bluegreen_prepare', config=config)
+        conn.commit()
+
+    with metrics.stage('bluegreen_load', schema=shadow), search_path(config, shadow) as shadow_config:
+        create_tables.main(shadow_config)
+        with db.connection(shadow_config) as conn:
+            cur = conn.cursor()
+            # Keep the history of rejected rows and quarantined files across generations
+            for table in ('load_rejects', 'load_quarantine'):
+                if table_exists(cur, live, table):
+                    metrics.execute(cur, f"INSERT INTO {table} SELECT * FROM {live}.{table}", 'bluegreen_prepare',
+                                    config=shadow_config)
+            conn.commit()
+        etl.main(config=shadow_config)
+        validate(shadow_config, live, shadow)
+
+    with metrics.stage('bluegreen_swap', schema=live):
+        swap(config, live, shadow, previous)
+    # Results cached while the shadow schema loaded still describe the old generation
+    if query_cache.enabled(config):
+        query_cache.bump_generation(config)
+
+
+def rollback(config=None):
+    """Swap the previous generation back in, keeping the current one as previous"""
+    config = config or db.get_config()
+    live, shadow, previous = schemas(config)
+    with db.connection(config) as conn:
+        cur = conn.cursor()
+        if not schema_exists(cur, previous):
+            raise ValueError(f"There is no previous generation in {previous} to roll back to")
+        metrics.execute(cur, f"DROP SCHEMA IF EXISTS {shadow} CASCADE", 'bluegreen_rollback', config=config)
+        metrics.execute(cur, f"ALTER SCHEMA {live} RENAME TO {shadow}", 'bluegreen_rollback', config=config)
+        metrics.execute(cur, f"ALTER SCHEMA {previous} RENAME TO {live}", 'bluegreen_rollback', config=config)
+        metrics.execute(cur, f"ALTER SCHEMA {shadow} RENAME TO {previous}", 'bluegreen_rollback', config=config)
+        conn.commit()
+    if query_cache.enabled(config):
+        query_cache.bump_generation(config)
+    logging.info(f"Rolled {live} back to the previous generation")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reload the star schema into a shadow schema and swap it in')
+    parser.add_argument('--rollback', action='store_true', help='Swap the previous generation back in')
+    args = parser.parse_args(argv)
+    if args.rollback:
+        rollback()
+    else:
+        reload()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
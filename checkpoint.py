@@ -0,0 +1,284 @@
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import math
+
+import psycopg2
+
+import compaction
+import db
+import local_backend
+import metrics
+import storage
+from sql_queries import (etl_steps, songplay_table_insert, staging_events_manifest_copy, staging_songs_manifest_copy,
+                         staging_events_compacted_copy, staging_songs_compacted_copy,
+                         staging_events_rejects_insert, staging_songs_rejects_insert,
+                         load_checkpoint_table_create, load_quarantine_table_create)
+
+# Restartable full loads. Each COPY runs in chunks of [CHECKPOINT] COPY_CHUNK_FILES files
+# through a manifest, and the songplay insert in [CHECKPOINT] INSERT_CHUNK_DAYS ranges of
+# ts. A chunk commits in the same transaction as its row in load_checkpoint, so when a
+# load dies, rerunning etl.py skips every chunk already committed. The listing a load
+# started with is kept under MY_BUCKET/checkpoints/ and a rerun resumes over that same
+# listing, so objects that landed since are left to the next --incremental run.
+# A chunk whose COPY fails past MAXERROR is rolled back, the files with the most rejects
+# (stl_load_errors) are moved to load_quarantine and the chunk is retried without them.
+
+
+def enabled(config):
+    """Return whether full loads are chunked and checkpointed, [CHECKPOINT] ENABLED"""
+    return config.getboolean('CHECKPOINT', 'ENABLED', fallback=False)
+
+
+def run_key(objects: list):
+    """Identify a load by the objects it copies, so only a rerun of the same load resumes"""
+    listing = sorted((o['url'], o.get('etag')) for o in objects)
+    return hashlib.md5(json.dumps(listing).encode()).hexdigest()
+
+
+def completed(cur, run_id: str, step: str):
+    """Return chunk number -> detail of the chunks of a step already committed"""
+    cur.execute("SELECT chunk, detail FROM load_checkpoint WHERE run_id = %s AND step = %s", (run_id, step))
+    return dict(cur.fetchall())
+
+
+def mark(cur, run_id: str, step: str, chunk: int, row_count: int = None, detail: str = None):
+    """Record a chunk as done, in the transaction that loaded it"""
+    cur.execute("""
+        INSERT INTO load_checkpoint (run_id, step, chunk, row_count, detail, finished_at)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (run_id, step, chunk, row_count, detail, datetime.datetime.utcnow()))
+
+
+def quarantined(cur, run_id: str):
+    cur.execute("SELECT s3_key FROM load_quarantine WHERE run_id = %s", (run_id,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def prepare(conn, config, events: list, songs: list):
+    """Create the checkpoint tables if needed and pick the load to run
+
+    An unfinished load is resumed over the objects it started with, whatever was listed
+    since. Otherwise a new load of events and songs starts, its listing saved first.
+
+    Returns:
+        (run_id, events, songs) of the load to run
+
+    """
+    cur = conn.cursor()
+    cur.execute(load_checkpoint_table_create)
+    cur.execute(load_quarantine_table_create)
+    cur.execute("SELECT run_id, COUNT(*) FROM load_checkpoint GROUP BY run_id")
+    runs = dict(cur.fetchall())
+    cur.execute("SELECT run_id, detail FROM load_checkpoint WHERE step = 'listing'")
+    listings = dict(cur.fetchall())
+    conn.commit()
+    if len(runs) > 1 or set(runs) - set(listings):
+        # Only written by an older etl.py, which kept no listing to resume over
+        raise RuntimeError("load_checkpoint holds chunks of a load without its listing. "
+                           "Run create_tables.py to drop the tables and start the load over")
+    if runs:
+        run_id, listing = next(iter(listings.items()))
+        started = json.loads(storage.get_object(config, listing))
+        logging.info(f"Resuming load {run_id} over the {len(started['events']) + len(started['songs'])} objects it "
+                     f"started with ({len(events) + len(songs)} listed now): {runs[run_id] - 1} chunks already committed")
+        return run_id, started['events'], started['songs']
+
+    run_id = run_key(events + songs)
+    bucket = storage.my_bucket(config, '[CHECKPOINT] ENABLED')
+    listing = storage.put_object(config, f"s3://{bucket}/checkpoints/{run_id}/listing.json",
+                                 json.dumps({'events': events, 'songs': songs}).encode())
+    mark(cur, run_id, 'listing', 0, len(events) + len(songs), listing)
+    conn.commit()
+    return run_id, events, songs
+
+
+def finish(conn, run_id: str):
+    """Forget a load's checkpoints once it completed, so the next full load starts over"""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM load_checkpoint WHERE run_id = %s", (run_id,))
+    conn.commit()
+
+
+def failing_files(cur, config):
+    """Files of the COPY that just failed in this session, with their reject counts, worst first"""
+    if local_backend.enabled(config):
+        counts = collections.Counter(reject[1] for reject in cur.connection.last_copy_rejects)
+        cur.connection.last_copy_rejects = []
+        return counts.most_common()
+    cur.execute("""
+        SELECT TRIM(filename), COUNT(*)
+        FROM stl_load_errors
+        WHERE query = (SELECT MAX(query) FROM stl_load_errors WHERE session = pg_backend_pid())
+        GROUP BY 1
+        ORDER BY 2 DESC
+    """)
+    return cur.fetchall()
+
+
+def quarantine(cur, run_id: str, step: str, files: list, reason: str):
+    """Record files left out of a load, with the error that failed their chunk"""
+    for url, errors in files:
+        cur.execute("""
+            INSERT INTO load_quarantine (run_id, step, s3_key, errors, reason, quarantined_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (run_id, step, url, errors, reason[:1024], datetime.datetime.utcnow()))
+        logging.warning(f"{step}: quarantined {url} after {errors} rejected lines")
+
+
+def copy_chunks(cur, config, run_id: str, step: str, copy: str, rejects: str, files: list, chunk_files: int):
+    """COPY files into a staging table a chunk at a time, committing each with its checkpoint
+
+    Args:
+        cur (psycopg2.extensions.cursor):   Cursor of the DAG step
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        run_id (str):                       Key of the load, see run_key()
+        step (str):                         ETL step name
+        copy (str):                         Manifest COPY statement with a {manifest} placeholder
+        rejects (str):                      Statement saving the COPY's rejected lines in load_rejects
+        files (list):                       S3 URIs to copy, in a stable order
+        chunk_files (int):                  Files per COPY
+
+    """
+    conn = cur.connection
+    bucket = storage.my_bucket(config, '[CHECKPOINT] ENABLED')
+    done = completed(cur, run_id, step)
+    skipped = quarantined(cur, run_id)
+    conn.commit()
+    chunks = [files[i:i + chunk_files] for i in range(0, len(files), chunk_files)]
+    for number, chunk in enumerate(chunks):
+        if number in done:
+            continue
+        chunk = [url for url in chunk if url not in skipped]
+        while True:
+            if not chunk:
+                mark(cur, run_id, step, number, 0, 'every file quarantined')
+                conn.commit()
+                break
+            manifest = storage.put_object(config, f"s3://{bucket}/checkpoints/{run_id}/{step}-{number:05d}.manifest",
+                                          json.dumps({'entries': [{'url': url, 'mandatory': True}
+                                                                  for url in chunk]}).encode())
+            query = copy.format(manifest=manifest)
+            try:
+                loaded = metrics.execute(cur, query, step, config=config)
+                metrics.execute(cur, rejects, step, config=config)
+                mark(cur, run_id, step, number, loaded, manifest)
+                conn.commit()
+                break
+            except (psycopg2.DataError, psycopg2.InternalError) as e:
+                # More rejects than MAXERROR: leave out the worst files and try the rest again
+                conn.rollback()
+                failing = [(url, n) for url, n in failing_files(cur, config) if url in chunk]
+                if not failing:
+                    raise
+                worst = [(url, n) for url, n in failing if n == failing[0][1]]
+                quarantine(cur, run_id, step, worst, str(e).strip())
+                conn.commit()
+                chunk = [url for url in chunk if url not in dict(worst)]
+        logging.info(f"{step}: chunk {number + 1}/{len(chunks)} committed")
+
+
+def ts_ranges(cur, days: int):
+    """Split the NextSong events' ts into ranges of whole days"""
+    cur.execute("SELECT MIN(ts), MAX(ts) FROM staging_events WHERE page = 'NextSong'")
+    first, last = cur.fetchone()
+    if first is None:
+        return []
+    start = datetime.datetime.combine(first.date(), datetime.time())
+    width = datetime.timedelta(days=days)
+    return [(start + i * width, start + (i + 1) * width)
+            for i in range(math.floor((last - start) / width) + 1)]
+
+
+def insert_chunks(cur, run_id: str, step: str, days: int):
+    """Insert songplay a ts range at a time, committing each with its checkpoint"""
+    conn = cur.connection
+    done = completed(cur, run_id, step)
+    ranges = ts_ranges(cur, days)
+    conn.commit()
+    for number, (low, high) in enumerate(ranges):
+        if number in done:
+            continue
+        query = (songplay_table_insert +
+                 f"  AND e.ts >= '{low:%Y-%m-%d %H:%M:%S}' AND e.ts < '{high:%Y-%m-%d %H:%M:%S}'\n")
+        rows = metrics.execute(cur, query, step)
+        mark(cur, run_id, step, number, rows, f"{low:%Y-%m-%d} to {high:%Y-%m-%d}")
+        conn.commit()
+    logging.info(f"{step}: {len(ranges)} ts ranges committed")
+
+
+def run_once(cur, run_id: str, step: str, queries: list):
+    """Run a step's queries unless a previous attempt at this load committed them"""
+    if completed(cur, run_id, step):
+        logging.info(f"{step}: already committed, skipped")
+        return
+    rows = None
+    for query in queries:
+        if callable(query):
+            query(cur)
+        else:
+            rows = metrics.execute(cur, query, step)
+    mark(cur, run_id, step, 0, rows)
+
+
+def staged_files(config, cur, run_id: str, name: str, objects: list, slices: int):
+    """URIs a staging table is copied from: the objects, or their compacted chunks
+
+    The manifest compaction wrote is checkpointed too, so a resumed load reuses the chunks.
+    """
+    if not compaction.enabled(config):
+        return [o['url'] for o in objects]
+    step = f"compact_{name}"
+    manifest = completed(cur, run_id, step).get(0)
+    if manifest is None:
+        manifest = compaction.compact(config, name, objects, slices)
+        mark(cur, run_id, step, 0, len(objects), manifest)
+        cur.connection.commit()
+    if manifest is None:
+        return []
+    return [entry['url'] for entry in json.loads(storage.get_object(config, manifest))['entries']]
+
+
+def resumable_steps(config, events: list, songs: list):
+    """Build the full-load ETL steps, every one of them checkpointed
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        events (list):                      Log objects listed now
+        songs (list):                       Song objects listed now
+
+    Returns:
+        (steps, run_id, events, songs): pass run_id to finish() once the load and its checks
+        passed. events and songs are the objects the load copies, those of an unfinished
+        load when one is resumed, so only they are recorded in load_state.
+
+    """
+    chunk_files = config.getint('CHECKPOINT', 'COPY_CHUNK_FILES', fallback=64)
+    days = config.getint('CHECKPOINT', 'INSERT_CHUNK_DAYS', fallback=7)
+    compacted = compaction.enabled(config)
+    with db.connection(config) as conn:
+        run_id, events, songs = prepare(conn, config, events, songs)
+        slices = compaction.slice_count(conn, config) if compacted else 1
+        # Whole multiples of the slices, so every COPY still keeps each slice busy
+        chunk_files = math.ceil(chunk_files / slices) * slices
+        cur = conn.cursor()
+        files = {'staging_events_copy': staged_files(config, cur, run_id, 'log_data', events, slices),
+                 'staging_songs_copy': staged_files(config, cur, run_id, 'song_data', songs, slices)}
+
+    steps = {}
+    for step, (queries, deps) in etl_steps.items():
+        queries = [queries] if isinstance(queries, str) else queries
+        steps[step] = ([lambda cur, step=step, queries=queries: run_once(cur, run_id, step, queries)], deps)
+    for step, copy, rejects in [
+            ('staging_events_copy', staging_events_compacted_copy if compacted else staging_events_manifest_copy,
+             staging_events_rejects_insert),
+            ('staging_songs_copy', staging_songs_compacted_copy if compacted else staging_songs_manifest_copy,
+             staging_songs_rejects_insert)]:
+        steps[step] = ([lambda cur, step=step, copy=copy, rejects=rejects:
+                        copy_chunks(cur, config, run_id, step, copy, rejects, files[step], chunk_files)],
+                       steps[step][1])
+    steps['songplay_table_insert'] = ([lambda cur: insert_chunks(cur, run_id, 'songplay_table_insert', days)],
+                                      steps['songplay_table_insert'][1])
+    return steps, run_id, events, songs
@@ -0,0 +1,130 @@
+import datetime
+import gzip
+import heapq
+import json
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import local_backend
+import storage
+from sql_queries import (etl_steps, staging_events_compacted_copy, staging_songs_compacted_copy,
+                         staging_events_rejects_insert, staging_songs_rejects_insert)
+
+# COPY pays a fixed cost per S3 object and hands whole files to slices, so thousands of
+# tiny song files load slowly and unevenly. Before the COPY, the listed objects are
+# coalesced into gzipped chunks of about [COMPACTION] TARGET_MB, as many as a multiple of
+# the cluster's slice count and balanced by size, under MY_BUCKET/compacted/. The COPY
+# then reads them through a manifest. Works the same on the local S3 stand-in.
+
+
+def enabled(config):
+    """Return whether COPY loads from compacted chunks, [COMPACTION] ENABLED"""
+    return config.getboolean('COMPACTION', 'ENABLED', fallback=False)
+
+
+def slice_count(conn, config):
+    """Number of slices COPY spreads files over, [COMPACTION] SLICES or asked of the cluster
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        config (configparser.ConfigParser):    Parsed dwh.cfg
+
+    """
+    slices = config.getint('COMPACTION', 'SLICES', fallback=0)
+    if slices or local_backend.enabled(config):
+        return max(slices, 1)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM stv_slices")
+    slices = cur.fetchone()[0]
+    conn.commit()
+    return slices
+
+
+def plan_chunks(objects: list, slices: int, target_bytes: int):
+    """Assign objects to chunks of roughly equal size
+
+    The chunk count is the smallest multiple of slices that keeps chunks near
+    target_bytes, and objects are placed largest first into the smallest chunk.
+
+    Args:
+        objects (list):     Objects returned by storage.list_objects
+        slices (int):       Slices in the cluster
+        target_bytes (int): Preferred uncompressed chunk size
+
+    Returns:
+        list of chunks, each a list of objects in url order
+
+    """
+    if not objects:
+        return []
+    total = sum(o['size'] for o in objects)
+    count = max(1, math.ceil(total / target_bytes / slices)) * slices
+    count = min(count, len(objects))
+    heap = [(0, i) for i in range(count)]
+    chunks = [[] for _ in range(count)]
+    for obj in sorted(objects, key=lambda o: (-o['size'], o['url'])):
+        size, i = heapq.heappop(heap)
+        chunks[i].append(obj)
+        heapq.heappush(heap, (size + obj['size'], i))
+    return [sorted(chunk, key=lambda o: o['url']) for chunk in chunks]
+
+
+def _write_chunk(config, uri: str, objects: list):
+    """Concatenate the objects' JSON, one record set after another, into one gzipped object"""
+    parts = []
+    for obj in objects:
+        body = storage.get_object(config, obj['url'])
+        if obj['url'].endswith('.gz'):
+            body = gzip.decompress(body)
+        parts.append(body if body.endswith(b'\n') else body + b'\n')
+    body = b''.join(parts)
+    storage.put_object(config, uri, gzip.compress(body, compresslevel=6))
+    return {'url': uri, 'mandatory': True}
+
+
+def compact(config, name: str, objects: list, slices: int):
+    """Coalesce objects into gzipped chunks and write a COPY manifest listing them
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        name (str):                         Dataset name, e.g. 'log_data'
+        objects (list):                     Objects to load
+        slices (int):                       Slices in the cluster
+
+    Returns:
+        S3 URI of the manifest, or None when there is nothing to load
+
+    """
+    bucket = storage.my_bucket(config, '[COMPACTION] ENABLED')
+    target_bytes = int(config.getfloat('COMPACTION', 'TARGET_MB', fallback=64) * 2 ** 20)
+    chunks = plan_chunks(objects, slices, target_bytes)
+    if not chunks:
+        return None
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    prefix = f"s3://{bucket}/compacted/{name}/{stamp}"
+
+    workers = config.getint('COMPACTION', 'WORKERS', fallback=16)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(lambda i: _write_chunk(config, f"{prefix}/part-{i:05d}.json.gz", chunks[i]),
+                                    range(len(chunks))))
+    logging.info(f"Compacted {len(objects)} {name} objects ({sum(o['size'] for o in objects)} bytes) "
+                 f"into {len(entries)} chunks for {slices} slices")
+    return storage.put_object(config, f"{prefix}.manifest", json.dumps({'entries': entries}).encode())
+
+
+def copy_steps(events_manifest: str, songs_manifest: str):
+    """Build the full-load ETL steps, copying the compacted chunks in the manifests
+
+    Args:
+        events_manifest (str): S3 URI of the compacted log data manifest
+        songs_manifest (str):  S3 URI of the compacted song data manifest
+
+    """
+    steps = dict(etl_steps)
+    for step, manifest, copy, rejects in [
+            ('staging_events_copy', events_manifest, staging_events_compacted_copy, staging_events_rejects_insert),
+            ('staging_songs_copy', songs_manifest, staging_songs_compacted_copy, staging_songs_rejects_insert)]:
+        _, deps = steps[step]
+        steps[step] = ([copy.format(manifest=manifest), rejects] if manifest is not None else [], deps)
+    return steps
@@ -1,35 +1,42 @@
-import configparser
-from venv import create
-import psycopg2
+import db
+import metrics
 from sql_queries import create_table_queries, drop_table_queries
 
 
-def table_query(cur, conn, table_query_list : list):
-    """Run a list of SQL queries
+def table_query(cur, conn, table_query_list : list, stage: str = 'create_tables', config=None):
+    """Run a list of SQL queries, recording each one in the metrics
     
     Args:
         cur (psycopg2.extensions.cursor:     Postgres cursor
         conn (psycopg2.exensions.connectoin: Postgres connection
         table_query_list (list):             List of SQL queries
+        stage (str):                         Stage the statements are recorded under
+        config (configparser.ConfigParser):  Config the connection was opened with, dwh.cfg by default
         
     """
     for query in table_query_list:
-        cur.execute(query)
+        metrics.execute(cur, query, stage, config=config)
         conn.commit()
 
-def main():
-    """Connect to Redshift database, drop and create tables"""
+def create_schema(cur, conn, config=None):
+    """Create the [DB] SCHEMA the session's search_path points at, if one is set"""
+    schema = (config or db.get_config()).get('DB', 'SCHEMA', fallback='')
+    if schema:
+        table_query(cur, conn, [f"CREATE SCHEMA IF NOT EXISTS {schema}"], 'create_tables', config)
 
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+def main(config=None):
+    """Connect to Redshift database, drop and create tables
 
-    table_query(cur, conn, drop_table_queries)
-    table_query(cur, conn, create_table_queries)
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg, db.get_config() by default
 
-    conn.close()
+    """
+    with db.connection(config) as conn:
+        cur = conn.cursor()
+        create_schema(cur, conn, config)
+        table_query(cur, conn, drop_table_queries, 'drop_tables', config)
+        table_query(cur, conn, create_table_queries, 'create_tables', config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+
+def topological_order(steps: dict):
+    """Order ETL steps so every step comes after the steps it depends on
+
+    Args:
+        steps (dict): step name -> (query, [names of steps it depends on])
+
+    Raises:
+        ValueError: a step depends on an unknown step or the steps form a cycle
+
+    """
+    for name, (_, deps) in steps.items():
+        for dep in deps:
+            if dep not in steps:
+                raise ValueError(f"Step '{name}' depends on unknown step '{dep}'")
+
+    order = []
+    done = set()
+    remaining = dict(steps)
+    while remaining:
+        ready = [name for name, (_, deps) in remaining.items() if done.issuperset(deps)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between steps: {sorted(remaining)}")
+        for name in ready:
+            order.append(name)
+            done.add(name)
+            del remaining[name]
+    return order
+
+
+def run_step(pool, name: str, query):
+    """Run one ETL step on a connection borrowed from the pool
+
+    Args:
+        pool (psycopg2.pool.ThreadedConnectionPool): Connection pool
+        name (str):                                  Step name, used for logging
+        query (str or list):                         SQL query, or a list of queries run in one transaction.
+                                                     A callable in the list is called with the cursor instead.
+
+    """
+    queries = [query] if isinstance(query, str) else query
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        logging.info(f"Starting step {name}")
+        for q in queries:
+            if callable(q):
+                q(cur)
+            else:
+                metrics.execute(cur, q, name, config=getattr(pool, 'config', None))
+        conn.commit()
+        logging.info(f"Finished step {name}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def run_dag(steps: dict, pool, max_workers: int):
+    """Run ETL steps concurrently, starting each one as soon as its dependencies finish
+
+    A failed step stops any new steps from being started. Steps that are already
+    running are allowed to finish before the error is raised.
+
+    Args:
+        steps (dict):       step name -> (query, [names of steps it depends on])
+        pool:               Connection pool with at least max_workers connections
+        max_workers (int):  Maximum number of steps running at the same time
+
+    """
+    topological_order(steps)
+
+    done = set()
+    running = {}
+    pending = dict(steps)
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                ready = [name for name, (_, deps) in pending.items() if done.issuperset(deps)]
+                for name in ready:
+                    query, _ = pending.pop(name)
+                    running[executor.submit(run_step, pool, name, query)] = name
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    logging.error(f"Step {name} failed: {e}")
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
+    return done
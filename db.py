@@ -0,0 +1,193 @@
+import atexit
+import configparser
+import contextlib
+import logging
+import threading
+import time
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+import local_backend
+import metrics
+
+# One place to connect from: dwh.cfg is parsed once per path, every connection gets
+# TCP keepalives, retries transient connect failures and has its statement timeout and
+# query tag set, and the entry points share one pool instead of reconnecting per step.
+
+_configs = {}
+_pool = None
+_lock = threading.RLock()
+
+
+def get_config(path: str = 'dwh.cfg'):
+    """Parse dwh.cfg once and return the same ConfigParser on every call
+
+    Changes made to the returned config (boot.py sets the cluster endpoint) are seen by
+    every later caller in the process.
+
+    Args:
+        path (str): Path to dwh.cfg
+
+    """
+    with _lock:
+        if path not in _configs:
+            config = configparser.ConfigParser()
+            config.read(path)
+            _configs[path] = config
+        return _configs[path]
+
+
+def connect_kwargs(config):
+    """Keyword arguments for psycopg2.connect, for Redshift or the local backend
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    kwargs = dict(application_name=config.get('DB', 'QUERY_GROUP', fallback='sparkify_etl'),
+                  keepalives=1,
+                  keepalives_idle=config.getint('DB', 'KEEPALIVES_IDLE', fallback=60),
+                  keepalives_interval=10,
+                  keepalives_count=5)
+    if local_backend.enabled(config):
+        kwargs.update(local_backend.connect_args(config))
+    else:
+        kwargs.update(host=config['CLUSTER']['HOST'],
+                      dbname=config['CLUSTER']['DB_NAME'],
+                      user=config['CLUSTER']['DB_USER'],
+                      password=config['CLUSTER']['DB_PASSWORD'],
+                      port=config['CLUSTER']['DB_PORT'],
+                      connect_timeout=config.getint('DB', 'CONNECT_TIMEOUT', fallback=10))
+    return kwargs
+
+
+def _setup_session(conn, config):
+    """Set the schema, the statement timeout and, on Redshift, the query group queries are labelled with
+
+    With [DB] SCHEMA set, unqualified table names resolve in that schema only, which is
+    what lets bluegreen.py build a reload in another schema and swap it in by name.
+    """
+    cur = conn.cursor()
+    schema = config.get('DB', 'SCHEMA', fallback='')
+    if schema:
+        cur.execute(f"SET search_path TO {schema}")
+    timeout = config.getint('DB', 'STATEMENT_TIMEOUT', fallback=0)
+    if timeout:
+        cur.execute(f"SET statement_timeout TO {timeout}")
+    if not local_backend.enabled(config):
+        cur.execute("SET query_group TO %s", (config.get('DB', 'QUERY_GROUP', fallback='sparkify_etl'),))
+    conn.commit()
+
+
+def connect(config=None, retries: int = None):
+    """Open a connection, retrying transient failures with exponential backoff
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg, get_config() by default
+        retries (int):                      Retries after the first attempt, [DB] CONNECT_RETRIES by default
+
+    """
+    config = config or get_config()
+    if retries is None:
+        retries = config.getint('DB', 'CONNECT_RETRIES', fallback=3)
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            conn = psycopg2.connect(**connect_kwargs(config))
+            break
+        except psycopg2.OperationalError as e:
+            if attempt == retries:
+                metrics.emit({'stage': 'connect', 'seconds': round(time.perf_counter() - start, 4),
+                              'retries': attempt, 'status': 'error', 'error': str(e).strip()[:500]}, config)
+                raise
+            logging.warning(f"Connection attempt {attempt + 1} failed, retrying in {2 ** attempt}s: {e}")
+            time.sleep(2 ** attempt)
+    _setup_session(conn, config)
+    metrics.emit({'stage': 'connect', 'seconds': round(time.perf_counter() - start, 4),
+                  'retries': attempt, 'status': 'ok'}, config)
+    return conn
+
+
+class Pool(ThreadedConnectionPool):
+    """Thread-safe pool that opens connections lazily with connect() and keeps them open
+
+    psycopg2's pools close any connection returned beyond minconn, so minconn is raised
+    to maxconn once the pool exists and returned connections stay open for reuse.
+    Connections the server dropped while idle are replaced when borrowed.
+    """
+
+    def __init__(self, config, maxconn: int):
+        self.config = config
+        super().__init__(0, maxconn)
+        self.minconn = maxconn
+
+    def _connect(self, key=None):
+        conn = connect(self.config)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+    def getconn(self, key=None):
+        conn = super().getconn(key)
+        if conn.closed:
+            self.putconn(conn, close=True)
+            conn = super().getconn(key)
+        return conn
+
+
+def get_pool(config=None):
+    """Return the process-wide pool, sized by [ETL] MAX_CONNECTIONS
+
+    The pool connects with the config it was built from. Asking for it with another
+    config, as bluegreen.py does for the shadow schema, closes it and builds a new one.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg, get_config() by default
+
+    """
+    global _pool
+    config = config or get_config()
+    with _lock:
+        if _pool is not None and not _pool.closed and _pool.config is not config:
+            _pool.closeall()
+        if _pool is None or _pool.closed or _pool.config is not config:
+            _pool = Pool(config, config.getint('ETL', 'MAX_CONNECTIONS', fallback=4))
+        return _pool
+
+
+@atexit.register
+def close_pool():
+    """Close every pooled connection"""
+    global _pool
+    with _lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+
+@contextlib.contextmanager
+def connection(config=None):
+    """Borrow a connection from the pool, rolling back if the block raises
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg, get_config() by default
+
+    Example:
+        with db.connection() as conn:
+            conn.cursor().execute(query)
+            conn.commit()
+
+    """
+    pool = get_pool(config)
+    conn = pool.getconn()
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
@@ -1,63 +1,77 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import logging
+import sys
+import checkpoint
+import compaction
+import db
+import incremental
+import metrics
+import quality
+import query_cache
+import staging_schema
+from dag import run_dag
+from sql_queries import etl_steps
+
+
+def main(incremental_load=False, export_parquet=False, config=None):
+    """Load the staging tables and build the star schema, running independent steps in parallel
 
-
-def table_query(cur, conn, table_query_list : list):
-    """Run a list of SQL queries
-    
     Args:
-        cur (psycopg2.extensions.cursor:     Postgres cursor
-        conn (psycopg2.exensions.connectoin: Postgres connection
-        table_query_list (list):             List of SQL queries
-        
-    """
-    for query in table_query_list:
-        cur.execute(query)
-        conn.commit()
-
-def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    table_query(cur, conn, copy_table_queries)
-    table_query(cur, conn, insert_table_queries)
+        incremental_load (bool):            Only stage S3 objects missing from load_state and merge them
+                                            into the existing tables instead of copying the whole prefix
+        export_parquet (bool):              Also write the star schema to Parquet under [PARQUET] PATH
+        config (configparser.ConfigParser): Parsed dwh.cfg, db.get_config() by default
 
-    conn.close()
+    """
+    config = config or db.get_config()
+    max_connections = config.getint('ETL', 'MAX_CONNECTIONS', fallback=4)
+    pool = db.get_pool(config)
+
+    if incremental_load:
+        changed = incremental.run(config, pool, max_connections) > 0
+    else:
+        # Listed before the COPY so a later --incremental run only loads objects added since
+        events, songs = incremental.source_objects(config)
+        # Fail before a long COPY rather than after it, when a field went missing or changed type
+        staging_schema.check(config, {'staging_events': events, 'staging_songs': songs})
+        steps = etl_steps
+        run_id = None
+        if checkpoint.enabled(config):
+            # Every chunk commits with a checkpoint, so rerunning etl.py after a failure resumes
+            # A resumed load copies the objects it started with, newer ones wait for --incremental
+            steps, run_id, events, songs = checkpoint.resumable_steps(config, events, songs)
+        elif compaction.enabled(config):
+            # Coalesce the many small objects so COPY reads a few slice-aligned chunks
+            with db.connection(config) as conn:
+                slices = compaction.slice_count(conn, config)
+            steps = compaction.copy_steps(compaction.compact(config, 'log_data', events, slices),
+                                          compaction.compact(config, 'song_data', songs, slices))
+        if quality.enabled(config):
+            # A failed check rolls back the step it runs in and raises here, before the load is
+            # recorded or the cache retired. Steps that committed before it keep their rows
+            steps = quality.with_checks(steps)
+        run_dag(steps, pool, max_connections)
+        with db.connection(config) as conn:
+            incremental.record_loaded(conn, events + songs, replace=True)
+            if run_id is not None:
+                checkpoint.finish(conn, run_id)
+        changed = True
+
+    # Cached analytic results are keyed on the load generation, so this retires them
+    if changed and query_cache.enabled(config):
+        query_cache.bump_generation(config)
+
+    if export_parquet:
+        import parquet_export
+        with db.connection(config) as conn:
+            parquet_export.export_from_config(conn, config)
 
 
 if __name__ == "__main__":
-    main()
-
-
-
-# def load_staging_tables(cur, conn):
-#     for query in copy_table_queries:
-#         cur.execute(query)
-#         conn.commit()
-
-
-# def insert_tables(cur, conn):
-#     for query in insert_table_queries:
-#         cur.execute(query)
-#         conn.commit()
-
-
-# def main():
-#     config = configparser.ConfigParser()
-#     config.read('dwh.cfg')
-
-#     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-#     cur = conn.cursor()
-    
-#     load_staging_tables(cur, conn)
-#     insert_tables(cur, conn)
-
-#     conn.close()
-
-
-# if __name__ == "__main__":
-#     main()
\ No newline at end of file
+    if '--profile' in sys.argv:
+        # Log the slowest steps and statements of this run when it ends
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        with metrics.Profiler() as profiler:
+            main(incremental_load='--incremental' in sys.argv, export_parquet='--parquet' in sys.argv)
+        profiler.report()
+    else:
+        main(incremental_load='--incremental' in sys.argv, export_parquet='--parquet' in sys.argv)
@@ -1,39 +1,46 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries, create_table_queries, drop_table_queries
+import db
+import metrics
+from sql_queries import (insert_table_queries, songplay_table_drop, user_table_drop, song_table_drop,
+                         artist_table_drop, time_table_drop, song_match_table_drop, songplay_by_song_table_drop,
+                         songplay_by_artist_table_drop, songplay_by_hour_table_drop, songplay_table_create,
+                         user_table_create, song_table_create, artist_table_create, time_table_create,
+                         song_match_table_create, songplay_by_song_table_create, songplay_by_artist_table_create,
+                         songplay_by_hour_table_create)
 
 # Use this to test the creation of our fact and dimension tables without modifying our staging tables
 
+# The tables insert_table_queries fill, named so that staging, load_state and the other
+# bookkeeping tables are left alone however create_table_queries grows
+drop_table_queries = [song_match_table_drop, songplay_table_drop, user_table_drop, song_table_drop,
+                      artist_table_drop, time_table_drop, songplay_by_song_table_drop,
+                      songplay_by_artist_table_drop, songplay_by_hour_table_drop]
+create_table_queries = [song_match_table_create, songplay_table_create, user_table_create, song_table_create,
+                        artist_table_create, time_table_create, songplay_by_song_table_create,
+                        songplay_by_artist_table_create, songplay_by_hour_table_create]
+
 
 def drop_tables(cur, conn):
-    for query in drop_table_queries[2:]:
-        cur.execute(query)
+    for query in drop_table_queries:
+        metrics.execute(cur, query, 'drop_tables')
         conn.commit()
 
 def create_tables(cur, conn):
-    for query in create_table_queries[2:]:
-        cur.execute(query)
+    for query in create_table_queries:
+        metrics.execute(cur, query, 'create_tables')
         conn.commit()
 
 def insert_tables(cur, conn):
     for query in insert_table_queries:
-        cur.execute(query)
+        metrics.execute(cur, query, 'insert_tables')
         conn.commit()
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-    insert_tables(cur, conn)
-
-    conn.close()
+    with db.connection() as conn:
+        cur = conn.cursor()
+        drop_tables(cur, conn)
+        create_tables(cur, conn)
+        insert_tables(cur, conn)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import sys
+
+import staging_schema
+import storage
+
+# Sizes of the Udacity LOG_DATA/SONG_DATA sample, used as scale 1
+BASE_SONGS = 14896
+BASE_EVENTS = 8056
+BASE_USERS = 96
+
+LOG_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+               'level', 'location', 'method', 'page', 'registration', 'sessionId', 'song',
+               'status', 'ts', 'userAgent', 'userId']
+
+WORDS = ['love', 'night', 'heart', 'fire', 'dream', 'rain', 'blue', 'gold', 'city', 'road',
+         'summer', 'river', 'ghost', 'light', 'wild', 'dance', 'shadow', 'home', 'storm', 'star']
+PAGES = ['Home', 'About', 'Settings', 'Help', 'Upgrade', 'Downgrade', 'Logout', 'Save Settings']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Portland-South Portland, ME', 'Lansing-East Lansing, MI']
+AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+          'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:31.0) Gecko/20100101 Firefox/31.0',
+          '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+
+
+def zipf_index(rng, n: int, skew: float):
+    """Draw an index in [0, n) where low indexes are more popular
+
+    Uses the inverse CDF of a continuous power law, so nothing proportional to n is
+    kept in memory. A skew of 0 is uniform.
+
+    Args:
+        rng (random.Random): Random number generator
+        n (int):             Number of items
+        skew (float):        Zipf exponent
+
+    """
+    u = rng.random()
+    if skew == 0:
+        return int(u * n)
+    if skew == 1:
+        x = n ** u
+    else:
+        x = ((n ** (1 - skew) - 1) * u + 1) ** (1 / (1 - skew))
+    return min(int(x) - 1, n - 1)
+
+
+def song(seed: int, i: int, n_artists: int):
+    """Build song number i. The same seed and index always give the same song.
+
+    Args:
+        seed (int):      Dataset seed
+        i (int):         Song index
+        n_artists (int): Number of artists songs are spread over
+
+    """
+    rng = random.Random(seed * 1000003 + i)
+    artist = i % n_artists
+    artist_rng = random.Random(seed * 1000033 + artist)
+    has_location = artist_rng.random() < 0.4
+    return {'num_songs': 1,
+            'artist_id': f"AR{artist:016X}",
+            'artist_latitude': round(artist_rng.uniform(-60, 60), 5) if has_location else None,
+            'artist_longitude': round(artist_rng.uniform(-150, 150), 5) if has_location else None,
+            'artist_location': artist_rng.choice(LOCATIONS) if has_location else '',
+            'artist_name': ' '.join(artist_rng.choice(WORDS).title() for _ in range(2)) + f" {artist}",
+            'song_id': f"SO{i:016X}",
+            'title': ' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 4))) + f" {i}",
+            'duration': round(rng.uniform(90, 480), 5),
+            'year': rng.choice([0, rng.randint(1960, 2018)])}
+
+
+def user(seed: int, i: int):
+    """Build the static attributes of user number i"""
+    rng = random.Random(seed * 1000037 + i)
+    return {'userId': str(i + 1),
+            'firstName': rng.choice(WORDS).title(),
+            'lastName': rng.choice(WORDS).title() + 'son',
+            'gender': rng.choice(['F', 'M']),
+            'location': rng.choice(LOCATIONS),
+            'userAgent': rng.choice(AGENTS),
+            'registration': float(1540000000000 + rng.randint(0, 10 ** 9))}
+
+
+def write_songs(config, args, n_songs: int, n_artists: int):
+    """Stream the song catalogue to SONG_DATA, songs_per_file songs per object"""
+    root = storage.local_path(args.out, config['S3']['SONG_DATA'])
+    written = 0
+    for start in range(0, n_songs, args.songs_per_file):
+        key = f"{start:012X}"
+        directory = os.path.join(root, key[-3], key[-2], key[-1])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"TR{key}.json"), 'w') as f:
+            for i in range(start, min(start + args.songs_per_file, n_songs)):
+                f.write(json.dumps(song(args.seed, i, n_artists)) + '\n')
+                written += 1
+    return written
+
+
+def events(args, n_events: int, n_songs: int, n_artists: int, n_users: int, day: datetime.date):
+    """Yield one day's worth of log events, sorted by ts"""
+    rng = random.Random(args.seed * 1000039 + day.toordinal())
+    start = datetime.datetime(day.year, day.month, day.day)
+    offsets = sorted(rng.random() * 86400000 for _ in range(n_events))
+    sessions = {}
+    for offset in offsets:
+        ts = int((start - datetime.datetime(1970, 1, 1)).total_seconds() * 1000 + offset)
+        logged_in = rng.random() >= args.null_user_rate
+        u = zipf_index(rng, n_users, args.skew)
+        session_id, item = sessions.get(u, (rng.randint(1, 10 ** 6), 0))
+        sessions[u] = (session_id, item + 1)
+        event = dict.fromkeys(LOG_COLUMNS)
+        event.update({'auth': 'Logged In' if logged_in else 'Logged Out',
+                      'itemInSession': item,
+                      'level': 'paid' if random.Random(args.seed + u * 31 + day.toordinal() // 7).random() < 0.3 else 'free',
+                      'method': 'GET',
+                      'page': rng.choice(PAGES),
+                      'sessionId': session_id,
+                      'status': 200,
+                      'ts': ts,
+                      'userId': ''})
+        if logged_in:
+            event.update(user(args.seed, u))
+            if rng.random() < 0.8:
+                if rng.random() < args.match_rate:
+                    s = song(args.seed, zipf_index(rng, n_songs, args.skew), n_artists)
+                else:
+                    s = {'artist_name': f"Unknown Artist {rng.randint(0, 10 ** 6)}",
+                         'title': f"Unknown Song {rng.randint(0, 10 ** 6)}",
+                         'duration': round(rng.uniform(90, 480), 5)}
+                event.update({'artist': s['artist_name'], 'song': s['title'], 'length': s['duration'],
+                              'page': 'NextSong', 'method': 'PUT'})
+        yield event
+
+
+def write_events(config, args, n_events: int, n_songs: int, n_artists: int, n_users: int):
+    """Stream the event log to LOG_DATA, one object per day like the Udacity sample"""
+    root = storage.local_path(args.out, config['S3']['LOG_DATA'])
+    n_files = max(1, math.ceil(n_events / args.events_per_file))
+    first_day = datetime.date(2018, 11, 1)
+    written = 0
+    for n in range(n_files):
+        day = first_day + datetime.timedelta(days=n)
+        directory = os.path.join(root, str(day.year), f"{day.month:02d}")
+        os.makedirs(directory, exist_ok=True)
+        count = min(args.events_per_file, n_events - written)
+        with open(os.path.join(directory, f"{day.isoformat()}-events.json"), 'w') as f:
+            for event in events(args, count, n_songs, n_artists, n_users, day):
+                f.write(json.dumps(event) + '\n')
+        written += count
+    return written
+
+
+def write_jsonpaths(config, args):
+    """Write the jsonpaths files the COPY statements point at"""
+    for table, (_, option) in staging_schema.SOURCES.items():
+        path = storage.local_path(args.out, config['S3'][option])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(staging_schema.jsonpaths(table), f, indent=4)
+
+
+def parse_args(argv, config):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Sparkify dataset in the local S3 stand-in')
+    parser.add_argument('--scale', type=float, default=1, help='Multiple of the Udacity sample size, e.g. 1, 10, 100, 1000')
+    parser.add_argument('--out', default=config.get('LOCAL', 'DATA_DIR', fallback='data'),
+                        help='Directory standing in for S3')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of song and user popularity, 0 is uniform')
+    parser.add_argument('--null-user-rate', type=float, default=0.03, help='Fraction of logged out events with a blank userId')
+    parser.add_argument('--match-rate', type=float, default=0.9, help='Fraction of plays that match a song in SONG_DATA')
+    parser.add_argument('--events-per-file', type=int, default=300)
+    parser.add_argument('--songs-per-file', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Write event log and song JSON files at the requested scale"""
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    args = parse_args(argv, config)
+
+    n_songs = max(1, int(BASE_SONGS * args.scale))
+    n_events = max(1, int(BASE_EVENTS * args.scale))
+    n_users = max(1, int(BASE_USERS * args.scale))
+    n_artists = max(1, int(n_songs / 1.4))
+
+    write_jsonpaths(config, args)
+    songs_written = write_songs(config, args, n_songs, n_artists)
+    events_written = write_events(config, args, n_events, n_songs, n_artists, n_users)
+    logging.info(f"Wrote {songs_written} songs and {events_written} events to {args.out}")
+    return songs_written, events_written
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
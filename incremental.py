@@ -0,0 +1,169 @@
+import datetime
+import json
+import logging
+from psycopg2.extras import execute_values
+
+import compaction
+import inventory
+import quality
+import staging_schema
+import storage
+from dag import run_dag
+from sql_queries import (incremental_etl_steps, staging_events_manifest_copy,
+                         staging_songs_manifest_copy, staging_events_compacted_copy,
+                         staging_songs_compacted_copy, staging_events_rejects_insert,
+                         staging_songs_rejects_insert)
+
+
+def loaded_objects(cur):
+    """Return the S3 objects already ingested as a dict of url -> etag
+
+    Args:
+        cur (psycopg2.extensions.cursor): Postgres cursor
+
+    """
+    cur.execute("SELECT s3_key, etag FROM load_state")
+    return dict(cur.fetchall())
+
+
+def new_objects(objects: list, loaded: dict):
+    """Keep the objects that were never loaded or whose contents changed since
+
+    Args:
+        objects (list): Objects returned by storage.list_objects
+        loaded (dict):  url -> etag of objects already loaded
+
+    """
+    return [o for o in objects if loaded.get(o['url']) != o['etag']]
+
+
+def source_objects(config):
+    """List the log and song objects under the S3 prefixes in dwh.cfg
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    Returns:
+        (log objects, song objects)
+
+    """
+    # Listed in parallel, or reused from the inventory boot.py takes before the load
+    return (inventory.objects(config, config['S3']['LOG_DATA']),
+            inventory.objects(config, config['S3']['SONG_DATA']))
+
+
+def write_manifest(config, name: str, objects: list):
+    """Write a COPY manifest listing the objects to load
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        name (str):                         Manifest name, e.g. 'log_data'
+        objects (list):                     Objects to include
+
+    Returns:
+        S3 URI of the manifest, or None when there is nothing to load
+
+    """
+    if not objects:
+        return None
+    bucket = storage.my_bucket(config, 'An incremental load')
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    manifest = {'entries': [{'url': o['url'], 'mandatory': True} for o in objects]}
+    return storage.put_object(config, f"s3://{bucket}/manifests/{name}-{stamp}.manifest",
+                              json.dumps(manifest).encode())
+
+
+def incremental_steps(events_manifest: str, songs_manifest: str, compacted: bool = False):
+    """Build the incremental ETL steps, copying only the objects in the manifests
+
+    Args:
+        events_manifest (str): S3 URI of the log data manifest, or None
+        songs_manifest (str):  S3 URI of the song data manifest, or None
+        compacted (bool):      The manifests list gzipped chunks written by compaction.py
+
+    """
+    events_copy, songs_copy = ((staging_events_compacted_copy, staging_songs_compacted_copy) if compacted
+                               else (staging_events_manifest_copy, staging_songs_manifest_copy))
+    steps = dict(incremental_etl_steps)
+    for step, manifest, copy, rejects in [
+            ('staging_events_copy', events_manifest, events_copy, staging_events_rejects_insert),
+            ('staging_songs_copy', songs_manifest, songs_copy, staging_songs_rejects_insert)]:
+        queries, deps = steps[step]
+        if manifest is not None:
+            queries = queries + [copy.format(manifest=manifest), rejects]
+        steps[step] = (queries, deps)
+    return steps
+
+
+def record_loaded(conn, objects: list, replace: bool = False):
+    """Mark objects as ingested in the load_state table
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        objects (list):                        Objects that were loaded
+        replace (bool):                        Forget every other object, after a full load
+
+    """
+    cur = conn.cursor()
+    if replace:
+        # load_state outlives create_tables.py, so a full reload starts it over
+        cur.execute("DELETE FROM load_state")
+    if not objects:
+        conn.commit()
+        return
+    if not replace:
+        cur.execute("DELETE FROM load_state WHERE s3_key IN %s", (tuple(o['url'] for o in objects),))
+    execute_values(cur,
+                   "INSERT INTO load_state (s3_key, etag, size, loaded_at) VALUES %s",
+                   [(o['url'], o['etag'], o['size'], datetime.datetime.utcnow()) for o in objects])
+    conn.commit()
+
+
+def run(config, pool, max_workers: int):
+    """Stage only new S3 objects and merge them into the star schema
+
+    Args:
+        config (configparser.ConfigParser):          Parsed dwh.cfg
+        pool (psycopg2.pool.ThreadedConnectionPool): Connection pool
+        max_workers (int):                           Maximum number of steps running at the same time
+
+    Returns:
+        number of new objects loaded
+
+    """
+    conn = pool.getconn()
+    try:
+        loaded = loaded_objects(conn.cursor())
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    events, songs = source_objects(config)
+    new_events = new_objects(events, loaded)
+    new_songs = new_objects(songs, loaded)
+    logging.info(f"Found {len(new_events)} new log objects and {len(new_songs)} new song objects")
+    if not new_events and not new_songs:
+        return 0
+
+    staging_schema.check(config, {'staging_events': new_events, 'staging_songs': new_songs})
+    if compaction.enabled(config):
+        conn = pool.getconn()
+        try:
+            slices = compaction.slice_count(conn, config)
+        finally:
+            pool.putconn(conn)
+        steps = incremental_steps(compaction.compact(config, 'log_data', new_events, slices),
+                                  compaction.compact(config, 'song_data', new_songs, slices), compacted=True)
+    else:
+        steps = incremental_steps(write_manifest(config, 'log_data', new_events),
+                                  write_manifest(config, 'song_data', new_songs))
+    if quality.enabled(config):
+        steps = quality.with_checks(steps, incremental=True)
+    run_dag(steps, pool, max_workers)
+
+    conn = pool.getconn()
+    try:
+        record_loaded(conn, new_events + new_songs)
+    finally:
+        pool.putconn(conn)
+    return len(new_events) + len(new_songs)
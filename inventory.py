@@ -0,0 +1,289 @@
+import argparse
+import bisect
+import configparser
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import storage
+
+# Pre-flight inventory of the S3 data before any COPY. A prefix is split into its
+# sub-prefixes, a level at a time, until there are enough to keep [INVENTORY] WORKERS
+# threads busy, and each is listed in parallel. The listing, with every object's size
+# and ETag, is cached in [INVENTORY] CACHE_PATH and reused by the load for MAX_AGE_SECONDS,
+# and the previous one is kept to report what was added, changed or removed since. From
+# the sizes, recommend() estimates the COPY time and suggests the node count, compaction
+# and checkpoint chunk size.
+
+# Upper bounds in bytes of the size histogram buckets
+SIZE_BUCKETS = [('<1KB', 2 ** 10), ('<64KB', 2 ** 16), ('<1MB', 2 ** 20), ('<16MB', 2 ** 24),
+                ('<128MB', 2 ** 27), ('>=128MB', math.inf)]
+
+# node type -> (slices per node, storage per node in GB)
+NODE_TYPES = {
+    'dc2.large': (2, 160),
+    'dc2.8xlarge': (16, 2560),
+    'ra3.xlplus': (2, 32000),
+    'ra3.4xlarge': (4, 128000),
+    'ra3.16xlarge': (16, 128000),
+}
+
+
+def _split(config, uri: str, wanted: int, max_depth: int):
+    """Expand a prefix into sub-prefixes until there are wanted of them or max_depth levels
+
+    Returns:
+        (sub-prefix URIs still to list, objects found directly on the levels expanded)
+
+    """
+    prefixes = [uri]
+    objects = []
+    for _ in range(max_depth):
+        if len(prefixes) >= wanted:
+            break
+        deeper = []
+        for prefix in prefixes:
+            sub_prefixes, found = storage.list_level(config, prefix)
+            deeper += sub_prefixes
+            objects += found
+        prefixes = deeper
+        if not prefixes:
+            break
+    return prefixes, objects
+
+
+def list_parallel(config, uri: str):
+    """List every object under a prefix, listing its sub-prefixes in parallel
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 prefix URI
+
+    Returns:
+        list of dicts with the object's url, size and etag, in url order
+
+    """
+    workers = config.getint('INVENTORY', 'WORKERS', fallback=16)
+    prefixes, objects = _split(config, uri, workers, config.getint('INVENTORY', 'MAX_DEPTH', fallback=3))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for listed in executor.map(lambda prefix: storage.list_objects(config, prefix), prefixes):
+            objects += listed
+    return sorted(objects, key=lambda o: o['url'])
+
+
+def _read_cache(path: str):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_cache(path: str, cache: dict):
+    # Written then renamed, so a concurrent reader never sees half a listing
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(cache, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def take(config, uris: list = None):
+    """List the prefixes and cache the listing, keeping the one it replaces as previous
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uris (list):                        S3 prefix URIs, [S3] LOG_DATA and SONG_DATA by default
+
+    Returns:
+        dict of prefix URI -> objects
+
+    """
+    uris = uris or [config['S3']['LOG_DATA'], config['S3']['SONG_DATA']]
+    path = config.get('INVENTORY', 'CACHE_PATH', fallback='s3_inventory.json')
+    cache = _read_cache(path)
+    listings = {}
+    for uri in uris:
+        with metrics.stage('inventory', prefix=uri) as record:
+            listings[uri] = list_parallel(config, uri)
+            record.update(objects=len(listings[uri]), listed_bytes=sum(o['size'] for o in listings[uri]))
+        entry = cache.get(uri)
+        cache[uri] = {'taken_at': time.time(), 'objects': listings[uri],
+                      'previous': entry['objects'] if entry else None}
+    _write_cache(path, cache)
+    return listings
+
+
+def objects(config, uri: str):
+    """The objects under a prefix, from a cached listing younger than [INVENTORY] MAX_AGE_SECONDS
+
+    Objects uploaded since the cached listing was taken are picked up by the next load.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 prefix URI
+
+    """
+    max_age = config.getfloat('INVENTORY', 'MAX_AGE_SECONDS', fallback=300)
+    entry = _read_cache(config.get('INVENTORY', 'CACHE_PATH', fallback='s3_inventory.json')).get(uri)
+    if entry and time.time() - entry['taken_at'] <= max_age:
+        return entry['objects']
+    return take(config, [uri])[uri]
+
+
+def diff(previous: list, current: list):
+    """Objects added, changed (new ETag) and removed between two listings
+
+    Args:
+        previous (list): Earlier listing, or None when there is none
+        current (list):  Current listing
+
+    """
+    before = {o['url']: o['etag'] for o in previous or []}
+    now = {o['url'] for o in current}
+    return {'added': [o for o in current if o['url'] not in before],
+            'changed': [o for o in current if o['url'] in before and before[o['url']] != o['etag']],
+            'removed': sorted(url for url in before if url not in now)}
+
+
+def changes(config, uri: str):
+    """diff() of the cached listing of a prefix against the one it replaced"""
+    entry = _read_cache(config.get('INVENTORY', 'CACHE_PATH', fallback='s3_inventory.json')).get(uri)
+    if entry is None:
+        return None
+    return diff(entry['previous'], entry['objects'])
+
+
+def _percentile(sizes: list, fraction: float):
+    return sizes[min(len(sizes) - 1, int(fraction * len(sizes)))]
+
+
+def summarize(listing: list):
+    """Count, bytes and size distribution of a listing"""
+    sizes = sorted(o['size'] for o in listing)
+    histogram = dict.fromkeys((name for name, _ in SIZE_BUCKETS), 0)
+    bounds = [bound for _, bound in SIZE_BUCKETS]
+    for size in sizes:
+        histogram[SIZE_BUCKETS[bisect.bisect_right(bounds, size)][0]] += 1
+    summary = {'objects': len(sizes), 'bytes': sum(sizes), 'histogram': histogram}
+    if sizes:
+        summary.update(min=sizes[0], p50=_percentile(sizes, 0.5), p90=_percentile(sizes, 0.9), max=sizes[-1])
+    return summary
+
+
+def copy_minutes(total_bytes: int, files: int, slices: int, mb_per_slice_second: float, file_seconds: float):
+    """Estimated COPY time: each slice reads its share of the bytes and pays a fixed cost per file"""
+    seconds = total_bytes / 2 ** 20 / mb_per_slice_second / slices + files * file_seconds / slices
+    return round(seconds / 60, 1)
+
+
+def recommend(config, summaries: list):
+    """Suggest the node count, compaction and checkpoint chunk size for the inventoried data
+
+    The node count covers both storage, at [INVENTORY] STORED_FRACTION of the raw JSON for
+    the staging and star schema copies kept under half full, and a COPY finishing in
+    TARGET_COPY_MINUTES at SLICE_MB_PER_SECOND and FILE_SECONDS per object on each slice.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        summaries (list):                   summarize() of each prefix
+
+    """
+    node_type = config.get('CLUSTER', 'DWH_NODE_TYPE', fallback='dc2.large')
+    slices_per_node, storage_gb = NODE_TYPES.get(node_type, NODE_TYPES['dc2.large'])
+    configured = config.getint('CLUSTER', 'DWH_NUM_NODES', fallback=1)
+    rate = config.getfloat('INVENTORY', 'SLICE_MB_PER_SECOND', fallback=5.0)
+    file_seconds = config.getfloat('INVENTORY', 'FILE_SECONDS', fallback=0.05)
+    target_minutes = config.getfloat('INVENTORY', 'TARGET_COPY_MINUTES', fallback=30)
+    stored_fraction = config.getfloat('INVENTORY', 'STORED_FRACTION', fallback=0.3)
+
+    total_bytes = sum(s['bytes'] for s in summaries)
+    files = sum(s['objects'] for s in summaries)
+    small = sum(s['histogram']['<1KB'] + s['histogram']['<64KB'] + s['histogram']['<1MB'] for s in summaries)
+    compact = files > 0 and small / files > 0.5
+    # Compacted chunks are few, so the per-file cost all but disappears
+    copied_files = 0 if compact else files
+
+    storage_nodes = math.ceil(total_bytes * stored_fraction * 2 / (storage_gb * 2 ** 30 * 0.5))
+    needed_slices = math.ceil(copy_minutes(total_bytes, copied_files, 1, rate, file_seconds) / target_minutes)
+    throughput_nodes = math.ceil(needed_slices / slices_per_node)
+    nodes = max(1, storage_nodes, throughput_nodes)
+    # A multi-node cluster has at least two compute nodes
+    nodes = 2 if nodes == 1 and configured > 1 else nodes
+    slices = nodes * slices_per_node
+
+    target_mb = min(256, max(16, math.ceil(total_bytes / 2 ** 20 / slices / 4)))
+    # Files COPY reads: the objects, or as many compacted chunks as compaction.plan_chunks makes
+    copy_files = files
+    if compact:
+        copy_files = min(files, max(1, math.ceil(total_bytes / (target_mb * 2 ** 20) / slices)) * slices)
+    # About five minutes of COPY per checkpointed chunk, in whole multiples of the slices
+    chunk_files = rate * 2 ** 20 * slices * 300 / max(1, total_bytes / max(1, copy_files))
+    chunk_files = min(math.floor(chunk_files / slices), math.ceil(copy_files / slices)) * slices
+    chunk_files = max(slices, chunk_files)
+    return {'node_type': node_type, 'nodes': nodes, 'slices': slices,
+            'storage_nodes': storage_nodes, 'throughput_nodes': throughput_nodes,
+            'copy_minutes': copy_minutes(total_bytes, copied_files, slices, rate, file_seconds),
+            'configured_nodes': configured,
+            'configured_copy_minutes': copy_minutes(total_bytes, copied_files, configured * slices_per_node,
+                                                    rate, file_seconds),
+            'compaction': compact, 'compaction_target_mb': target_mb, 'copy_chunk_files': chunk_files}
+
+
+def preflight(config):
+    """Take the inventory and log what it found and recommends before the load
+
+    With [INVENTORY] APPLY_SIZING the recommended node count replaces DWH_NUM_NODES, for
+    boot.py to create the cluster with.
+
+    Returns:
+        recommend() of the inventory
+
+    """
+    listings = take(config)
+    summaries = []
+    for uri, listing in listings.items():
+        summary = summarize(listing)
+        summaries.append(summary)
+        logging.info(f"{uri}: {summary['objects']} objects, {summary['bytes'] / 2 ** 20:.1f} MB, "
+                     f"median {summary.get('p50', 0)} bytes, sizes {summary['histogram']}")
+        changed = changes(config, uri)
+        if changed:
+            logging.info(f"{uri}: {len(changed['added'])} added, {len(changed['changed'])} changed and "
+                         f"{len(changed['removed'])} removed since the last inventory")
+        if changed and changed['removed']:
+            logging.warning(f"{uri}: the rows of removed objects stay loaded until the next full load")
+    advice = recommend(config, summaries)
+    logging.info(f"Recommended {advice['nodes']} x {advice['node_type']} ({advice['slices']} slices): "
+                 f"COPY about {advice['copy_minutes']} min, {advice['configured_copy_minutes']} min "
+                 f"on the configured {advice['configured_nodes']} nodes")
+    logging.info(f"Recommended COPY chunking: compaction {'on' if advice['compaction'] else 'off'} at "
+                 f"{advice['compaction_target_mb']} MB, [CHECKPOINT] COPY_CHUNK_FILES={advice['copy_chunk_files']}")
+    metrics.emit(dict(advice, stage='inventory_preflight', seconds=0))
+    if config.getboolean('INVENTORY', 'APPLY_SIZING', fallback=False):
+        config['CLUSTER']['DWH_NUM_NODES'] = str(advice['nodes'])
+    return advice
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inventory the S3 data and recommend cluster sizing and COPY chunking')
+    parser.add_argument('--json', action='store_true', help='Print the summaries and recommendation as JSON')
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if not args.json:
+        preflight(config)
+        return
+    listings = take(config)
+    summaries = {uri: summarize(listing) for uri, listing in listings.items()}
+    counts = {uri: {kind: len(found) for kind, found in (changes(config, uri) or {}).items()} for uri in listings}
+    print(json.dumps({'prefixes': summaries, 'changes': counts,
+                      'recommendation': recommend(config, list(summaries.values()))}, indent=4))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
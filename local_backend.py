@@ -0,0 +1,247 @@
+import datetime
+import gzip
+import json
+import re
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+import storage
+
+# Run the warehouse SQL on a plain PostgreSQL database instead of Redshift. Table
+# attributes that only matter to Redshift are stripped, and COPY is emulated by reading
+# the JSON files from the local directory standing in for S3 (see storage.local_root).
+
+_REDSHIFT_ONLY = [
+    (re.compile(r'\bDISTSTYLE\s+(ALL|EVEN|KEY|AUTO)\b', re.I), ''),
+    (re.compile(r'\b(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\bDISTKEY\s*\([^)]*\)', re.I), ''),
+    (re.compile(r'\b(SORTKEY|DISTKEY)\b', re.I), ''),
+    (re.compile(r'\bENCODE\s+\w+', re.I), ''),
+    (re.compile(r'\bIDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)', re.I),
+     r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)'),
+    (re.compile(r'\bEXTRACT\s*\(\s*weekday\b', re.I), 'EXTRACT(dow'),
+]
+
+_COPY = re.compile(r"^\s*COPY\s+(?P<table>[\w.]+)\s+FROM\s+'(?P<source>[^']+)'(?P<options>.*)$", re.I | re.S)
+_JSON_OPTION = re.compile(r"\bJSON\s+'(?P<jsonpaths>[^']+)'", re.I)
+_NON_SPACE = re.compile(r'\S')
+_MAXERROR_OPTION = re.compile(r'\bMAXERROR\s+(?:AS\s+)?(?P<maxerror>\d+)', re.I)
+_LAST_COPY_REJECTS = re.compile(r'\bstl_load_errors\b.*\bpg_last_copy_id\(\)', re.I | re.S)
+_JSONPATH = re.compile(r"^\$(?:\['(?P<bracket>[^']+)'\]|\.(?P<dot>\w+))$")
+
+
+def enabled(config):
+    """Return whether the local PostgreSQL backend is switched on in dwh.cfg
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    return config.getboolean('LOCAL', 'ENABLED', fallback=False)
+
+
+def translate(query: str):
+    """Rewrite Redshift-only syntax into its PostgreSQL equivalent
+
+    Args:
+        query (str): SQL query written for Redshift
+
+    """
+    for pattern, replacement in _REDSHIFT_ONLY:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def _jsonpaths_keys(config, jsonpaths: str, columns: list):
+    """Return the JSON key feeding each table column, in column order"""
+    if jsonpaths.lower() == 'auto':
+        return [name for name, _, _ in columns]
+    keys = []
+    for path in json.loads(storage.get_object(config, jsonpaths))['jsonpaths']:
+        match = _JSONPATH.match(path)
+        if match is None:
+            raise ValueError(f"Unsupported jsonpath: {path}")
+        keys.append(match.group('bracket') or match.group('dot'))
+    if len(keys) != len(columns):
+        raise psycopg2.DataError(f"{jsonpaths} has {len(keys)} paths but the table has {len(columns)} columns")
+    return keys
+
+
+def _records(body: bytes):
+    """Yield (line number, record) for every JSON object in a file
+
+    Objects may be one per line or concatenated, like Redshift's COPY accepts.
+    """
+    text = body.decode('utf-8')
+    decoder = json.JSONDecoder()
+    pos = 0
+    # Newlines are counted from the previous record on, so a file is scanned once
+    line = 1
+    counted = 0
+    while True:
+        start = _NON_SPACE.search(text, pos)
+        if start is None:
+            return
+        pos = start.start()
+        line += text.count('\n', counted, pos)
+        counted = pos
+        record, pos = decoder.raw_decode(text, pos)
+        yield line, record
+
+
+def _convert(value, data_type: str, timeformat: str):
+    """Convert a JSON value to a column type the way COPY would, raising ValueError on failure"""
+    if value is None:
+        return None
+    if data_type in ('smallint', 'integer', 'bigint'):
+        if isinstance(value, str) and value.strip() == '':
+            raise ValueError('Invalid digit')
+        number = float(value)
+        if number != int(number):
+            raise ValueError('Invalid digit')
+        return int(number)
+    if data_type in ('real', 'double precision', 'numeric'):
+        return float(value)
+    if data_type.startswith('timestamp'):
+        if timeformat == 'epochmillisecs':
+            return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=float(value))
+        if timeformat == 'epochsecs':
+            return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=float(value))
+        return value
+    if data_type == 'boolean':
+        return bool(value)
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+class LocalCursor(psycopg2.extensions.cursor):
+    """Cursor that translates Redshift SQL and emulates COPY from the local S3 stand-in"""
+
+    def execute(self, query, vars=None):
+        if not isinstance(query, str):
+            return super().execute(query, vars)
+        copy = _COPY.match(query)
+        if copy is not None:
+            return self._copy(copy.group('table'), copy.group('source'), copy.group('options'))
+        if _LAST_COPY_REJECTS.search(query):
+            return self._insert_last_copy_rejects()
+        return super().execute(translate(query), vars)
+
+    def _columns(self, table: str):
+        super().execute("""
+            SELECT column_name, data_type, is_nullable = 'YES'
+            FROM information_schema.columns
+            WHERE table_name = %s
+              AND table_schema = ANY(current_schemas(false))
+            ORDER BY ordinal_position
+        """, (table.split('.')[-1].lower(),))
+        return self.fetchall()
+
+    def _sources(self, config, source: str, manifest: bool):
+        if manifest:
+            entries = json.loads(storage.get_object(config, source))['entries']
+            return [entry['url'] for entry in entries]
+        return [o['url'] for o in storage.list_objects(config, source)]
+
+    def _copy(self, table: str, source: str, options: str):
+        """Load every JSON object under the source prefix (or manifest) into the table"""
+        config = self.connection.config
+        jsonpaths = _JSON_OPTION.search(options)
+        maxerror = _MAXERROR_OPTION.search(options)
+        maxerror = int(maxerror.group('maxerror')) if maxerror else 0
+        timeformat = re.search(r"\bTIMEFORMAT\s+(?:AS\s+)?'([^']+)'", options, re.I)
+        timeformat = timeformat.group(1).lower() if timeformat else None
+        manifest = re.search(r'\bMANIFEST\b', options, re.I) is not None
+
+        columns = self._columns(table)
+        keys = _jsonpaths_keys(config, jsonpaths.group('jsonpaths') if jsonpaths else 'auto', columns)
+        insert = "INSERT INTO {} ({}) VALUES %s".format(table, ', '.join(name for name, _, _ in columns))
+        started = datetime.datetime.utcnow()
+
+        rejects = []
+        batch = []
+        loaded = 0
+        for url in self._sources(config, source, manifest):
+            body = storage.get_object(config, url)
+            if url.endswith('.gz'):
+                body = gzip.decompress(body)
+            for line_number, record in _records(body):
+                lowered = {k.lower(): v for k, v in record.items()}
+                row = []
+                for (name, data_type, nullable), key in zip(columns, keys):
+                    raw = record.get(key, lowered.get(key.lower()))
+                    try:
+                        value = _convert(raw, data_type, timeformat)
+                        if value is None and not nullable:
+                            raise ValueError('Missing data for not-null field')
+                    except (TypeError, ValueError, OverflowError) as e:
+                        rejects.append((table, url, line_number, name, data_type[:10],
+                                        None if raw is None else str(raw)[:1024], str(e)[:100], started))
+                        break
+                    row.append(value)
+                else:
+                    batch.append(row)
+                if len(rejects) > maxerror:
+                    # Kept for checkpoint.py, which reads stl_load_errors for them on Redshift
+                    self.connection.last_copy_rejects = rejects
+                    raise psycopg2.DataError(f"Load into table '{table}' failed. Check 'load_rejects' for details.")
+                if len(batch) >= 1000:
+                    execute_values(self, insert, batch)
+                    loaded += len(batch)
+                    batch = []
+        if batch:
+            execute_values(self, insert, batch)
+            loaded += len(batch)
+        self.connection.last_copy_rejects = rejects
+        self.rowcount_loaded = loaded
+
+    def _insert_last_copy_rejects(self):
+        rejects = getattr(self.connection, 'last_copy_rejects', [])
+        if rejects:
+            execute_values(self, """
+                INSERT INTO load_rejects
+                    (table_name, filename, line_number, colname, type, raw_field_value, err_reason, rejected_at)
+                VALUES %s
+            """, rejects, page_size=len(rejects))
+        else:
+            # Still run a statement so rowcount doesn't report the COPY's last batch
+            super().execute("SELECT 1 WHERE false")
+        self.connection.last_copy_rejects = []
+
+
+class LocalConnection(psycopg2.extensions.connection):
+    """Connection whose cursors run Redshift SQL against PostgreSQL"""
+
+    def __init__(self, dsn, *args, config=None, **kwargs):
+        super().__init__(dsn, *args, **kwargs)
+        self.config = config
+        self.last_copy_rejects = []
+        self.cursor_factory = LocalCursor
+
+
+def connect_args(config):
+    """Keyword arguments for psycopg2.connect (or a pool) pointing at the local database
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    def factory(dsn, *args, **kwargs):
+        return LocalConnection(dsn, *args, config=config, **kwargs)
+
+    return dict(host=config['LOCAL']['HOST'],
+                dbname=config['LOCAL']['DB_NAME'],
+                user=config['LOCAL']['DB_USER'],
+                password=config['LOCAL']['DB_PASSWORD'],
+                port=config['LOCAL']['DB_PORT'],
+                connection_factory=factory)
+
+
+def connect(config):
+    """Open a connection to the local PostgreSQL database
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    return psycopg2.connect(**connect_args(config))
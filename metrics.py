@@ -0,0 +1,300 @@
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Structured metrics for every statement the entry points run. execute() wraps
+# cur.execute and emits one record per statement with its stage, duration, rows and, on
+# Redshift, the bytes it scanned; stage() times a whole phase. Records are appended to
+# [METRICS] JSONL_PATH and summed per stage into the Prometheus textfile PROM_PATH, and
+# every record is passed to the hooks registered with add_hook(), e.g. a profiler.
+
+_lock = threading.Lock()
+_hooks = []
+_totals = collections.defaultdict(collections.Counter)
+_config = None
+
+
+def configure(config):
+    """Use this config's [METRICS] section instead of dwh.cfg's
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    global _config
+    _config = config
+
+
+def _settings():
+    global _config
+    if _config is None:
+        # db imports this module to record connect retries, so it is imported late
+        import db
+        _config = db.get_config()
+    return _config
+
+
+def add_hook(hook):
+    """Call hook(record) with every record emitted from now on
+
+    Args:
+        hook (callable): Receives each record dict
+
+    """
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def _write_prometheus(path: str):
+    lines = []
+    for metric, field, help_text in [
+            ('sparkify_stage_seconds_total', 'seconds', 'Seconds spent in statements of the stage'),
+            ('sparkify_stage_rows_total', 'rows', 'Rows loaded or written by the stage'),
+            ('sparkify_stage_bytes_total', 'bytes', 'Bytes scanned by the stage on Redshift'),
+            ('sparkify_stage_retries_total', 'retries', 'Retried attempts in the stage'),
+            ('sparkify_stage_errors_total', 'errors', 'Failed statements in the stage'),
+            ('sparkify_stage_statements_total', 'statements', 'Statements run by the stage')]:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        for stage, totals in sorted(_totals.items()):
+            lines.append(f'{metric}{{stage="{stage}"}} {round(totals[field], 6)}')
+    # Written then renamed, so node_exporter never reads half a file
+    with open(f"{path}.tmp", 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(f"{path}.tmp", path)
+
+
+def emit(record: dict, config=None):
+    """Send a record to the configured sinks and the hooks
+
+    Args:
+        record (dict):                      Record with at least 'stage' and 'seconds'
+        config (configparser.ConfigParser): Config whose [METRICS] section is used, the
+                                            configure()d one or dwh.cfg by default
+
+    """
+    config = config or _settings()
+    record = dict(record, time=datetime.datetime.utcnow().isoformat(timespec='milliseconds'),
+                  entry_point=os.path.basename(sys.argv[0]) or 'python')
+    formats = [f.strip() for f in config.get('METRICS', 'FORMAT', fallback='jsonl').split(',') if f.strip()]
+    with _lock:
+        totals = _totals[record['stage']]
+        totals['seconds'] += record.get('seconds') or 0
+        totals['rows'] += max(record.get('rows') or 0, 0)
+        totals['bytes'] += record.get('bytes') or 0
+        totals['retries'] += record.get('retries') or 0
+        totals['errors'] += record.get('status') == 'error'
+        totals['statements'] += record.get('statement') is not None
+        if 'jsonl' in formats:
+            with open(config.get('METRICS', 'JSONL_PATH', fallback='metrics.jsonl'), 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        if 'prometheus' in formats:
+            _write_prometheus(config.get('METRICS', 'PROM_PATH', fallback='sparkify_etl.prom'))
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(record)
+
+
+def query_stats(cur, redshift: bool):
+    """Return the query ID and svl_query_summary totals of the last statement run on cur
+
+    Only Redshift keeps these, so the local backend gets an empty dict.
+
+    Args:
+        cur (psycopg2.extensions.cursor): Cursor the statement ran on
+        redshift (bool):                  Whether cur is connected to Redshift
+
+    """
+    if not redshift:
+        return {}
+    cur.execute("SELECT pg_last_query_id()")
+    query_id = cur.fetchone()[0]
+    cur.execute("""
+        SELECT SUM(rows), SUM(bytes), BOOL_OR(is_diskbased = 't')
+        FROM svl_query_summary
+        WHERE query = %s
+    """, (query_id,))
+    rows, bytes_, diskbased = cur.fetchone()
+    return {'query_id': query_id, 'summary_rows': rows, 'summary_bytes': bytes_, 'diskbased': diskbased}
+
+
+def copy_stats(cur, query_id: int):
+    """Files and lines a COPY committed (stl_load_commits) and the bytes it read (stl_file_scan)"""
+    cur.execute("""
+        SELECT COUNT(DISTINCT filename), SUM(lines_scanned)
+        FROM stl_load_commits
+        WHERE query = %s
+    """, (query_id,))
+    files, lines = cur.fetchone()
+    cur.execute("SELECT SUM(bytes) FROM stl_file_scan WHERE query = %s", (query_id,))
+    return {'files': files, 'lines_scanned': lines, 'copy_bytes': cur.fetchone()[0]}
+
+
+def rows_affected(cur, query: str, redshift: bool):
+    """Rows loaded by a COPY or written by an INSERT/DELETE"""
+    if query.lstrip().upper().startswith('COPY'):
+        if redshift:
+            cur.execute("SELECT pg_last_copy_count()")
+            return cur.fetchone()[0]
+        return getattr(cur, 'rowcount_loaded', -1)
+    return cur.rowcount
+
+
+def execute(cur, query: str, stage: str, vars=None, config=None):
+    """Run a statement on cur and emit a record of it
+
+    The record has the stage, the statement's first 80 characters, seconds, rows and
+    status. With [METRICS] REDSHIFT_STATS=True it also has, on Redshift, the query ID and
+    bytes scanned from svl_query_summary, or for a COPY from stl_file_scan. That costs two
+    more round trips per statement and four per COPY, so it is off unless asked for.
+    A failed statement is recorded with its error and re-raised.
+
+    Args:
+        cur (psycopg2.extensions.cursor):   Cursor to run the statement on
+        query (str):                        SQL statement
+        stage (str):                        Stage or ETL step the statement belongs to
+        vars:                               Query parameters
+        config (configparser.ConfigParser): Config the statement's connection was opened
+                                            with, the configure()d one or dwh.cfg by default
+
+    Returns:
+        rows the statement returned or affected, pg_last_copy_count() for a COPY on Redshift.
+        Use it instead of cur.rowcount, which the Redshift stats queries overwrite.
+
+    """
+    config = config or _settings()
+    redshift = not config.getboolean('LOCAL', 'ENABLED', fallback=False)
+    record = {'stage': stage, 'statement': ' '.join(query.split())[:80]}
+    start = time.perf_counter()
+    try:
+        cur.execute(query, vars)
+    except Exception as e:
+        record.update(seconds=round(time.perf_counter() - start, 4), status='error', error=str(e).strip()[:500])
+        emit(record, config)
+        raise
+    record.update(seconds=round(time.perf_counter() - start, 4), status='ok')
+    # The stats queries below replace cur's result, so a SELECT keeps its own
+    if cur.description is not None:
+        record['rows'] = cur.rowcount
+        emit(record, config)
+        return record['rows']
+    record['rows'] = rows_affected(cur, query, redshift)
+    if redshift and config.getboolean('METRICS', 'REDSHIFT_STATS', fallback=False):
+        stats = query_stats(cur, redshift)
+        record.update(query_id=stats['query_id'], bytes=stats['summary_bytes'], diskbased=stats['diskbased'])
+        if query.lstrip().upper().startswith('COPY'):
+            record.update(copy_stats(cur, stats['query_id']))
+            record['bytes'] = record['copy_bytes'] or record['bytes']
+    emit(record, config)
+    return record['rows']
+
+
+@contextlib.contextmanager
+def stage(name: str, **fields):
+    """Time a whole phase, emitting one record when it ends
+
+    Example:
+        with metrics.stage('create_tables'):
+            create_tables.main()
+
+    """
+    start = time.perf_counter()
+    record = dict(fields, stage=name)
+    try:
+        yield record
+    except Exception as e:
+        record.update(seconds=round(time.perf_counter() - start, 4), status='error', error=str(e).strip()[:500])
+        emit(record)
+        raise
+    record.update(seconds=round(time.perf_counter() - start, 4), status='ok')
+    emit(record)
+
+
+class Profiler:
+    """Hook that collects statement records, to find the slowest stages and statements
+
+    Example:
+        with metrics.Profiler() as profiler:
+            etl.main()
+        profiler.report()
+
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record: dict):
+        if record.get('statement') is not None:
+            self.records.append(record)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+
+    def slowest(self, top: int = 10):
+        return summarize(self.records, top)
+
+    def report(self, top: int = 10):
+        stages, statements = self.slowest(top)
+        for name, totals in stages:
+            logging.info(f"{name}: {totals['seconds']:.3f}s in {totals['statements']} statements, {totals['rows']} rows")
+        for record in statements:
+            logging.info(f"{record['seconds']:.3f}s {record['stage']}: {record['statement']}")
+
+
+def summarize(records: list, top: int = 10):
+    """Rank stages by total statement time and list the slowest statements
+
+    Args:
+        records (list): Statement records, e.g. read back from the JSON lines file
+        top (int):      How many of each to return
+
+    Returns:
+        (list of (stage, totals) slowest first, list of the slowest statement records)
+
+    """
+    stages = collections.defaultdict(collections.Counter)
+    statements = [r for r in records if r.get('statement') is not None]
+    for record in statements:
+        totals = stages[record['stage']]
+        totals['seconds'] += record.get('seconds') or 0
+        totals['statements'] += 1
+        totals['rows'] += max(record.get('rows') or 0, 0)
+    ranked = sorted(stages.items(), key=lambda item: item[1]['seconds'], reverse=True)[:top]
+    return ranked, sorted(statements, key=lambda r: r.get('seconds') or 0, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the slowest stages and statements in a metrics file')
+    parser.add_argument('path', nargs='?', default='metrics.jsonl', help='JSON lines written by [METRICS] JSONL_PATH')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with open(args.path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    stages, statements = summarize(records, args.top)
+    print('Slowest stages:')
+    for name, totals in stages:
+        print(f"  {totals['seconds']:10.3f}s  {totals['statements']:5d} statements  {name}")
+    print('Slowest statements:')
+    for record in statements:
+        print(f"  {record['seconds']:10.3f}s  {record['stage']}: {record['statement']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
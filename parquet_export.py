@@ -0,0 +1,150 @@
+import logging
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+except ImportError:     # only needed when exporting
+    pa = None
+
+# Write the star schema out of the warehouse as Parquet, so it can still be queried after
+# shutdown.py has removed the cluster. songplay is partitioned by year/month of start_time,
+# and every file keeps row-group min/max statistics, so readers get partition pruning and
+# predicate pushdown (see read_table).
+
+
+def _schemas():
+    return {
+        'songplay': pa.schema([('songplay_id', pa.int32()), ('start_time', pa.timestamp('us')),
+                               ('user_id', pa.int32()), ('level', pa.string()), ('song_id', pa.string()),
+                               ('artist_id', pa.string()), ('session_id', pa.int32()),
+                               ('location', pa.string()), ('user_agent', pa.string())]),
+        'users': pa.schema([('user_id', pa.int32()), ('first_name', pa.string()), ('last_name', pa.string()),
+                            ('gender', pa.string()), ('level', pa.string())]),
+        'song': pa.schema([('song_id', pa.string()), ('title', pa.string()), ('artist_id', pa.string()),
+                           ('year', pa.int32()), ('duration', pa.float64())]),
+        'artist': pa.schema([('artist_id', pa.string()), ('name', pa.string()), ('location', pa.string()),
+                             ('latitude', pa.float64()), ('longitude', pa.float64())]),
+        'time': pa.schema([('start_time', pa.timestamp('us')), ('hour', pa.int32()), ('day', pa.int32()),
+                           ('week', pa.int32()), ('month', pa.int32()), ('year', pa.int32()),
+                           ('weekday', pa.int32())]),
+    }
+
+
+# Sorting on the column readers filter on keeps each row group's min/max range narrow
+SORT_COLUMNS = {'songplay': 'start_time', 'users': 'user_id', 'song': 'song_id',
+                'artist': 'artist_id', 'time': 'start_time'}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet export needs pyarrow: pip install pyarrow")
+
+
+def _batches(conn, table: str, schema, chunk_rows: int):
+    """Stream a table through a server-side cursor as Arrow record batches"""
+    cur = conn.cursor(name=f"parquet_export_{table}")
+    cur.itersize = chunk_rows
+    cur.execute(f"SELECT {', '.join(schema.names)} FROM {table} ORDER BY {SORT_COLUMNS[table]}")
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            arrays = [pa.array(column, type=field.type) for column, field in zip(columns, schema)]
+            if table == 'songplay':
+                start_time = arrays[schema.get_field_index('start_time')]
+                arrays += [pyarrow.compute.year(start_time).cast(pa.int16()),
+                           pyarrow.compute.month(start_time).cast(pa.int8())]
+                yield pa.RecordBatch.from_arrays(arrays, schema=_songplay_partitioned(schema))
+            else:
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+    finally:
+        cur.close()
+
+
+def _songplay_partitioned(schema):
+    return schema.append(pa.field('year', pa.int16())).append(pa.field('month', pa.int8()))
+
+
+def export(conn, path: str, compression: str = 'zstd', rows_per_group: int = 128 * 1024,
+           rows_per_file: int = 1024 * 1024, tables=None):
+    """Write the star schema tables to Parquet
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        path (str):                            Local directory or s3:// URI to write under
+        compression (str):                     Parquet compression codec
+        rows_per_group (int):                  Rows per row group, the unit readers skip with statistics
+        rows_per_file (int):                   Rows per file, so readers can split the work
+        tables (list):                         Tables to export, all five by default
+
+    """
+    _require_pyarrow()
+    filesystem, root = pyarrow.fs.FileSystem.from_uri(path if '://' in path else os.path.abspath(path))
+    file_format = ds.ParquetFileFormat()
+    write_options = file_format.make_write_options(compression=compression, write_statistics=True)
+    schemas = _schemas()
+
+    for table in tables or list(schemas):
+        schema = schemas[table]
+        partitioning = None
+        if table == 'songplay':
+            schema = _songplay_partitioned(schema)
+            partitioning = ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor='hive')
+        ds.write_dataset(_batches(conn, table, schemas[table], rows_per_group),
+                         f"{root}/{table}",
+                         schema=schema,
+                         format=file_format,
+                         file_options=write_options,
+                         filesystem=filesystem,
+                         partitioning=partitioning,
+                         basename_template=f"{table}-{{i}}.parquet",
+                         max_rows_per_group=rows_per_group,
+                         min_rows_per_group=min(rows_per_group, rows_per_file),
+                         max_rows_per_file=rows_per_file,
+                         existing_data_behavior='delete_matching')
+        conn.commit()
+        logging.info(f"Exported {table} to {path}/{table}")
+
+
+def export_from_config(conn, config):
+    """Export using the [PARQUET] settings in dwh.cfg
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        config (configparser.ConfigParser):    Parsed dwh.cfg
+
+    """
+    export(conn,
+           config.get('PARQUET', 'PATH', fallback='star_schema_parquet'),
+           compression=config.get('PARQUET', 'COMPRESSION', fallback='zstd'),
+           rows_per_group=config.getint('PARQUET', 'ROWS_PER_GROUP', fallback=128 * 1024),
+           rows_per_file=config.getint('PARQUET', 'ROWS_PER_FILE', fallback=1024 * 1024))
+
+
+def read_table(path: str, table: str, columns=None, filter=None):
+    """Read an exported table, pruning partitions and row groups that can't match the filter
+
+    Example:
+        read_table('star_schema_parquet', 'songplay', ['song_id'],
+                   (ds.field('year') == 2018) & (ds.field('month') == 11))
+
+    Args:
+        path (str):     Directory or s3:// URI passed to export
+        table (str):    Table name
+        columns (list): Columns to read, all by default
+        filter:         pyarrow.dataset expression
+
+    Returns:
+        pyarrow.Table
+
+    """
+    _require_pyarrow()
+    filesystem, root = pyarrow.fs.FileSystem.from_uri(path if '://' in path else os.path.abspath(path))
+    dataset = ds.dataset(f"{root}/{table}", format='parquet', filesystem=filesystem,
+                         partitioning='hive' if table == 'songplay' else None)
+    return dataset.to_table(columns=columns, filter=filter)
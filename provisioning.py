@@ -0,0 +1,332 @@
+import copy
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import boto3
+from botocore.exceptions import ClientError
+
+import db
+import storage
+from dag import topological_order
+
+# Provision the Redshift cluster as a set of steps that run as soon as their dependencies
+# finish, so the IAM policy and security group work overlaps with the cluster coming up.
+# Every finished step is recorded in a state file, and an interrupted boot.py picks up
+# from the steps that hadn't finished yet.
+
+S3_READ_ONLY_POLICY = 'arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess'
+UNLOAD_POLICY_NAME = 'sparkify-unload'
+
+
+def aws_clients(config):
+    """Create the IAM, Redshift and EC2 clients from the [AWS] section of dwh.cfg
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    return {name: boto3.client(name,
+                               region_name=config['AWS']['REGION'],
+                               aws_access_key_id=config['AWS']['KEY'],
+                               aws_secret_access_key=config['AWS']['SECRET'])
+            for name in ('iam', 'redshift', 'ec2')}
+
+
+def _error_code(e: ClientError):
+    return e.response.get('Error', {}).get('Code')
+
+
+def create_role(config, clients, state):
+    """Create the IAM role Redshift assumes to read S3, reusing it if it already exists"""
+    role_name = config['CLUSTER']['DWH_IAM_ROLE_NAME']
+    try:
+        clients['iam'].create_role(
+            Path='/',
+            RoleName=role_name,
+            AssumeRolePolicyDocument=json.dumps(
+                {'Statement': [{'Action': 'sts:AssumeRole',
+                                'Effect': 'Allow',
+                                'Principal': {'Service': 'redshift.amazonaws.com'}}],
+                 'Version': '2012-10-17'}))
+    except ClientError as e:
+        if _error_code(e) != 'EntityAlreadyExists':
+            raise
+        logging.info(f"IAM role {role_name} already exists")
+    return {'role_arn': clients['iam'].get_role(RoleName=role_name)['Role']['Arn']}
+
+
+def unload_policy(bucket: str):
+    """Inline policy letting the role write UNLOAD results under MY_BUCKET/unload/"""
+    return json.dumps({'Version': '2012-10-17',
+                       'Statement': [{'Effect': 'Allow',
+                                      'Action': ['s3:PutObject', 's3:DeleteObject'],
+                                      'Resource': f"arn:aws:s3:::{bucket}/unload/*"}]})
+
+
+def attach_policy(config, clients, state):
+    """Give the role S3 read-only access, and write access to MY_BUCKET/unload/ when MY_BUCKET is set
+
+    Attaching an attached policy and putting an inline policy again are no-ops.
+    """
+    role_name = config['CLUSTER']['DWH_IAM_ROLE_NAME']
+    clients['iam'].attach_role_policy(RoleName=role_name, PolicyArn=S3_READ_ONLY_POLICY)
+    my_bucket = config.get('S3', 'MY_BUCKET', fallback='').strip("'\" ")
+    if my_bucket:
+        bucket, _ = storage.parse_s3_uri(my_bucket)
+        clients['iam'].put_role_policy(RoleName=role_name, PolicyName=UNLOAD_POLICY_NAME,
+                                       PolicyDocument=unload_policy(bucket))
+    return {}
+
+
+def describe_cluster(clients, identifier: str):
+    """Return the cluster's description, or None when it doesn't exist"""
+    try:
+        return clients['redshift'].describe_clusters(ClusterIdentifier=identifier)['Clusters'][0]
+    except ClientError as e:
+        if _error_code(e) != 'ClusterNotFound':
+            raise
+        return None
+
+
+def snapshot_exists(clients, snapshot_identifier: str):
+    try:
+        return bool(clients['redshift'].describe_cluster_snapshots(
+            SnapshotIdentifier=snapshot_identifier)['Snapshots'])
+    except ClientError as e:
+        if _error_code(e) != 'ClusterSnapshotNotFound':
+            raise
+        return False
+
+
+def create_cluster(config, clients, state):
+    """Start bringing the cluster up without waiting for it
+
+    A paused cluster is resumed and, with [BOOT] LIFECYCLE=snapshot, the snapshot
+    shutdown.py took is restored. Both keep the loaded tables, which the returned
+    'start' value ('resumed' or 'restored') tells boot.py. Otherwise a new cluster is
+    created ('created'), or one that is already running is reused ('existing').
+    """
+    identifier = config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
+    snapshot = config.get('BOOT', 'SNAPSHOT_IDENTIFIER', fallback=f"{identifier}-warm")
+    redshift = clients['redshift']
+
+    cluster = describe_cluster(clients, identifier)
+    if cluster is not None and cluster['ClusterStatus'] == 'paused':
+        logging.info(f"Resuming paused cluster {identifier}")
+        cluster = redshift.resume_cluster(ClusterIdentifier=identifier)['Cluster']
+        start = 'resumed'
+    elif cluster is not None:
+        logging.info(f"Cluster {identifier} already exists")
+        start = 'existing'
+    elif config.get('BOOT', 'LIFECYCLE', fallback='delete') == 'snapshot' and snapshot_exists(clients, snapshot):
+        logging.info(f"Restoring cluster {identifier} from snapshot {snapshot}")
+        cluster = redshift.restore_from_cluster_snapshot(
+            ClusterIdentifier=identifier,
+            SnapshotIdentifier=snapshot,
+            NodeType=config['CLUSTER']['DWH_NODE_TYPE'],
+            NumberOfNodes=int(config['CLUSTER']['DWH_NUM_NODES']),
+            IamRoles=[state['role_arn']])['Cluster']
+        start = 'restored'
+    else:
+        cluster = redshift.create_cluster(
+            ClusterType=config['CLUSTER']['DWH_CLUSTER_TYPE'],
+            NodeType=config['CLUSTER']['DWH_NODE_TYPE'],
+            NumberOfNodes=int(config['CLUSTER']['DWH_NUM_NODES']),
+            DBName=config['CLUSTER']['DB_NAME'],
+            ClusterIdentifier=identifier,
+            MasterUsername=config['CLUSTER']['DB_USER'],
+            MasterUserPassword=config['CLUSTER']['DB_PASSWORD'],
+            IamRoles=[state['role_arn']])['Cluster']
+        start = 'created'
+    return {'vpc_id': cluster['VpcId'], 'start': start}
+
+
+def authorize_ingress(config, clients, state):
+    """Open the database port on the VPC's default security group while the cluster starts"""
+    groups = clients['ec2'].describe_security_groups(
+        Filters=[{'Name': 'vpc-id', 'Values': [state['vpc_id']]},
+                 {'Name': 'group-name', 'Values': ['default']}])['SecurityGroups']
+    port = int(config['CLUSTER']['DB_PORT'])
+    try:
+        clients['ec2'].authorize_security_group_ingress(GroupId=groups[0]['GroupId'],
+                                                        CidrIp='0.0.0.0/0',
+                                                        IpProtocol='tcp',
+                                                        FromPort=port,
+                                                        ToPort=port)
+    except ClientError as e:
+        if _error_code(e) != 'InvalidPermission.Duplicate':
+            raise
+        logging.info(f"Port {port} is already open on {groups[0]['GroupId']}")
+    return {}
+
+
+def wait_for_cluster(config, clients, state):
+    """Block on the cluster_available waiter until the cluster is up or the timeout passes"""
+    identifier = config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
+    delay = config.getint('BOOT', 'WAITER_DELAY', fallback=15)
+    timeout = config.getint('BOOT', 'CLUSTER_TIMEOUT', fallback=1800)
+    clients['redshift'].get_waiter('cluster_available').wait(
+        ClusterIdentifier=identifier,
+        WaiterConfig={'Delay': delay, 'MaxAttempts': max(1, timeout // delay)})
+    cluster = describe_cluster(clients, identifier)
+    logging.info(f"Cluster is available. Endpoint: {cluster['Endpoint']['Address']}")
+    return {'host': cluster['Endpoint']['Address']}
+
+
+def test_connection(config, clients, state):
+    """Connect and run a query, retrying with exponential backoff while the endpoint settles"""
+    cluster_config = copy.deepcopy(config)
+    cluster_config['CLUSTER']['HOST'] = state['host']
+    conn = db.connect(cluster_config, retries=config.getint('BOOT', 'CONNECT_RETRIES', fallback=6))
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.fetchall()
+    finally:
+        conn.close()
+    return {}
+
+
+# step name -> (function, [names of steps it depends on]), in the same shape as etl_steps
+provision_steps = {
+    'create_role': (create_role, []),
+    'attach_policy': (attach_policy, ['create_role']),
+    'create_cluster': (create_cluster, ['create_role']),
+    'authorize_ingress': (authorize_ingress, ['create_cluster']),
+    'wait_for_cluster': (wait_for_cluster, ['create_cluster']),
+    'test_connection': (test_connection, ['wait_for_cluster', 'authorize_ingress']),
+}
+
+
+def load_state(path: str):
+    if not os.path.exists(path):
+        return {'done': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: dict):
+    # Write to a temporary file first so an interrupted run never leaves half a state file
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def provision(config, clients, state_path: str, steps: dict = None):
+    """Run the provisioning steps concurrently, skipping the ones a previous run finished
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        clients (dict):                     'iam', 'redshift' and 'ec2' boto3 clients
+        state_path (str):                   JSON file recording finished steps and their outputs
+        steps (dict):                       step name -> (function, deps), provision_steps by default
+
+    Returns:
+        dict of the values the steps found: role_arn, vpc_id, start and host
+
+    """
+    steps = steps or provision_steps
+    topological_order(steps)
+    state = load_state(state_path)
+
+    done = set(state['done'])
+    pending = {name: step for name, step in steps.items() if name not in done}
+    running = {}
+    started = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        while pending or running:
+            if error is None:
+                ready = [name for name, (_, deps) in pending.items() if done.issuperset(deps)]
+                for name in ready:
+                    function, _ = pending.pop(name)
+                    logging.info(f"Starting provisioning step {name}")
+                    started[name] = time.perf_counter()
+                    running[executor.submit(function, config, clients, dict(state))] = name
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    logging.error(f"Provisioning step {name} failed: {e}")
+                    if error is None:
+                        error = e
+                    continue
+                state.update(outputs)
+                state['done'] = sorted(done | {name})
+                save_state(state_path, state)
+                done.add(name)
+                logging.info(f"Finished provisioning step {name} in {time.perf_counter() - started[name]:.1f}s")
+    if error is not None:
+        raise error
+    return {k: v for k, v in state.items() if k != 'done'}
+
+
+def save_config(config_file: str, values: dict):
+    """Write the cluster endpoint and role ARN into dwh.cfg for create_tables.py and etl.py
+
+    Only the HOST and ARN lines are rewritten, the rest of the file is left as it is.
+
+    Args:
+        config_file (str): Path to dwh.cfg
+        values (dict):     Values returned by provision
+
+    """
+    updates = {'CLUSTER': ('HOST', values['host']), 'IAM_ROLE': ('ARN', values['role_arn'])}
+    with open(config_file) as f:
+        lines = f.read().split('\n')
+    section = None
+    for i, line in enumerate(lines):
+        if line.startswith('['):
+            section = line.strip('[] ')
+        elif section in updates and line.split('=')[0].strip().upper() == updates[section][0]:
+            lines[i] = '{}={}'.format(*updates[section])
+    with open(config_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def wait_for_status(clients, identifier: str, status: str, timeout: int = 1800):
+    """Poll the cluster with exponential backoff until it reaches a status boto3 has no waiter for"""
+    delay = 5
+    deadline = time.monotonic() + timeout
+    while describe_cluster(clients, identifier)['ClusterStatus'] != status:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Cluster {identifier} did not become {status} within {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+
+def pause_cluster(config, clients):
+    """Pause the cluster so the next boot.py resumes it with its tables still loaded"""
+    identifier = config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
+    clients['redshift'].pause_cluster(ClusterIdentifier=identifier)
+    wait_for_status(clients, identifier, 'paused', config.getint('BOOT', 'CLUSTER_TIMEOUT', fallback=1800))
+
+
+def delete_cluster(config, clients, snapshot: bool):
+    """Delete the cluster, first taking the snapshot the next boot.py restores when snapshot is set
+
+    A snapshot left by an earlier shutdown under the same name is replaced.
+    """
+    identifier = config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
+    redshift = clients['redshift']
+    if snapshot:
+        snapshot_identifier = config.get('BOOT', 'SNAPSHOT_IDENTIFIER', fallback=f"{identifier}-warm")
+        if snapshot_exists(clients, snapshot_identifier):
+            redshift.delete_cluster_snapshot(SnapshotIdentifier=snapshot_identifier)
+        redshift.delete_cluster(ClusterIdentifier=identifier,
+                                SkipFinalClusterSnapshot=False,
+                                FinalClusterSnapshotIdentifier=snapshot_identifier)
+    else:
+        redshift.delete_cluster(ClusterIdentifier=identifier, SkipFinalClusterSnapshot=True)
+    delay = config.getint('BOOT', 'WAITER_DELAY', fallback=15)
+    timeout = config.getint('BOOT', 'CLUSTER_TIMEOUT', fallback=1800)
+    redshift.get_waiter('cluster_deleted').wait(
+        ClusterIdentifier=identifier,
+        WaiterConfig={'Delay': delay, 'MaxAttempts': max(1, timeout // delay)})
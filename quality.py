@@ -0,0 +1,214 @@
+import logging
+
+import metrics
+from sql_queries import staged_user_id
+
+# Data-quality checks for the star schema, declared per table below. All checks on a
+# table are folded into one aggregate query, so a table is scanned once however many
+# checks it has. The query runs at the end of the DAG step that loads the table, in the
+# step's transaction, so a failed 'error' check rolls the insert back before anyone can
+# read it. The DAG then fails, and etl.py doesn't record the load in load_state or bump
+# the cache generation. 'warn' checks are only logged. Incremental loads only check the
+# rows they merged, see DELTA. A checkpointed load (checkpoint.py) commits its COPY and
+# songplay chunks as it goes, so there only the rows of the last transaction roll back.
+
+
+class DataQualityError(ValueError):
+    """A data-quality check with severity 'error' found more violations than allowed"""
+
+
+def enabled(config):
+    """Return whether loads run the checks, [QUALITY] ENABLED"""
+    return config.getboolean('QUALITY', 'ENABLED', fallback=True)
+
+
+# A check is (name, aggregate expression over t, join it needs, table the join reads)
+def not_null(column: str):
+    return (f"{column}_not_null", f"SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END)", None, None)
+
+
+def unique(column: str):
+    return (f"{column}_unique", f"COUNT(t.{column}) - COUNT(DISTINCT t.{column})", None, None)
+
+
+def references(column: str, table: str, key: str = None):
+    """Rows whose column has no match in table.key, through a LEFT JOIN to its distinct keys"""
+    key = key or column
+    alias = f"ref_{table}"
+    join = f"LEFT JOIN (SELECT DISTINCT {key} FROM {table}) {alias} ON t.{column} = {alias}.{key}"
+    return (f"{column}_in_{table}",
+            f"SUM(CASE WHEN t.{column} IS NOT NULL AND {alias}.{key} IS NULL THEN 1 ELSE 0 END)", join, table)
+
+
+def not_empty():
+    return ('not_empty', "CASE WHEN COUNT(*) = 0 THEN 1 ELSE 0 END", None, None)
+
+
+# table -> (step name prefix, [(check, max violations, severity)])
+# The step loading a table is '<prefix>_insert' on a full load and '<prefix>_merge' incrementally.
+CHECKS = {
+    'songplay': ('songplay_table', [
+        (not_empty(), 0, 'error'),
+        (not_null('start_time'), 0, 'error'),
+        (not_null('user_id'), 0, 'error'),
+        (not_null('song_id'), 0, 'error'),
+        (not_null('artist_id'), 0, 'error'),
+        (unique('songplay_id'), 0, 'error'),
+        (references('song_id', 'song'), 0, 'error'),
+        (references('artist_id', 'artist'), 0, 'error'),
+        (references('user_id', 'users'), 0, 'error'),
+        (references('start_time', 'time'), 0, 'error'),
+    ]),
+    'users': ('user_table', [
+        (not_null('user_id'), 0, 'error'),
+        (unique('user_id'), 0, 'error'),
+        (not_null('level'), 0, 'warn'),
+    ]),
+    'song': ('song_table', [
+        (not_null('song_id'), 0, 'error'),
+        (unique('song_id'), 0, 'error'),
+        (references('artist_id', 'artist'), 0, 'error'),
+    ]),
+    'artist': ('artist_table', [
+        (not_null('artist_id'), 0, 'error'),
+        (unique('artist_id'), 0, 'error'),
+        (not_null('name'), 0, 'warn'),
+    ]),
+    'time': ('time_table', [
+        (not_null('start_time'), 0, 'error'),
+        (unique('start_time'), 0, 'error'),
+        (not_null('hour'), 0, 'error'),
+    ]),
+}
+
+
+# table -> condition on t limiting the checks to the rows an incremental merge touched:
+# songplay and time in the start_time range of songplay_delta, which the sort key on
+# start_time prunes to, and the dimensions to the keys in the staging tables.
+_DELTA_RANGE = ("t.start_time BETWEEN (SELECT MIN(start_time) FROM songplay_delta) "
+                "AND (SELECT MAX(start_time) FROM songplay_delta)")
+DELTA = {
+    'songplay': _DELTA_RANGE,
+    'users': f"t.user_id IN (SELECT {staged_user_id.format(alias='')} FROM staging_events)",
+    'song': "t.song_id IN (SELECT song_id FROM staging_songs)",
+    'artist': "t.artist_id IN (SELECT artist_id FROM staging_songs)",
+    'time': _DELTA_RANGE,
+}
+
+
+def check_query(table: str, scope: str = None, names: list = None):
+    """The one aggregate query computing every check on a table
+
+    Args:
+        table (str):  Key of CHECKS
+        scope (str):  Condition on t limiting the rows checked, such as DELTA[table]. A run
+                      may add no rows, so not_empty is left out of a scoped query
+        names (list): Only compute these checks, every check by default
+
+    Returns:
+        (query, list of (check name, max violations, severity) in the order of its columns)
+
+    """
+    _, checks = CHECKS[table]
+    if names is not None:
+        checks = [check for check in checks if check[0][0] in names]
+    if scope:
+        checks = [check for check in checks if check[0][0] != 'not_empty']
+    joins = []
+    columns = []
+    for (name, expression, join, _), _, _ in checks:
+        if join and join not in joins:
+            joins.append(join)
+        columns.append(f"{expression} AS {name}")
+    query = "SELECT\n    {}\nFROM {} t\n{}".format(',\n    '.join(columns), table, '\n'.join(joins))
+    if scope:
+        query = query.rstrip() + f"\nWHERE {scope}"
+    return query, [(name, allowed, severity) for (name, _, _, _), allowed, severity in checks]
+
+
+def run_checks(cur, table: str, stage: str = None, scope: str = None, names: list = None):
+    """Run a table's checks, raising DataQualityError if an 'error' check fails
+
+    Args:
+        cur (psycopg2.extensions.cursor): Postgres cursor
+        table (str):                      Key of CHECKS
+        stage (str):                      Stage the query and results are recorded under
+        scope (str):                      Condition limiting the rows checked, see check_query()
+        names (list):                     Only run these checks, every check by default
+
+    Returns:
+        dict of check name -> violations
+
+    """
+    stage = stage or f"quality_{table}"
+    query, checks = check_query(table, scope, names)
+    metrics.execute(cur, query, stage)
+    results = dict(zip([name for name, _, _ in checks], (int(v or 0) for v in cur.fetchone())))
+    failed = []
+    for name, allowed, severity in checks:
+        passed = results[name] <= allowed
+        metrics.emit({'stage': stage, 'check': f"{table}.{name}", 'violations': results[name],
+                      'status': 'ok' if passed else severity})
+        if passed:
+            continue
+        message = f"{table}.{name}: {results[name]} violations, {allowed} allowed"
+        if severity == 'error':
+            failed.append(message)
+        logging.warning(f"Data-quality check failed: {message}")
+    if failed:
+        raise DataQualityError('Data-quality checks failed:\n' + '\n'.join(failed))
+    return results
+
+
+def _upstream(steps: dict, step: str):
+    """Names of every step that step depends on, directly or not"""
+    seen = set()
+    pending = list(steps[step][1])
+    while pending:
+        dep = pending.pop()
+        if dep not in seen:
+            seen.add(dep)
+            pending += steps[dep][1]
+    return seen
+
+
+def with_checks(steps: dict, incremental: bool = False):
+    """Run each checked table's checks at the end of the step loading it, in its transaction
+
+    A check referencing another table runs in whichever of the two steps commits last. When
+    neither depends on the other, the step loading the checked table waits for the other one,
+    e.g. songplay_table_insert for the dimension inserts, and runs it there.
+
+    Args:
+        steps (dict):       step name -> (query, [names of steps it depends on])
+        incremental (bool): The steps are incremental merges rather than full inserts,
+                            only the rows they merged are checked
+
+    """
+    suffix = 'merge' if incremental else 'insert'
+    steps = {name: ([query] if isinstance(query, str) else list(query), list(deps))
+             for name, (query, deps) in steps.items()}
+    # step -> [(table, names of its checks run there)], in the order they are added
+    placed = {}
+    for table, (prefix, checks) in CHECKS.items():
+        step = f"{prefix}_{suffix}"
+        if step not in steps:
+            continue
+        names = {step: []}
+        for (name, _, _, referenced), _, _ in checks:
+            target = step
+            if referenced in CHECKS and f"{CHECKS[referenced][0]}_{suffix}" in steps:
+                other = f"{CHECKS[referenced][0]}_{suffix}"
+                if step in _upstream(steps, other):
+                    target = other
+                elif other not in steps[step][1]:
+                    steps[step][1].append(other)
+            names.setdefault(target, []).append(name)
+        for target, target_names in names.items():
+            placed.setdefault(target, []).append((table, target_names))
+    scopes = DELTA if incremental else {}
+    for step, tables in placed.items():
+        for table, names in tables:
+            steps[step][0].append(lambda cur, table=table, names=names:
+                                  run_checks(cur, table, scope=scopes.get(table), names=names))
+    return steps
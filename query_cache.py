@@ -0,0 +1,226 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from botocore.exceptions import ClientError
+
+import db
+import storage
+
+# Cache analytic query results so dashboards repeating the same queries don't wake the
+# cluster. Results are keyed on the normalized SQL plus the load generation of every
+# table it reads. etl.py bumps the '*' generation after each load that changed data and
+# invalidate() bumps a single table, so stale entries are never looked up again; their
+# files are deleted by bump_generation() and by a QueryCache that sees the bump.
+# Generations live in [S3] MY_BUCKET/cache/generations.json, shared by every machine, so
+# [CACHE] ENABLED needs MY_BUCKET. Meant for small aggregate results: a miss fetches the
+# whole result.
+
+ALL_TABLES = '*'
+
+_COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_TABLE = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_][\w.]*)', re.I)
+
+
+def enabled(config):
+    """Return whether results are cached and loads bump the generation, [CACHE] ENABLED"""
+    return config.getboolean('CACHE', 'ENABLED', fallback=False)
+
+
+def normalize(query: str):
+    """Drop comments, collapse whitespace and the trailing semicolon"""
+    return ' '.join(_COMMENT.sub(' ', query).split()).rstrip(';').strip()
+
+
+def tables(query: str):
+    """Tables a query reads from, by name after FROM and JOIN"""
+    return sorted({t.lower() for t in _TABLE.findall(_COMMENT.sub(' ', query))})
+
+
+def _generations_uri(config):
+    bucket, _ = storage.parse_s3_uri(config['S3']['MY_BUCKET'])
+    return f"s3://{bucket}/cache/generations.json"
+
+
+def read_generations(config):
+    """Return the load generation of every table that has been bumped
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    try:
+        return json.loads(storage.get_object(config, _generations_uri(config)))
+    except FileNotFoundError:
+        return {}
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+        return {}
+
+
+def bump_generation(config, tables: list = None):
+    """Advance the load generation, of the given tables or of all of them
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        tables (list):                      Table names, every table when None
+
+    """
+    generations = read_generations(config)
+    for table in tables or [ALL_TABLES]:
+        generations[table.lower()] = generations.get(table.lower(), 0) + 1
+    storage.put_object(config, _generations_uri(config), json.dumps(generations).encode())
+    logging.info(f"Bumped load generation of {', '.join(tables or [ALL_TABLES])}")
+    QueryCache(config).evict_stale(generations)
+
+
+def invalidate(config, table: str):
+    """Make every cached result that read the table stale
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        table (str):                        Table name
+
+    """
+    bump_generation(config, [table])
+
+
+class QueryCache:
+    """Two-tier result cache: an in-memory LRU in front of pickled results on disk
+
+    The generations file is re-read at most every [CACHE] GENERATIONS_TTL seconds, so a
+    memory hit costs neither an S3 request nor a cluster query. Each file on disk starts
+    with the generations its result was read at, so evict_stale() finds the stale ones
+    without loading their results.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.directory = config.get('CACHE', 'DIR', fallback='query_cache')
+        self.memory_entries = config.getint('CACHE', 'MEMORY_ENTRIES', fallback=128)
+        self.generations_ttl = config.getfloat('CACHE', 'GENERATIONS_TTL', fallback=5)
+        self._memory = collections.OrderedDict()
+        self._generations = None
+        self._generations_read_at = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def generations(self):
+        if self._generations is None or time.monotonic() - self._generations_read_at > self.generations_ttl:
+            previous = self._generations
+            self._generations = read_generations(self.config)
+            self._generations_read_at = time.monotonic()
+            if previous is not None and previous != self._generations:
+                self.evict_stale(self._generations)
+        return self._generations
+
+    def _versions(self, query: str):
+        """The '*' generation and those of the tables the query reads"""
+        generations = self.generations()
+        return {table: generations.get(table, 0) for table in [ALL_TABLES] + tables(query)}
+
+    def key(self, query: str):
+        """Hash of the normalized SQL and the generations of the tables it reads"""
+        versions = self._versions(query)
+        text = json.dumps([normalize(query), versions.pop(ALL_TABLES), sorted(versions.items())])
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, result):
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, query: str):
+        """Return the cached (columns, rows), or None"""
+        key = self.key(query)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        try:
+            with open(os.path.join(self.directory, f"{key}.pkl"), 'rb') as f:
+                pickle.load(f)
+                result = pickle.load(f)
+        except FileNotFoundError:
+            # Never written, or evicted by another process since
+            return None
+        self._remember(key, result)
+        return result
+
+    def put(self, query: str, result):
+        key = self.key(query)
+        self._remember(key, result)
+        # Write then rename, so a concurrent reader never loads half a file
+        path = os.path.join(self.directory, f"{key}.pkl")
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump(self._versions(query), f)
+            pickle.dump(result, f)
+        os.replace(f"{path}.tmp", path)
+
+    def run(self, query: str):
+        """Return (columns, rows, hit), only borrowing a connection on a miss
+
+        Args:
+            query (str): SELECT query
+
+        """
+        result = self.get(query)
+        if result is not None:
+            return result[0], result[1], True
+        with db.connection(self.config) as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            result = ([c[0] for c in cur.description], cur.fetchall())
+            conn.commit()
+        self.put(query, result)
+        return result[0], result[1], False
+
+    def evict_stale(self, generations: dict):
+        """Delete the files on disk read at an older generation than these
+
+        Args:
+            generations (dict): table -> load generation, as read_generations() returns
+
+        Returns:
+            number of files deleted
+
+        """
+        evicted = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.pkl'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                with open(path, 'rb') as f:
+                    versions = pickle.load(f)
+            except FileNotFoundError:
+                continue
+            except (EOFError, pickle.UnpicklingError):
+                versions = None
+            # Files written before the generations were stored in them are dropped too
+            if not isinstance(versions, dict) or any(generations.get(table, 0) != generation
+                                                     for table, generation in versions.items()):
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+        if evicted:
+            logging.info(f"Evicted {evicted} stale cached results from {self.directory}")
+        return evicted
+
+    def clear(self):
+        """Drop every cached result, in memory and on disk"""
+        with self._lock:
+            self._memory.clear()
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.pkl'):
+                os.remove(os.path.join(self.directory, filename))
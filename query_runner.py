@@ -0,0 +1,152 @@
+import gzip
+import os
+import resource
+import time
+import tracemalloc
+import pandas as pd
+
+import local_backend
+import storage
+
+# Run a query without holding the whole result in memory. 'stream' pages rows through a
+# server-side cursor, 'chunks' turns each page into a DataFrame and 'unload' has the
+# database write the result to files (UNLOAD on Redshift, COPY TO on the local backend).
+# Every mode reports rows/sec and peak memory.
+
+MODES = ('fetchall', 'stream', 'chunks', 'unload')
+
+
+def iter_dataframes(conn, query: str, chunk_rows: int = 10000, name: str = 'query_runner'):
+    """Yield the result as DataFrames of at most chunk_rows rows
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        query (str):                           SELECT query
+        chunk_rows (int):                      Rows per DataFrame
+        name (str):                            Cursor name
+
+    """
+    cur = conn.cursor(name=name)
+    try:
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield pd.DataFrame(rows, columns=[c[0] for c in cur.description])
+    finally:
+        cur.close()
+        conn.commit()
+
+
+def unload(conn, config, query: str, name: str):
+    """Write the result to files under [S3] MY_BUCKET/unload/<name>/ instead of fetching it
+
+    Redshift UNLOADs gzipped CSV in parallel, one or more files per slice. The local
+    backend writes a single gzipped CSV into the directory standing in for S3.
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        config (configparser.ConfigParser):    Parsed dwh.cfg
+        query (str):                           SELECT query
+        name (str):                            Name of the directory the files go to
+
+    Returns:
+        (S3 prefix the files were written under, rows written)
+
+    """
+    bucket, _ = storage.parse_s3_uri(config['S3']['MY_BUCKET'])
+    prefix = f"s3://{bucket}/unload/{name}/"
+    # Both UNLOAD and COPY wrap the query, so it can't end in a semicolon, and Redshift
+    # only takes a LIMIT, as query1 has, inside a subquery
+    query = f"SELECT * FROM ({query.strip().rstrip(';')}) unloaded"
+    cur = conn.cursor()
+    if local_backend.enabled(config):
+        path = storage.local_path(storage.local_root(config), f"{prefix}0000_part_00.gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt', newline='') as f:
+            cur.copy_expert(f"COPY ({local_backend.translate(query)}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        rows = cur.rowcount
+    else:
+        cur.execute(f"""
+            UNLOAD ('{query.replace("'", "''")}')
+            TO '{prefix}'
+            IAM_ROLE '{config['IAM_ROLE']['ARN']}'
+            CSV HEADER GZIP ALLOWOVERWRITE PARALLEL ON
+        """)
+        cur.execute("SELECT pg_last_unload_count()")
+        rows = cur.fetchone()[0]
+    conn.commit()
+    return prefix, rows
+
+
+def run_query(conn, query: str, mode: str = 'stream', chunk_rows: int = 10000, preview: int = 5,
+              config=None, name: str = 'query'):
+    """Run a query in one of MODES and measure it
+
+    'fetchall' is the old behaviour and holds the whole result, the other modes only hold
+    one chunk at a time.
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        query (str):                           SELECT query
+        mode (str):                            One of MODES
+        chunk_rows (int):                      Rows per round trip or DataFrame
+        preview (int):                         Leading rows to keep and return
+        config (configparser.ConfigParser):    Parsed dwh.cfg, needed for 'unload'
+        name (str):                            Query name, used for the unload directory
+
+    Returns:
+        (DataFrame of the first preview rows, or None for 'unload', dict of stats)
+
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    stats = {'mode': mode}
+    head = None
+    start = time.perf_counter()
+    try:
+        if mode == 'fetchall':
+            cur = conn.cursor()
+            cur.execute(query)
+            df = pd.DataFrame(cur.fetchall(), columns=[c[0] for c in cur.description])
+            conn.commit()
+            rows, head = len(df), df.head(preview)
+        elif mode == 'stream':
+            # A named cursor keeps the result on the server, iterating fetches itersize rows at a time
+            cur = conn.cursor(name=f"{name}_stream")
+            cur.itersize = chunk_rows
+            cur.execute(query)
+            rows, kept = 0, []
+            for row in cur:
+                if rows < preview:
+                    kept.append(row)
+                rows += 1
+            head = pd.DataFrame(kept, columns=[c[0] for c in cur.description])
+            cur.close()
+            conn.commit()
+        elif mode == 'chunks':
+            rows = 0
+            for df in iter_dataframes(conn, query, chunk_rows, f"{name}_chunks"):
+                if head is None:
+                    head = df.head(preview)
+                rows += len(df)
+        else:
+            stats['location'], rows = unload(conn, config, query, name)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    stats.update({'rows': rows,
+                  'seconds': round(seconds, 4),
+                  'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+                  'peak_python_mb': round(peak / 2 ** 20, 2),
+                  # Process-wide high-water mark, includes libpq's result buffers (KB on Linux)
+                  'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)})
+    return head, stats
@@ -0,0 +1,65 @@
+import re
+
+from query_cache import normalize
+from sql_queries import query1, query1_rollup
+
+# Route analytic queries over songplay to the rollup tables the ETL maintains (see
+# rollup_keys in sql_queries.py). Every path that loads songplay keeps them current:
+# etl.py's full and incremental loads, etl_insert_tables.py and stream_etl.py --load.
+# Only shapes the rollups answer exactly are rewritten, anything else is returned unchanged.
+
+# Known analytic queries and their rollup equivalents, matched on normalized SQL
+_EQUIVALENTS = {normalize(query1).lower(): query1_rollup}
+
+# Grouping expression over songplay -> (rollup table, the same expression over the rollup)
+_GROUPINGS = {
+    'song_id': ('songplay_by_song', 'song_id'),
+    'artist_id': ('songplay_by_artist', 'artist_id'),
+    'level': ('songplay_by_hour', 'level'),
+    "date_trunc('hour', start_time)": ('songplay_by_hour', 'start_hour'),
+    'extract(hour from start_time)': ('songplay_by_hour', 'EXTRACT(hour FROM start_hour)'),
+}
+
+_COUNT_SONGPLAY = re.compile(r'\(\s*SELECT\s+COUNT\(\s*\*\s*\)\s+FROM\s+songplay\s*\)', re.I)
+_GROUP_COUNT = re.compile(
+    r'^SELECT\s+(?P<key>.+?)(?:\s+AS\s+(?P<key_alias>\w+))?\s*,\s*COUNT\(\s*\*\s*\)(?:\s+AS\s+(?P<alias>\w+))?'
+    r'\s+FROM\s+songplay\s+GROUP\s+BY\s+(?P<group>.+?)'
+    r'(?P<rest>\s+ORDER\s+BY\s+.+?)?(?P<limit>\s+LIMIT\s+\d+)?$', re.I)
+
+
+def _rewrite_group_count(query: str):
+    """SELECT <key>, COUNT(*) FROM songplay GROUP BY <key> [ORDER BY ...] [LIMIT n]"""
+    match = _GROUP_COUNT.match(query)
+    if match is None:
+        return None
+    key = match.group('key').lower()
+    if key not in _GROUPINGS or match.group('group').lower() not in (key, '1'):
+        return None
+    table, expression = _GROUPINGS[key]
+    key_alias = match.group('key_alias') or (key if re.fullmatch(r'\w+', key) else None)
+    select_key = f"{expression} AS {key_alias}" if key_alias else expression
+    alias = match.group('alias') or 'count'
+    rest = match.group('rest') or ''
+    rest = re.sub(r'COUNT\(\s*\*\s*\)', 'SUM(plays)', rest, flags=re.I)
+    rest = re.sub(re.escape(match.group('key')), expression, rest, flags=re.I)
+    return (f"SELECT {select_key}, SUM(plays) AS {alias} FROM {table} "
+            f"GROUP BY {expression}{rest}{match.group('limit') or ''}")
+
+
+def rewrite(query: str):
+    """Return an equivalent query reading the rollups, or the query unchanged
+
+    Args:
+        query (str): Analytic query
+
+    """
+    normalized = normalize(query)
+    if normalized.lower() in _EQUIVALENTS:
+        return _EQUIVALENTS[normalized.lower()]
+    grouped = _rewrite_group_count(normalized)
+    if grouped is not None:
+        return grouped
+    if _COUNT_SONGPLAY.search(normalized):
+        # Every songplay row is counted once per artist
+        return _COUNT_SONGPLAY.sub('(SELECT COALESCE(SUM(plays), 0) FROM songplay_by_artist)', normalized)
+    return query
@@ -1,23 +1,11 @@
 # Shutdown cluster and clean up
-import pandas as pd
 import configparser
-import boto3
+import datetime
 import logging
+import os
 import sys
-from time import sleep
 
-
-def to_df(properties):
-    """Formats properties into a DataFrame.
-
-    Args:
-        properties: the results from a redshift.describe_cluster AWS API call
-
-    """
-    keysToShow = ['ClusterIdentifier', 'NodeType', 'ClusterStatus', 'MasterUsername', 'DBName', 'Endpoint', 
-                  'NumberOfNodes', 'VpcId']
-    x = [(k, v) for k,v in properties.items() if k in keysToShow]
-    return pd.DataFrame(data=x, columns=["Key", "Value"])
+import provisioning
 
 # Setup Logging
 logging.basicConfig(#filename='data_warehouse.log', 
@@ -27,6 +15,7 @@ logging.basicConfig(#filename='data_warehouse.log',
                     handlers=[logging.FileHandler('data_warehouse.log'),
                               logging.StreamHandler(sys.stdout)]
                     )
+start_time = datetime.datetime.now()
 
 # Grab our configurations
 config_file='dwh.cfg'
@@ -34,63 +23,57 @@ config=configparser.ConfigParser()
 config.read(config_file)
 
 # Initialize AWS Resources
-# ec2 = boto3.resource('ec2',
-#                      region_name=config['AWS']['REGION'],
-#                      aws_access_key_id=config['AWS']['KEY'],
-#                      aws_secret_access_key=config['AWS']['secret'])
-# s3 = boto3.resource('s3',
-#                     region_name=config['AWS']['REGION'],
-#                     aws_access_key_id=config['AWS']['KEY'],
-#                     aws_secret_access_key=config['AWS']['SECRET'])
-iam = boto3.client('iam',
-                    region_name=config['AWS']['REGION'],
-                    aws_access_key_id=config['AWS']['KEY'],
-                    aws_secret_access_key=config['AWS']['SECRET'])
-redshift = boto3.client('redshift',
-                    region_name=config['AWS']['REGION'],
-                    aws_access_key_id=config['AWS']['KEY'],
-                    aws_secret_access_key=config['AWS']['SECRET'])
+clients = provisioning.aws_clients(config)
+iam = clients['iam']
+
+# [BOOT] LIFECYCLE picks what happens to the cluster:
+#   delete   -- delete it without a snapshot, the next boot.py starts from scratch
+#   snapshot -- delete it after a final snapshot, the next boot.py restores that snapshot
+#   pause    -- pause it, the next boot.py resumes it
+lifecycle = config.get('BOOT', 'LIFECYCLE', fallback='delete')
+if '--lifecycle' in sys.argv:
+    lifecycle = sys.argv[sys.argv.index('--lifecycle') + 1]
 
 # Shutdown Cluster
-logging.info('Starting Shutdown Process')
+logging.info(f'Starting Shutdown Process ({lifecycle})')
+phase_start = datetime.datetime.now()
 try:
-    redshift.delete_cluster(ClusterIdentifier=config['CLUSTER']['DWH_CLUSTER_IDENTIFIER'], 
-                            SkipFinalClusterSnapshot=True)
-    deleted_cluster_props = redshift.describe_clusters(ClusterIdentifier=config['CLUSTER']['DWH_CLUSTER_IDENTIFIER'])['Clusters'][0]
-    to_df(deleted_cluster_props)
+    if lifecycle == 'pause':
+        provisioning.pause_cluster(config, clients)
+        logging.info(f"Cluster paused in {datetime.datetime.now()-phase_start}")
+    else:
+        provisioning.delete_cluster(config, clients, snapshot=lifecycle == 'snapshot')
+        logging.info(f"Cluster has finished deletion in {datetime.datetime.now()-phase_start}")
 except Exception as e:
     logging.error(e)
 
-# Wait for Cluster to be deleted
-logging.info("Waiting for Cluster to be Deleted")
-n_count = 0
-try:
-    while True:
-        cluster_props = redshift.describe_clusters(ClusterIdentifier=config['CLUSTER']['DWH_CLUSTER_IDENTIFIER'])['Clusters'][0]
-        _df = to_df(cluster_props)
-        done = _df[_df['Key']=='ClusterStatus']['Value'].values[0]
-        if done == 'deleting':
-            n_count += 1
-            sys.stdout.write(f'\rProgress: {"="*n_count}')
-            sys.stdout.flush()
-        sleep(3)
-except Exception as e:
-    logging.error(e)
-logging.info("Cluster has finished deletion")
+# A paused cluster still uses the role, a snapshot restore can create it again
+if lifecycle != 'pause':
+    # Detach Policy
+    logging.info("Detach Policy")
+    try:
+        iam.detach_role_policy(RoleName=config['CLUSTER']['DWH_IAM_ROLE_NAME'],
+                               PolicyArn=provisioning.S3_READ_ONLY_POLICY)
+    except Exception as e:
+        logging.error(e)
+    try:
+        iam.delete_role_policy(RoleName=config['CLUSTER']['DWH_IAM_ROLE_NAME'],
+                               PolicyName=provisioning.UNLOAD_POLICY_NAME)
+    except iam.exceptions.NoSuchEntityException:
+        pass
+    except Exception as e:
+        logging.error(e)
+    logging.info("IAM role policy detached")
 
-# Detach Policy
-logging.info("Detach Policy")
-try:
-    iam.detach_role_policy(RoleName=config['CLUSTER']['DWH_IAM_ROLE_NAME'],
-                           PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-except Exception as e:
-    logging.error(e)
-logging.info("IAM role policy detached")
+    # Delete Role
+    logging.info("Delete Role")
+    try:
+        iam.delete_role(RoleName=config['CLUSTER']['DWH_IAM_ROLE_NAME'])
+    except Exception as e:
+        logging.error(e)
 
-# Delete Role
-logging.info("Delete Role")
-try:
-    iam.delete_role(RoleName=config['CLUSTER']['DWH_IAM_ROLE_NAME'])
-except Exception as e:
-    logging.error(e)
-logging.info("Shutdown Completed")
+# The next boot.py has to provision again, resuming or restoring when it can
+state_file = config.get('BOOT', 'STATE_FILE', fallback='boot_state.json')
+if os.path.exists(state_file):
+    os.remove(state_file)
+logging.info(f"Shutdown Completed. Total Elapsed Time: {datetime.datetime.now()-start_time}")
@@ -1,5 +1,7 @@
 import configparser
 
+import staging_schema
+
 
 # CONFIG
 config = configparser.ConfigParser()
@@ -11,57 +13,33 @@ staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
 songplay_table_drop = "DROP TABLE IF EXISTS songplay"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS song"
+song_match_table_drop = "DROP TABLE IF EXISTS song_match"
 artist_table_drop = "DROP TABLE IF EXISTS artist"
 time_table_drop = "DROP TABLE IF EXISTS time"
+user_history_table_drop = "DROP TABLE IF EXISTS users_history"
+songplay_delta_table_drop = "DROP TABLE IF EXISTS songplay_delta"
+songplay_by_song_table_drop = "DROP TABLE IF EXISTS songplay_by_song"
+songplay_by_artist_table_drop = "DROP TABLE IF EXISTS songplay_by_artist"
+songplay_by_hour_table_drop = "DROP TABLE IF EXISTS songplay_by_hour"
+load_checkpoint_table_drop = "DROP TABLE IF EXISTS load_checkpoint"
 
 # CREATE TABLES
-staging_events_table_create= ("""
-CREATE TABLE staging_events (
-    artist text,
-    auth varchar,                --text
-    firstName varchar,           --text
-    gender varchar,
-    itemInSession varchar,
-    lastName varchar,            --text
-    length varchar,              --float
-    level varchar,               --text
-    location varchar,            --text
-    method varchar,
-    page varchar,
-    registration varchar,        --int
-    sessionId varchar,           --int
-    song varchar,                --text
-    status varchar,
-    ts varchar NOT NULL  SORTKEY  DISTKEY,
-    userAgent varchar,
-    userId varchar            --int, but there are actually nulls here
-)
-""")
+# ts is converted from epoch milliseconds by COPY's TIMEFORMAT. Values that fail to convert
+# are written to load_rejects instead of aborting the COPY.
+# The staging tables are generated with their jsonpaths files, see staging_schema.py.
+staging_events_table_create = staging_schema.create_table_query('staging_events')
 
-staging_songs_table_create = ("""
-CREATE TABLE staging_songs (
-    artist_id varchar NOT NULL SORTKEY DISTKEY,
-    artist_latitude float,    
-    artist_location text,
-    artist_longitude float, 
-    artist_name text,
-    duration float,           
-    num_songs int,       
-    song_id varchar NOT NULL, 
-    title text,
-    year int             
-)
-""")
+staging_songs_table_create = staging_schema.create_table_query('staging_songs')
 
 songplay_table_create = ("""
 CREATE TABLE songplay (
     songplay_id int IDENTITY(0,1) SORTKEY,
     start_time timestamp NOT NULL,
-    user_id varchar NOT NULL,
+    user_id int NOT NULL,
     level varchar,
     song_id varchar NOT NULL,
     artist_id varchar NOT NULL,
-    session_id varchar NOT NULL,
+    session_id int NOT NULL,
     location text,
     user_agent text
 )
@@ -69,7 +47,7 @@ CREATE TABLE songplay (
 
 user_table_create = ("""
 CREATE TABLE users (
-    user_id varchar NOT NULL SORTKEY,
+    user_id int NOT NULL SORTKEY,
     first_name text,
     last_name text,
     gender text,
@@ -87,6 +65,17 @@ CREATE TABLE song (
 )
 """)
 
+# Lookup from a normalized (artist, title, duration) match key to the song it identifies.
+# It is small enough to copy to every node, so the songplay join never redistributes.
+song_match_table_create = ("""
+CREATE TABLE song_match (
+    match_key char(32) NOT NULL SORTKEY,
+    song_id varchar NOT NULL,
+    artist_id varchar NOT NULL
+)
+DISTSTYLE ALL
+""")
+
 artist_table_create = ("""
 CREATE TABLE artist (
     artist_id varchar NOT NULL SORTKEY,
@@ -109,6 +98,108 @@ CREATE TABLE time (
 )
 """)
 
+# Songplay rows added by the last incremental run, so the rollups can be updated from
+# them alone
+songplay_delta_table_create = ("""
+CREATE TABLE songplay_delta (
+    start_time timestamp NOT NULL,
+    user_id int NOT NULL,
+    level varchar,
+    song_id varchar NOT NULL,
+    artist_id varchar NOT NULL,
+    session_id int NOT NULL,
+    location text,
+    user_agent text
+)
+""")
+
+# Play counts kept next to songplay, so plays per song, artist, hour and level don't
+# rescan the fact table. rollups.py routes matching analytic queries to them.
+songplay_by_song_table_create = ("""
+CREATE TABLE songplay_by_song (
+    song_id varchar NOT NULL SORTKEY,
+    artist_id varchar NOT NULL,
+    plays bigint NOT NULL
+)
+""")
+
+songplay_by_artist_table_create = ("""
+CREATE TABLE songplay_by_artist (
+    artist_id varchar NOT NULL SORTKEY,
+    plays bigint NOT NULL
+)
+DISTSTYLE ALL
+""")
+
+songplay_by_hour_table_create = ("""
+CREATE TABLE songplay_by_hour (
+    start_hour timestamp NOT NULL SORTKEY,
+    level varchar,
+    plays bigint NOT NULL
+)
+DISTSTYLE ALL
+""")
+
+# SCD type-2 history of users: a new row is opened every time a user's level changes
+user_history_table_create = ("""
+CREATE TABLE users_history (
+    user_id int NOT NULL SORTKEY,
+    first_name text,
+    last_name text,
+    gender text,
+    level text,
+    valid_from timestamp NOT NULL,
+    valid_to timestamp,
+    is_current boolean NOT NULL
+)
+""")
+
+load_rejects_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_rejects (
+    table_name varchar NOT NULL,
+    filename varchar(256),
+    line_number bigint,
+    colname varchar(127),
+    type varchar(10),
+    raw_field_value varchar(1024),
+    err_reason varchar(100),
+    rejected_at timestamp NOT NULL SORTKEY
+)
+""")
+
+load_state_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_state (
+    s3_key varchar(1024) NOT NULL SORTKEY,
+    etag varchar(64),
+    size bigint,
+    loaded_at timestamp NOT NULL
+)
+""")
+
+# Chunks of a full load already committed, see checkpoint.py. Dropped with the tables
+# it describes, so a load only resumes onto the staging rows it wrote.
+load_checkpoint_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_checkpoint (
+    run_id varchar(32) NOT NULL,
+    step varchar(64) NOT NULL,
+    chunk int NOT NULL,
+    row_count bigint,
+    detail varchar(1024),
+    finished_at timestamp NOT NULL SORTKEY
+)
+""")
+
+load_quarantine_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_quarantine (
+    run_id varchar(32) NOT NULL,
+    step varchar(64) NOT NULL,
+    s3_key varchar(1024) NOT NULL,
+    errors int,
+    reason varchar(1024),
+    quarantined_at timestamp NOT NULL SORTKEY
+)
+""")
+
 # STAGING TABLES
 staging_events_copy = ("""
     COPY staging_events
@@ -116,10 +207,13 @@ staging_events_copy = ("""
     CREDENTIALS 'aws_iam_role={}'
     JSON {}
     region '{}'
+    TIMEFORMAT 'epochmillisecs'
+    MAXERROR {}
 """).format(config.get('S3','LOG_DATA'), 
             config.get('IAM_ROLE', 'ARN'), 
             config.get('S3','LOG_JSONPATH'),
-            config.get('AWS','REGION')
+            config.get('AWS','REGION'),
+            config.getint('ETL', 'COPY_MAXERROR', fallback=1000)
             )
 
 staging_songs_copy = ("""
@@ -128,48 +222,114 @@ staging_songs_copy = ("""
     CREDENTIALS 'aws_iam_role={}'
     JSON {}
     region '{}'
+    MAXERROR {}
 """).format(config.get('S3', 'SONG_DATA'),
             config.get('IAM_ROLE', 'ARN'),
             config.get('S3','SONG_JSONPATH'),
-            config.get('AWS', 'REGION')
+            config.get('AWS', 'REGION'),
+            config.getint('ETL', 'COPY_MAXERROR', fallback=1000)
             )
 
+# Rows skipped by the last COPY in this session are kept in load_rejects
+staging_events_rejects_insert = ("""
+INSERT INTO load_rejects
+    (table_name, filename, line_number, colname, type, raw_field_value, err_reason, rejected_at)
+SELECT
+    'staging_events',
+    TRIM(filename),
+    line_number,
+    TRIM(colname),
+    TRIM(type),
+    TRIM(raw_field_value),
+    TRIM(err_reason),
+    starttime
+FROM stl_load_errors
+WHERE query = pg_last_copy_id()
+""")
+
+staging_songs_rejects_insert = staging_events_rejects_insert.replace("'staging_events'", "'staging_songs'")
+
+# FINAL TABLES
+# MATCH KEYS
+# Events are matched to songs on a hash of the lower-cased, trimmed artist and title plus the
+# duration rounded to MATCH_DURATION_TOLERANCE seconds. FLOOR(x + 0.5) is used rather than
+# ROUND so the key can be reproduced outside the warehouse.
+match_key = ("MD5(LOWER(TRIM({artist})) || '|' || LOWER(TRIM({title})) || '|' || "
+             "CAST(CAST(FLOOR({duration} / %s + 0.5) AS bigint) AS varchar))"
+             % config.getfloat('ETL', 'MATCH_DURATION_TOLERANCE', fallback=1.0))
+
+song_match_insert = ("""
+INSERT INTO song_match
+    (match_key, song_id, artist_id)
+SELECT
+    match_key,
+    song_id,
+    artist_id
+FROM (
+    SELECT
+        {}      AS match_key,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (PARTITION BY {} ORDER BY song_id) AS row_num
+    FROM staging_songs
+) keyed
+WHERE row_num = 1
+  AND match_key IS NOT NULL
+""").format(match_key.format(artist='artist_name', title='title', duration='duration'),
+            match_key.format(artist='artist_name', title='title', duration='duration'))
+
+# userId is staged as text, because logged out events have a blank one. The inserts cast it
+# back, so a blank becomes NULL rather than a COPY reject counted against MAXERROR.
+staged_user_id = "CAST(NULLIF(TRIM({alias}userId), '') AS int)"
+
 # FINAL TABLES
 songplay_table_insert = ("""
 INSERT INTO songplay
 (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
 SELECT
-TIMESTAMP 'epoch' + CAST(ts AS bigint)/1000 * interval '1 second' AS start_time,
-userID          AS user_id,
+ts              AS start_time,
+{}              AS user_id,
 level,
 
-song_id,
-artist_id,
+m.song_id,
+m.artist_id,
 
 sessionId               AS session_id,
 location,
 userAgent                AS user_agent
 FROM staging_events e
-JOIN staging_songs s
-ON (s.duration=e.length 
-    AND s.artist_name=e.artist 
-    AND s.title=e.song)
-WHERE user_ID IS NOT NULL
+JOIN song_match m
+ON m.match_key = {}
+WHERE {} IS NOT NULL
   AND page = 'NextSong'
-""")
+""").format(staged_user_id.format(alias='e.'),
+            match_key.format(artist='e.artist', title='e.song', duration='e.length'),
+            staged_user_id.format(alias='e.'))
 
+# The dimension inserts keep one row per key. Users keep the attributes of their
+# latest event by ts, so a level change replaces the old row instead of adding one.
 user_table_insert = ("""
 INSERT INTO users
     (user_id, first_name, last_name, gender, level)
 SELECT
-    userId              AS user_id,
-    firstName           AS first_name,
-    lastName            AS last_name,
+    user_id,
+    first_name,
+    last_name,
     gender,
     level
-FROM staging_events
-WHERE userId IS NOT NULL
-""")
+FROM (
+    SELECT
+        {user_id}           AS user_id,
+        firstName           AS first_name,
+        lastName            AS last_name,
+        gender,
+        level,
+        ROW_NUMBER() OVER (PARTITION BY {user_id} ORDER BY ts DESC) AS row_num
+    FROM staging_events
+    WHERE {user_id} IS NOT NULL
+) latest
+WHERE row_num = 1
+""").format(user_id=staged_user_id.format(alias=''))
 
 song_table_insert = ("""
 INSERT INTO song
@@ -180,42 +340,466 @@ SELECT
     artist_id,
     year,
     duration
-FROM staging_songs
+FROM (
+    SELECT
+        song_id,
+        title,
+        artist_id,
+        year,
+        duration,
+        ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, duration DESC) AS row_num
+    FROM staging_songs
+) latest
+WHERE row_num = 1
 """)
 
+# Songs by the same artist don't always carry a location, so prefer the most complete row
 artist_table_insert = ("""
 INSERT INTO artist
     (artist_id, name, location, latitude, longitude)
 SELECT
     artist_id,
-    artist_name      AS name,
-    artist_location  AS location,
-    artist_latitude  AS latitude,
-    artist_longitude AS longitude
-FROM staging_songs
+    name,
+    location,
+    latitude,
+    longitude
+FROM (
+    SELECT
+        artist_id,
+        artist_name      AS name,
+        artist_location  AS location,
+        artist_latitude  AS latitude,
+        artist_longitude AS longitude,
+        ROW_NUMBER() OVER (PARTITION BY artist_id
+                           ORDER BY CASE WHEN artist_location IS NULL OR artist_location = '' THEN 1 ELSE 0 END,
+                                    CASE WHEN artist_latitude IS NULL THEN 1 ELSE 0 END,
+                                    year DESC) AS row_num
+    FROM staging_songs
+) latest
+WHERE row_num = 1
 """)
 
+# Only rows where a user's level differs from their previous event open a new version
+user_history_insert = ("""
+INSERT INTO users_history
+    (user_id, first_name, last_name, gender, level, valid_from, valid_to, is_current)
+SELECT
+    user_id,
+    first_name,
+    last_name,
+    gender,
+    level,
+    valid_from,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from)         AS valid_to,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from) IS NULL AS is_current
+FROM (
+    SELECT
+        {user_id}           AS user_id,
+        firstName           AS first_name,
+        lastName            AS last_name,
+        gender,
+        level,
+        ts                  AS valid_from,
+        LAG(level) OVER (PARTITION BY {user_id} ORDER BY ts) AS prev_level
+    FROM staging_events
+    WHERE {user_id} IS NOT NULL
+) changes
+WHERE prev_level IS NULL
+   OR prev_level <> level
+""").format(user_id=staged_user_id.format(alias=''))
+
+# One row per distinct start_time, the EXTRACTs only run once per timestamp
 time_table_insert = ("""
 INSERT INTO time
     (start_time, hour, day, week, month, year, weekday)
 SELECT
-    start_time                         AS start_time,
+    s.start_time                       AS start_time,
     EXTRACT(hour FROM s.start_time)    AS hour,
     EXTRACT(day FROM s.start_time)     AS day,
     EXTRACT(week FROM s.start_time)    AS week,
     EXTRACT(month FROM s.start_time)   AS month,
     EXTRACT(year FROM s.start_time)    AS year,
     EXTRACT(weekday FROM s.start_time) AS weekday
-FROM songplay s
+FROM (
+    SELECT DISTINCT start_time
+    FROM songplay
+) s
 """)
 
+# ROLLUPS
+# rollup table -> [(column, expression over songplay)], the columns its plays are counted by
+rollup_keys = {
+    'songplay_by_song':   [('song_id', 'song_id'), ('artist_id', 'artist_id')],
+    'songplay_by_artist': [('artist_id', 'artist_id')],
+    'songplay_by_hour':   [('start_hour', "DATE_TRUNC('hour', start_time)"), ('level', 'level')],
+}
+
+# Full load: count every songplay row
+rollup_insert = ("""
+INSERT INTO {table}
+    ({columns}, plays)
+SELECT
+    {expressions},
+    COUNT(*)
+FROM songplay
+GROUP BY {expressions}
+""")
+
+# Incremental load: add the counts of the new rows in songplay_delta, then insert the keys
+# the rollup hasn't seen yet. level can be NULL, so keys are compared NULL-safe.
+rollup_merge_update = ("""
+UPDATE {table}
+SET plays = {table}.plays + d.plays
+FROM (
+    SELECT
+        {expressions_as},
+        COUNT(*) AS plays
+    FROM songplay_delta
+    GROUP BY {expressions}
+) d
+WHERE {join}
+""")
+
+rollup_merge_insert = ("""
+INSERT INTO {table}
+    ({columns}, plays)
+SELECT
+    {d_columns},
+    d.plays
+FROM (
+    SELECT
+        {expressions_as},
+        COUNT(*) AS plays
+    FROM songplay_delta
+    GROUP BY {expressions}
+) d
+LEFT JOIN {table} r
+ON {join_r}
+WHERE r.plays IS NULL
+""")
+
+
+def _rollup_query(template: str, table: str):
+    keys = rollup_keys[table]
+    return template.format(
+        table=table,
+        columns=', '.join(c for c, _ in keys),
+        expressions=', '.join(e for _, e in keys),
+        expressions_as=', '.join(f"{e} AS {c}" for c, e in keys),
+        d_columns=', '.join(f"d.{c}" for c, _ in keys),
+        join='\n  AND '.join(f"({table}.{c} = d.{c} OR ({table}.{c} IS NULL AND d.{c} IS NULL))" for c, _ in keys),
+        join_r='\n  AND '.join(f"(r.{c} = d.{c} OR (r.{c} IS NULL AND d.{c} IS NULL))" for c, _ in keys))
+
+
+rollup_table_inserts = [_rollup_query(rollup_insert, table) for table in rollup_keys]
+rollup_table_merges = [_rollup_query(template, table)
+                       for table in rollup_keys
+                       for template in (rollup_merge_update, rollup_merge_insert)]
+
+# The staging tables are reused as delta buffers: they are emptied, filled with only the
+# new S3 objects listed in a COPY manifest, then merged into the star schema.
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+staging_events_manifest_copy = ("""
+    COPY staging_events
+    FROM '{{manifest}}'
+    CREDENTIALS 'aws_iam_role={}'
+    JSON {}
+    region '{}'
+    TIMEFORMAT 'epochmillisecs'
+    MAXERROR {}
+    MANIFEST
+""").format(config.get('IAM_ROLE', 'ARN'),
+            config.get('S3','LOG_JSONPATH'),
+            config.get('AWS','REGION'),
+            config.getint('ETL', 'COPY_MAXERROR', fallback=1000)
+            )
+
+staging_songs_manifest_copy = ("""
+    COPY staging_songs
+    FROM '{{manifest}}'
+    CREDENTIALS 'aws_iam_role={}'
+    JSON {}
+    region '{}'
+    MAXERROR {}
+    MANIFEST
+""").format(config.get('IAM_ROLE', 'ARN'),
+            config.get('S3','SONG_JSONPATH'),
+            config.get('AWS', 'REGION'),
+            config.getint('ETL', 'COPY_MAXERROR', fallback=1000)
+            )
+
+# The same COPY reading the gzipped chunks compaction.py coalesces small objects into
+staging_events_compacted_copy = staging_events_manifest_copy + "    GZIP\n"
+staging_songs_compacted_copy = staging_songs_manifest_copy + "    GZIP\n"
+
+# song_match keeps the keys of every song loaded so far, so new events can match songs
+# loaded by earlier runs.
+song_match_merge = ("""
+INSERT INTO song_match
+    (match_key, song_id, artist_id)
+SELECT
+    n.match_key,
+    n.song_id,
+    n.artist_id
+FROM (
+    SELECT
+        {}      AS match_key,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (PARTITION BY {} ORDER BY song_id) AS row_num
+    FROM staging_songs
+) n
+LEFT JOIN song_match m
+ON m.match_key = n.match_key
+WHERE n.row_num = 1
+  AND n.match_key IS NOT NULL
+  AND m.match_key IS NULL
+""").format(match_key.format(artist='artist_name', title='title', duration='duration'),
+            match_key.format(artist='artist_name', title='title', duration='duration'))
+
+# New songplay rows are collected in songplay_delta first, so the rollups can be updated
+# from them. DELETE rather than TRUNCATE, which would commit the step's transaction.
+songplay_delta_clear = "DELETE FROM songplay_delta"
+
+songplay_delta_insert = ("""
+INSERT INTO songplay_delta
+(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT n.start_time, n.user_id, n.level, n.song_id, n.artist_id, n.session_id, n.location, n.user_agent
+FROM (
+    SELECT
+    e.ts            AS start_time,
+    {}              AS user_id,
+    e.level,
+    m.song_id,
+    m.artist_id,
+    e.sessionId     AS session_id,
+    e.location,
+    e.userAgent     AS user_agent
+    FROM staging_events e
+    JOIN song_match m
+    ON m.match_key = {}
+    WHERE {} IS NOT NULL
+      AND e.page = 'NextSong'
+) n
+LEFT JOIN songplay sp
+ON (sp.start_time=n.start_time
+    AND sp.user_id=n.user_id
+    AND sp.session_id=n.session_id
+    AND sp.song_id=n.song_id)
+WHERE sp.start_time IS NULL
+""").format(staged_user_id.format(alias='e.'),
+            match_key.format(artist='e.artist', title='e.song', duration='e.length'),
+            staged_user_id.format(alias='e.'))
+
+songplay_table_merge = ("""
+INSERT INTO songplay
+(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplay_delta
+""")
+
+user_table_merge_delete = ("""
+DELETE FROM users
+USING staging_events e
+WHERE users.user_id = {}
+""").format(staged_user_id.format(alias='e.'))
+
+song_table_merge_delete = ("""
+DELETE FROM song
+USING staging_songs s
+WHERE song.song_id = s.song_id
+""")
+
+artist_table_merge_delete = ("""
+DELETE FROM artist
+USING staging_songs s
+WHERE artist.artist_id = s.artist_id
+""")
+
+# The current version of each staged user seeds the change detection, so a delta whose
+# first event has the same level as the stored version doesn't open a new one.
+user_history_merge_stage = ("""
+CREATE TEMP TABLE user_level_changes AS
+SELECT
+    user_id,
+    first_name,
+    last_name,
+    gender,
+    level,
+    valid_from
+FROM (
+    SELECT
+        *,
+        LAG(level) OVER (PARTITION BY user_id ORDER BY valid_from) AS prev_level
+    FROM (
+        SELECT h.user_id, h.first_name, h.last_name, h.gender, h.level, h.valid_from
+        FROM users_history h
+        WHERE h.is_current
+          AND h.user_id IN (SELECT {user_id} FROM staging_events)
+        UNION ALL
+        SELECT
+            {user_id},
+            firstName,
+            lastName,
+            gender,
+            level,
+            ts
+        FROM staging_events
+        WHERE {user_id} IS NOT NULL
+    ) versions
+) changes
+WHERE prev_level IS NULL
+   OR prev_level <> level
+""").format(user_id=staged_user_id.format(alias=''))
+
+user_history_merge_delete = ("""
+DELETE FROM users_history
+USING user_level_changes c
+WHERE users_history.user_id = c.user_id
+  AND users_history.is_current
+""")
+
+user_history_merge_insert = ("""
+INSERT INTO users_history
+    (user_id, first_name, last_name, gender, level, valid_from, valid_to, is_current)
+SELECT
+    user_id,
+    first_name,
+    last_name,
+    gender,
+    level,
+    valid_from,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from)         AS valid_to,
+    LEAD(valid_from) OVER (PARTITION BY user_id ORDER BY valid_from) IS NULL AS is_current
+FROM user_level_changes
+""")
+
+user_history_merge_drop = "DROP TABLE user_level_changes"
+
+# Only the timestamps of the rows this run added are checked against time
+time_table_merge = ("""
+INSERT INTO time
+    (start_time, hour, day, week, month, year, weekday)
+SELECT
+    s.start_time                       AS start_time,
+    EXTRACT(hour FROM s.start_time)    AS hour,
+    EXTRACT(day FROM s.start_time)     AS day,
+    EXTRACT(week FROM s.start_time)    AS week,
+    EXTRACT(month FROM s.start_time)   AS month,
+    EXTRACT(year FROM s.start_time)    AS year,
+    EXTRACT(weekday FROM s.start_time) AS weekday
+FROM (
+    SELECT DISTINCT start_time
+    FROM songplay_delta
+) s
+LEFT JOIN time t
+ON t.start_time = s.start_time
+WHERE t.start_time IS NULL
+""")
+
+# ANALYTIC QUERIES
+# Run by test.py and timed by benchmark.py
+query1 = """
+    SELECT
+        DISTINCT sp.song_id AS song_id,
+        name AS artist_name,
+        title AS song_name,
+        count(*) as times_played
+    FROM songplay sp
+    JOIN artist a
+        ON sp.artist_id=a.artist_id
+    LEFT JOIN song s
+        ON sp.song_id=s.song_id
+    GROUP BY sp.song_id, name, title
+    ORDER BY sp.song_id DESC
+    LIMIT 100;
+    """
+
+# query1 answered from songplay_by_song, used by rollups.rewrite
+query1_rollup = """
+    SELECT
+        DISTINCT r.song_id AS song_id,
+        name AS artist_name,
+        title AS song_name,
+        SUM(r.plays) as times_played
+    FROM songplay_by_song r
+    JOIN artist a
+        ON r.artist_id=a.artist_id
+    LEFT JOIN song s
+        ON r.song_id=s.song_id
+    GROUP BY r.song_id, name, title
+    ORDER BY r.song_id DESC
+    LIMIT 100;
+    """
+
+query2 = """SELECT 
+    (SELECT count(*)
+    FROM songplay) AS songplay,
+    (SELECT count(*) 
+    FROM time) AS time,
+    (SELECT count(*)
+    FROM artist) AS artist_,
+    (SELECT count(*)
+    FROM users) AS users_,
+    (SELECT count(*)
+    FROM song) AS song_"""
+
 # QUERY LISTS
 create_table_queries = [staging_events_table_create, staging_songs_table_create, 
                         songplay_table_create, user_table_create, song_table_create, 
-                        artist_table_create, time_table_create]
+                        artist_table_create, time_table_create, load_state_table_create,
+                        user_history_table_create, load_rejects_table_create,
+                        song_match_table_create, songplay_delta_table_create,
+                        songplay_by_song_table_create, songplay_by_artist_table_create,
+                        songplay_by_hour_table_create, load_checkpoint_table_create,
+                        load_quarantine_table_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, 
                       songplay_table_drop, user_table_drop, song_table_drop, 
-                      artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, 
-                        artist_table_insert, time_table_insert]
\ No newline at end of file
+                      artist_table_drop, time_table_drop, user_history_table_drop,
+                      song_match_table_drop, songplay_delta_table_drop,
+                      songplay_by_song_table_drop, songplay_by_artist_table_drop,
+                      songplay_by_hour_table_drop, load_checkpoint_table_drop]
+copy_table_queries = [staging_events_copy, staging_events_rejects_insert,
+                      staging_songs_copy, staging_songs_rejects_insert]
+insert_table_queries = [song_match_insert, songplay_table_insert, user_table_insert, song_table_insert, 
+                        artist_table_insert, time_table_insert] + rollup_table_inserts
+analytic_queries = {'query1': query1, 'query2': query2}
+
+# QUERY DEPENDENCIES
+# Each ETL step is paired with the steps that must finish before it can start.
+# Steps without a dependency between them are run at the same time by dag.py.
+etl_steps = {
+    'staging_events_copy':   ([staging_events_copy, staging_events_rejects_insert], []),
+    'staging_songs_copy':    ([staging_songs_copy, staging_songs_rejects_insert], []),
+    'song_match_insert':     (song_match_insert, ['staging_songs_copy']),
+    'songplay_table_insert': (songplay_table_insert, ['staging_events_copy', 'song_match_insert']),
+    'user_table_insert':     (user_table_insert, ['staging_events_copy']),
+    'song_table_insert':     (song_table_insert, ['staging_songs_copy']),
+    'artist_table_insert':   (artist_table_insert, ['staging_songs_copy']),
+    'time_table_insert':     (time_table_insert, ['songplay_table_insert']),
+    'rollup_insert':         (rollup_table_inserts, ['songplay_table_insert']),
+}
+
+# The COPY steps are filled in by incremental.py once the manifests are written.
+# Each delete runs in the same transaction as the insert that follows it.
+incremental_etl_steps = {
+    'staging_events_copy':   ([staging_events_truncate], []),
+    'staging_songs_copy':    ([staging_songs_truncate], []),
+    'song_match_merge':      (song_match_merge, ['staging_songs_copy']),
+    'songplay_table_merge':  ([songplay_delta_clear, songplay_delta_insert, songplay_table_merge],
+                              ['staging_events_copy', 'song_match_merge']),
+    'user_table_merge':      ([user_table_merge_delete, user_table_insert], ['staging_events_copy']),
+    'song_table_merge':      ([song_table_merge_delete, song_table_insert], ['staging_songs_copy']),
+    'artist_table_merge':    ([artist_table_merge_delete, artist_table_insert], ['staging_songs_copy']),
+    'time_table_merge':      (time_table_merge, ['songplay_table_merge']),
+    'rollup_merge':          (rollup_table_merges, ['songplay_table_merge']),
+}
+
+# Keeping the history of users.level is optional
+if config.getboolean('ETL', 'USERS_SCD2', fallback=False):
+    etl_steps['user_history_insert'] = (user_history_insert, ['staging_events_copy'])
+    incremental_etl_steps['user_history_merge'] = ([user_history_merge_stage, user_history_merge_delete,
+                                                    user_history_merge_insert, user_history_merge_drop],
+                                                   ['staging_events_copy'])
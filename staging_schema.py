@@ -0,0 +1,255 @@
+import argparse
+import collections
+import configparser
+import json
+import logging
+import sys
+from botocore.exceptions import ClientError
+
+import storage
+
+# The staging tables and the jsonpaths files COPY maps JSON into them with are both
+# generated from STAGING_COLUMNS, so a column can't be renamed in one and not the other.
+# Before a load, check() compares the deployed jsonpaths files with the generated ones
+# and samples the incoming JSON for fields that were added, went missing or changed type.
+
+# table -> [(column, type, JSON key, column attributes, comment)], in COPY order
+STAGING_COLUMNS = {
+    'staging_events': [
+        ('artist', 'text', 'artist', '', ''),
+        ('auth', 'varchar', 'auth', '', 'text'),
+        ('firstName', 'varchar', 'firstName', '', 'text'),
+        ('gender', 'varchar', 'gender', '', ''),
+        ('itemInSession', 'int', 'itemInSession', '', ''),
+        ('lastName', 'varchar', 'lastName', '', 'text'),
+        ('length', 'float', 'length', '', ''),
+        ('level', 'varchar', 'level', '', 'text'),
+        ('location', 'varchar', 'location', '', 'text'),
+        ('method', 'varchar', 'method', '', ''),
+        ('page', 'varchar', 'page', '', ''),
+        ('registration', 'float', 'registration', '', 'epoch milliseconds, stored in the logs as 1540344794796.0'),
+        ('sessionId', 'int', 'sessionId', '', ''),
+        ('song', 'varchar', 'song', '', 'text'),
+        ('status', 'varchar', 'status', '', ''),
+        ('ts', 'timestamp', 'ts', 'NOT NULL SORTKEY DISTKEY', ''),
+        ('userAgent', 'varchar', 'userAgent', '', ''),
+        ('userId', 'varchar', 'userId', '', 'blank for logged out users, cast by the inserts'),
+    ],
+    'staging_songs': [
+        ('artist_id', 'varchar', 'artist_id', 'NOT NULL SORTKEY DISTKEY', ''),
+        ('artist_latitude', 'float', 'artist_latitude', '', ''),
+        ('artist_location', 'text', 'artist_location', '', ''),
+        ('artist_longitude', 'float', 'artist_longitude', '', ''),
+        ('artist_name', 'text', 'artist_name', '', ''),
+        ('duration', 'float', 'duration', '', ''),
+        ('num_songs', 'int', 'num_songs', '', ''),
+        ('song_id', 'varchar', 'song_id', 'NOT NULL', ''),
+        ('title', 'text', 'title', '', ''),
+        ('year', 'int', 'year', '', ''),
+    ],
+}
+
+# dwh.cfg [S3] options of each staging table's data prefix and jsonpaths file
+SOURCES = {'staging_events': ('LOG_DATA', 'LOG_JSONPATH'),
+           'staging_songs': ('SONG_DATA', 'SONG_JSONPATH')}
+
+
+class SchemaDriftError(ValueError):
+    """The incoming JSON or a deployed jsonpaths file no longer matches STAGING_COLUMNS"""
+
+
+def create_table_query(table: str):
+    """CREATE TABLE statement for a staging table
+
+    Args:
+        table (str): Key of STAGING_COLUMNS
+
+    """
+    lines = []
+    columns = STAGING_COLUMNS[table]
+    for i, (name, data_type, _, attributes, comment) in enumerate(columns):
+        line = f"    {name} {data_type}{' ' + attributes if attributes else ''}{',' if i < len(columns) - 1 else ''}"
+        lines.append(f"{line:<33}--{comment}" if comment else line)
+    return "\nCREATE TABLE {} (\n{}\n)\n".format(table, '\n'.join(lines))
+
+
+def jsonpaths(table: str):
+    """jsonpaths document mapping the JSON keys onto a staging table's columns, in order
+
+    Args:
+        table (str): Key of STAGING_COLUMNS
+
+    """
+    return {'jsonpaths': [f"$['{key}']" for _, _, key, _, _ in STAGING_COLUMNS[table]]}
+
+
+def _fits(value, data_type: str):
+    """Whether COPY could load a non-null JSON value into a column of the type"""
+    if data_type in ('int', 'float', 'timestamp'):
+        if isinstance(value, bool):
+            return False
+        if isinstance(value, (int, float)):
+            return data_type != 'int' or float(value).is_integer()
+        if isinstance(value, str):
+            try:
+                number = float(value)
+            except ValueError:
+                return False
+            return data_type != 'int' or number.is_integer()
+        return False
+    # Numbers load into character columns as their text, nested objects are a new shape
+    return not isinstance(value, (dict, list))
+
+
+def sample_records(config, objects: list, max_objects: int, max_records: int):
+    """Read up to max_records JSON records from each of max_objects objects spread over the list
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        objects (list):                     Objects returned by storage.list_objects
+        max_objects (int):                  Objects to read
+        max_records (int):                  Records to read per object
+
+    """
+    if not objects:
+        return []
+    # Evenly spaced, always including the last object, which is usually the newest
+    step = max(1, len(objects) // max_objects)
+    picked = objects[::-1][::step][:max_objects]
+    decoder = json.JSONDecoder()
+    records = []
+    for obj in picked:
+        found = []
+        for line in storage.iter_lines(config, obj['url']):
+            text = line.decode('utf-8').strip()
+            # Records may also be concatenated on one line
+            while text and len(found) < max_records:
+                record, end = decoder.raw_decode(text)
+                found.append(record)
+                text = text[end:].strip()
+            if len(found) >= max_records:
+                break
+        records += found
+    return records
+
+
+def detect_drift(table: str, records: list, max_bad_fraction: float = 0.5):
+    """Compare sampled JSON records with a staging table's columns
+
+    Args:
+        table (str):              Key of STAGING_COLUMNS
+        records (list):           Sampled JSON objects
+        max_bad_fraction (float): Share of a column's non-null values that may not fit its type
+
+    Returns:
+        dict with the 'added' fields no column reads, the 'removed' keys no record has and
+        the 'retyped' columns as column -> JSON types seen
+
+    """
+    columns = STAGING_COLUMNS[table]
+    seen = collections.Counter()
+    types = collections.defaultdict(collections.Counter)
+    bad = collections.Counter()
+    for record in records:
+        for key, value in record.items():
+            seen[key] += 1
+            types[key][type(value).__name__] += 1
+        for name, data_type, key, _, _ in columns:
+            value = record.get(key)
+            if value is not None and not _fits(value, data_type):
+                bad[name] += 1
+
+    keys = {key for _, _, key, _, _ in columns}
+    drift = {'added': sorted(k for k in seen if k not in keys),
+             'removed': sorted(k for k in keys if records and not seen[k]),
+             'retyped': {}}
+    for name, data_type, key, _, _ in columns:
+        non_null = seen[key] - types[key]['NoneType']
+        if non_null and bad[name] / non_null > max_bad_fraction:
+            drift['retyped'][name] = f"{data_type} but the JSON has {dict(types[key])}"
+    return drift
+
+
+def deployed_jsonpaths_drift(config, table: str):
+    """Differences between the jsonpaths file COPY reads and the generated one
+
+    Returns:
+        list of messages, empty when they match
+
+    """
+    uri = config['S3'][SOURCES[table][1]]
+    try:
+        deployed = json.loads(storage.get_object(config, uri))['jsonpaths']
+    except FileNotFoundError:
+        return [f"{uri} does not exist"]
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+        return [f"{uri} does not exist"]
+    expected = jsonpaths(table)['jsonpaths']
+    messages = [f"{uri} path {i + 1} is {got}, expected {want}"
+                for i, (got, want) in enumerate(zip(deployed, expected)) if got != want]
+    if len(deployed) != len(expected):
+        messages.append(f"{uri} has {len(deployed)} paths, {table} has {len(expected)} columns")
+    return messages
+
+
+def check(config, objects: dict):
+    """Check the deployed jsonpaths and a sample of the objects about to be copied
+
+    Added fields are only logged, since COPY ignores them. Missing or retyped fields and
+    stale jsonpaths files raise, unless [SCHEMA] FAIL_ON_DRIFT is off.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        objects (dict):                     staging table -> objects about to be copied into it
+
+    Raises:
+        SchemaDriftError: the sample or a jsonpaths file doesn't match STAGING_COLUMNS
+
+    """
+    max_objects = config.getint('SCHEMA', 'SAMPLE_OBJECTS', fallback=20)
+    max_records = config.getint('SCHEMA', 'SAMPLE_RECORDS', fallback=200)
+    max_bad_fraction = config.getfloat('SCHEMA', 'MAX_BAD_FRACTION', fallback=0.5)
+    problems = []
+    for table, table_objects in objects.items():
+        problems += deployed_jsonpaths_drift(config, table)
+        records = sample_records(config, table_objects, max_objects, max_records)
+        drift = detect_drift(table, records, max_bad_fraction)
+        if drift['added']:
+            logging.warning(f"{table}: sampled JSON has fields no column loads: {', '.join(drift['added'])}")
+        problems += [f"{table}: no sampled record has {key}" for key in drift['removed']]
+        problems += [f"{table}: {name} is {found}" for name, found in drift['retyped'].items()]
+        logging.info(f"Checked {len(records)} sampled {table} records against the schema")
+    if problems:
+        message = 'Schema drift before COPY:\n' + '\n'.join(problems)
+        if config.getboolean('SCHEMA', 'FAIL_ON_DRIFT', fallback=True):
+            raise SchemaDriftError(message)
+        logging.warning(message)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate jsonpaths files and check incoming JSON for schema drift')
+    parser.add_argument('--write', action='store_true', help='Write the staging_songs jsonpaths to jsonpaths.json')
+    parser.add_argument('--upload', nargs='+', choices=sorted(STAGING_COLUMNS), default=[],
+                        help="Upload the tables' jsonpaths to the [S3] *_JSONPATH locations")
+    parser.add_argument('--check', action='store_true', help='Sample the S3 data and report drift')
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if args.write:
+        with open('jsonpaths.json', 'w') as f:
+            json.dump(jsonpaths('staging_songs'), f, indent=4)
+            f.write('\n')
+    for table in args.upload:
+        uri = storage.put_object(config, config['S3'][SOURCES[table][1]], json.dumps(jsonpaths(table), indent=4).encode())
+        logging.info(f"Uploaded {table} jsonpaths to {uri}")
+    if args.check:
+        check(config, {table: storage.list_objects(config, config['S3'][prefix])
+                       for table, (prefix, _) in SOURCES.items()})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+import gzip
+import hashlib
+import os
+import boto3
+
+
+def s3_client(config):
+    """Create an S3 client from the [AWS] section of dwh.cfg
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    return boto3.client('s3',
+                        region_name=config['AWS']['REGION'],
+                        aws_access_key_id=config['AWS']['KEY'],
+                        aws_secret_access_key=config['AWS']['SECRET'])
+
+
+def local_root(config):
+    """Return the directory standing in for S3, or None when the real S3 is used
+
+    With [LOCAL] ENABLED each bucket is a directory under DATA_DIR, so
+    s3://udacity-dend/log_data/x.json is read from DATA_DIR/udacity-dend/log_data/x.json.
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+
+    """
+    if config.getboolean('LOCAL', 'ENABLED', fallback=False):
+        return config.get('LOCAL', 'DATA_DIR', fallback='data')
+    return None
+
+
+def parse_s3_uri(uri: str):
+    """Split an S3 URI into bucket and key
+
+    The S3 values in dwh.cfg are quoted so they can be dropped straight into a COPY
+    statement, so surrounding quotes are removed first.
+
+    Args:
+        uri (str): URI such as 's3://udacity-dend/log_data'
+
+    """
+    uri = uri.strip().strip("'\"")
+    if not uri.startswith('s3://'):
+        raise ValueError(f"Not an S3 URI: {uri}")
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def my_bucket(config, needed_by: str):
+    """Return the bucket of [S3] MY_BUCKET, where manifests and intermediate files are written
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        needed_by (str):                    What writes there, for the error message
+
+    Raises:
+        ValueError: MY_BUCKET is empty, as in the shipped dwh.cfg
+
+    """
+    uri = config.get('S3', 'MY_BUCKET', fallback='')
+    if not uri.strip("'\" "):
+        raise ValueError(f"{needed_by} needs [S3] MY_BUCKET set in dwh.cfg, a bucket it can write to")
+    return parse_s3_uri(uri)[0]
+
+
+def local_path(root: str, uri: str):
+    """Map an S3 URI onto a path under the local stand-in directory
+
+    Args:
+        root (str): Local directory standing in for S3
+        uri (str):  S3 URI
+
+    """
+    bucket, key = parse_s3_uri(uri)
+    return os.path.join(root, bucket, *key.split('/'))
+
+
+def _file_etag(path: str):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _list_local(root: str, bucket: str, prefix: str):
+    bucket_dir = os.path.join(root, bucket)
+    # Only walk the directory the prefix points into, S3 prefixes can end mid-name
+    start = os.path.join(bucket_dir, *prefix.split('/')[:-1])
+    objects = []
+    for dirpath, _, filenames in os.walk(start):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            key = os.path.relpath(path, bucket_dir).replace(os.sep, '/')
+            if key.startswith(prefix):
+                objects.append({'url': f"s3://{bucket}/{key}",
+                                'size': os.path.getsize(path),
+                                'etag': _file_etag(path)})
+    return sorted(objects, key=lambda o: o['url'])
+
+
+def list_objects(config, uri: str):
+    """List every object under an S3 prefix
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 prefix URI
+
+    Returns:
+        list of dicts with the object's url, size and etag
+
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    root = local_root(config)
+    if root is not None:
+        return _list_local(root, bucket, prefix)
+
+    paginator = s3_client(config).get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            objects.append({'url': f"s3://{bucket}/{obj['Key']}",
+                            'size': obj['Size'],
+                            'etag': obj['ETag'].strip('"')})
+    return objects
+
+
+def list_level(config, uri: str):
+    """List one level under an S3 prefix, like list_objects_v2 with Delimiter='/'
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 prefix URI
+
+    Returns:
+        (URIs of the sub-prefixes, objects directly under the prefix as list_objects returns them)
+
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    root = local_root(config)
+    prefixes = []
+    objects = []
+    if root is not None:
+        directory, _, start = prefix.rpartition('/')
+        path = os.path.join(root, bucket, *directory.split('/')) if directory else os.path.join(root, bucket)
+        if not os.path.isdir(path):
+            return prefixes, objects
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if not entry.name.startswith(start):
+                continue
+            key = f"{directory}/{entry.name}" if directory else entry.name
+            if entry.is_dir():
+                prefixes.append(f"s3://{bucket}/{key}/")
+            else:
+                objects.append({'url': f"s3://{bucket}/{key}",
+                                'size': entry.stat().st_size,
+                                'etag': _file_etag(entry.path)})
+        return prefixes, objects
+
+    paginator = s3_client(config).get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        prefixes += [f"s3://{bucket}/{p['Prefix']}" for p in page.get('CommonPrefixes', [])]
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            objects.append({'url': f"s3://{bucket}/{obj['Key']}",
+                            'size': obj['Size'],
+                            'etag': obj['ETag'].strip('"')})
+    return prefixes, objects
+
+
+def get_object(config, uri: str):
+    """Read an object's contents
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 URI
+
+    """
+    root = local_root(config)
+    if root is not None:
+        with open(local_path(root, uri), 'rb') as f:
+            return f.read()
+    bucket, key = parse_s3_uri(uri)
+    return s3_client(config).get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def iter_lines(config, uri: str):
+    """Read an object lazily, one line at a time, decompressing .gz objects
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          S3 URI
+
+    """
+    root = local_root(config)
+    if root is not None:
+        f = open(local_path(root, uri), 'rb')
+        lines = f
+    else:
+        bucket, key = parse_s3_uri(uri)
+        f = s3_client(config).get_object(Bucket=bucket, Key=key)['Body']
+        lines = f.iter_lines()
+    if uri.endswith('.gz'):
+        lines = gzip.GzipFile(fileobj=f)
+    try:
+        for line in lines:
+            yield line
+    finally:
+        f.close()
+
+
+def put_object(config, uri: str, body: bytes):
+    """Write an object to S3
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        uri (str):                          Destination S3 URI
+        body (bytes):                       Object contents
+
+    """
+    bucket, key = parse_s3_uri(uri)
+    root = local_root(config)
+    if root is not None:
+        path = local_path(root, uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+    else:
+        s3_client(config).put_object(Bucket=bucket, Key=key, Body=body)
+    return f"s3://{bucket}/{key}"
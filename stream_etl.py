@@ -0,0 +1,330 @@
+import argparse
+import configparser
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sys
+from multiprocessing import Pool
+
+import db
+import incremental
+import local_backend
+import storage
+from sql_queries import rollup_keys, rollup_table_inserts
+
+# Build the star schema without a warehouse COPY: the log and song JSON objects are read
+# line by line and run through the same transformations as the SQL in sql_queries.py.
+# Only the song hash index and the latest row per user are kept in memory; songplay rows
+# and their time rows are written out as soon as they are matched, and load() drops the
+# repeated start times in SQL.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# Written unquoted for NULL so it can't be confused with an empty string
+CSV_NULL = '\\N'
+# Lists the table files the last run() wrote, so load() never picks up older parts, and
+# the objects they were built from, which load() records in load_state
+MANIFEST = 'tables.json'
+_NON_SPACE = re.compile(r'\S')
+
+TABLE_COLUMNS = {
+    'songplay': ['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id', 'location', 'user_agent'],
+    'users': ['user_id', 'first_name', 'last_name', 'gender', 'level'],
+    'song': ['song_id', 'title', 'artist_id', 'year', 'duration'],
+    'artist': ['artist_id', 'name', 'location', 'latitude', 'longitude'],
+    'time': ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+    'song_match': ['match_key', 'song_id', 'artist_id'],
+}
+
+
+def match_key(artist: str, title: str, duration: float, tolerance: float):
+    """Python twin of the match_key SQL in sql_queries.py
+
+    Redshift's TRIM only strips spaces, so only spaces are stripped here too.
+
+    Args:
+        artist (str):      Artist name
+        title (str):       Song title
+        duration (float):  Song length in seconds
+        tolerance (float): Duration rounding in seconds
+
+    """
+    if artist is None or title is None or duration is None:
+        return None
+    rounded = math.floor(float(duration) / tolerance + 0.5)
+    text = f"{artist.strip(' ').lower()}|{title.strip(' ').lower()}|{rounded}"
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def records(config, url: str):
+    """Yield the JSON objects of one S3 object as its lines stream in
+
+    Objects may be one per line, concatenated on a line or spread over several lines,
+    like Redshift's COPY accepts. Only an unfinished object is buffered between lines.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for line in storage.iter_lines(config, url):
+        line = line.decode('utf-8')
+        buffer += line if line.endswith('\n') else line + '\n'
+        pos = 0
+        while True:
+            start = _NON_SPACE.search(buffer, pos)
+            if start is None:
+                buffer = ''
+                break
+            try:
+                record, pos = decoder.raw_decode(buffer, start.start())
+            except json.JSONDecodeError:
+                # Continued on the next line, or malformed, which json.loads raises below
+                buffer = buffer[start.start():]
+                break
+            yield record
+    if buffer.strip():
+        json.loads(buffer)
+
+
+def to_int(value):
+    """Convert like COPY into an int column, returning None for blanks"""
+    if value is None or (isinstance(value, str) and value.strip() == ''):
+        return None
+    return int(float(value))
+
+
+def desc_rank(value):
+    """Sort key ranking values like ORDER BY value DESC, highest first
+
+    Redshift and PostgreSQL sort NULLs first in descending order, so None ranks highest.
+    """
+    return (value is None, value or 0)
+
+
+def build_song_index(config, song_urls: list, tolerance: float):
+    """Stream the song objects into a match key index and the song and artist dimensions
+
+    Mirrors song_match_insert, song_table_insert and artist_table_insert: one song per
+    match key (lowest song_id), the latest year per song_id and the most complete row per
+    artist.
+
+    Returns:
+        (index of match key -> (song_id, artist_id), song rows by id, artist rows by id)
+
+    """
+    index = {}
+    songs = {}
+    artists = {}
+    for url in song_urls:
+        for s in records(config, url):
+            if s.get('song_id') is None or s.get('artist_id') is None:
+                continue
+            key = match_key(s.get('artist_name'), s.get('title'), s.get('duration'), tolerance)
+            if key is not None and (key not in index or s['song_id'] < index[key][0]):
+                index[key] = (s['song_id'], s['artist_id'])
+
+            song = (s['song_id'], s.get('title'), s['artist_id'], to_int(s.get('year')), s.get('duration'))
+            current = songs.get(s['song_id'])
+            if current is None or ((desc_rank(song[3]), desc_rank(song[4])) >
+                                   (desc_rank(current[3]), desc_rank(current[4]))):
+                songs[s['song_id']] = song
+
+            artist = (s['artist_id'], s.get('artist_name'), s.get('artist_location'),
+                      s.get('artist_latitude'), s.get('artist_longitude'))
+            year = desc_rank(to_int(s.get('year')))
+            rank = (not artist[2], artist[3] is None, not year[0], -year[1])
+            current = artists.get(s['artist_id'])
+            if current is None or rank < current[0]:
+                artists[s['artist_id']] = (rank, artist)
+    return index, songs, {artist_id: row for artist_id, (_, row) in artists.items()}
+
+
+def time_row(start_time: datetime.datetime):
+    """Same columns as time_table_insert. Redshift's week is the ISO week and weekday 0 is Sunday."""
+    return (start_time, start_time.hour, start_time.day, start_time.isocalendar()[1],
+            start_time.month, start_time.year, start_time.isoweekday() % 7)
+
+
+def process_events(config, event_urls: list, index: dict, tolerance: float, write_songplay):
+    """Stream log events, writing matched songplay rows as they are found
+
+    Returns:
+        latest user row and ts by user_id
+
+    """
+    users = {}
+    for url in event_urls:
+        for e in records(config, url):
+            user_id = to_int(e.get('userId'))
+            if user_id is None or e.get('ts') is None:
+                continue
+            ts = int(e['ts'])
+            if user_id not in users or ts > users[user_id][0]:
+                users[user_id] = (ts, (user_id, e.get('firstName'), e.get('lastName'), e.get('gender'), e.get('level')))
+
+            if e.get('page') != 'NextSong':
+                continue
+            matched = index.get(match_key(e.get('artist'), e.get('song'), e.get('length'), tolerance))
+            if matched is None:
+                continue
+            start_time = EPOCH + datetime.timedelta(milliseconds=ts)
+            write_songplay((start_time, user_id, e.get('level'), matched[0], matched[1],
+                                      to_int(e.get('sessionId')), e.get('location'), e.get('userAgent')))
+    return users
+
+
+def open_csv(out_dir: str, name: str):
+    """Open a gzipped CSV table file, returning the file and a function writing one row"""
+    f = gzip.open(os.path.join(out_dir, f"{name}.csv.gz"), 'wt', newline='')
+    writer = csv.writer(f)
+
+    def write_row(row):
+        writer.writerow([CSV_NULL if value is None else value for value in row])
+
+    return f, write_row
+
+
+def write_rows(out_dir: str, name: str, rows):
+    f, write_row = open_csv(out_dir, name)
+    with f:
+        for row in rows:
+            write_row(row)
+
+
+def _worker(job):
+    """Process one share of the event files in a separate process"""
+    config_path, event_urls, index, tolerance, out_dir, part = job
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    songplay_file, write_songplay = open_csv(out_dir, f"songplay-part-{part:04d}")
+    time_file, write_time = open_csv(out_dir, f"time-part-{part:04d}")
+
+    def write_row(row):
+        write_songplay(row)
+        # A start time repeats once per songplay at it, load() keeps one
+        write_time(time_row(row[0]))
+
+    with songplay_file, time_file:
+        return process_events(config, event_urls, index, tolerance, write_row)
+
+
+def run(config, out_dir: str, processes: int = 1, config_path: str = 'dwh.cfg'):
+    """Build the star schema from the log and song objects into gzipped CSV files
+
+    Args:
+        config (configparser.ConfigParser): Parsed dwh.cfg
+        out_dir (str):                      Directory the table files are written to
+        processes (int):                    Worker processes the event files are split across
+        config_path (str):                  dwh.cfg path, re-read by worker processes
+
+    Returns:
+        list of table file names written, also listed in MANIFEST
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # Parts of an earlier run with more processes would otherwise sit next to this run's
+    for filename in os.listdir(out_dir):
+        if '-part-' in filename or filename == MANIFEST:
+            os.remove(os.path.join(out_dir, filename))
+    tolerance = config.getfloat('ETL', 'MATCH_DURATION_TOLERANCE', fallback=1.0)
+    song_objects = storage.list_objects(config, config['S3']['SONG_DATA'])
+    event_objects = storage.list_objects(config, config['S3']['LOG_DATA'])
+    song_urls = [o['url'] for o in song_objects]
+    event_urls = [o['url'] for o in event_objects]
+
+    index, songs, artists = build_song_index(config, song_urls, tolerance)
+    logging.info(f"Indexed {len(index)} song match keys from {len(song_urls)} objects")
+
+    if processes > 1:
+        jobs = [(config_path, event_urls[part::processes], index, tolerance, out_dir, part)
+                for part in range(processes)]
+        with Pool(processes) as pool:
+            results = pool.map(_worker, jobs)
+    else:
+        results = [_worker((config_path, event_urls, index, tolerance, out_dir, 0))]
+
+    users = {}
+    for part_users in results:
+        for user_id, (ts, row) in part_users.items():
+            if user_id not in users or ts > users[user_id][0]:
+                users[user_id] = (ts, row)
+
+    write_rows(out_dir, 'users', (row for _, row in users.values()))
+    write_rows(out_dir, 'song', songs.values())
+    write_rows(out_dir, 'artist', artists.values())
+    # Incremental merges match new events against song_match, so it is loaded too
+    write_rows(out_dir, 'song_match', ((key, song_id, artist_id) for key, (song_id, artist_id) in index.items()))
+    logging.info(f"Wrote {len(users)} users, {len(songs)} songs and {len(artists)} artists to {out_dir}")
+    parts = len(results)
+    files = (['users.csv.gz', 'song.csv.gz', 'artist.csv.gz', 'song_match.csv.gz'] +
+             [f"{name}-part-{part:04d}.csv.gz" for name in ('songplay', 'time') for part in range(parts)])
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump({'files': sorted(files), 'objects': song_objects + event_objects}, f)
+    return sorted(files)
+
+
+def load(conn, out_dir: str):
+    """Bulk load the table files into PostgreSQL with COPY FROM STDIN, replacing the tables' rows
+
+    Redshift has no COPY FROM STDIN, so there the files have to be uploaded to S3 and
+    copied with CSV GZIP NULL AS '\\N' instead. The time parts go through a temporary
+    table, so each start time is inserted once. The old rows are deleted in the same
+    transaction, so loading twice doesn't duplicate them and readers never see the tables empty.
+    The rollups are rebuilt and load_state lists the objects read, as after a full etl.py
+    load, so rollups.py answers from current counts and --incremental only adds newer objects.
+
+    Args:
+        conn (psycopg2.extensions.connection): Postgres connection
+        out_dir (str):                         Directory written by run()
+
+    """
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    cur = conn.cursor()
+    for table in list(TABLE_COLUMNS) + list(rollup_keys):
+        cur.execute(f"DELETE FROM {table}")
+    columns = ', '.join(TABLE_COLUMNS['time'])
+    cur.execute(f"CREATE TEMP TABLE time_parts AS SELECT {columns} FROM time WHERE false")
+    for filename in manifest['files']:
+        table = filename.split('.')[0].split('-part-')[0]
+        target = 'time_parts' if table == 'time' else table
+        with gzip.open(os.path.join(out_dir, filename), 'rt') as f:
+            cur.copy_expert(f"COPY {target} ({', '.join(TABLE_COLUMNS[table])}) FROM STDIN "
+                            f"WITH (FORMAT csv, NULL '{CSV_NULL}')", f)
+    cur.execute(f"INSERT INTO time ({columns}) SELECT DISTINCT {columns} FROM time_parts")
+    cur.execute("DROP TABLE time_parts")
+    for query in rollup_table_inserts:
+        cur.execute(query)
+    # Commits the whole load
+    incremental.record_loaded(conn, manifest['objects'], replace=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the star schema from S3 JSON without a warehouse COPY')
+    parser.add_argument('--out', default='star_schema', help='Directory the table files are written to')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes for the event files')
+    parser.add_argument('--load', action='store_true', help='Bulk load the files into the local PostgreSQL backend')
+    parser.add_argument('--parquet', action='store_true',
+                        help='With --load, also write the loaded star schema to Parquet under [PARQUET] PATH')
+    args = parser.parse_args(argv)
+
+    config = db.get_config()
+    if args.load and not local_backend.enabled(config):
+        parser.error('--load needs the local backend, copy the files from S3 to load Redshift')
+    if args.parquet and not args.load:
+        parser.error('--parquet exports the loaded tables, it needs --load')
+    run(config, args.out, args.processes)
+    if args.load:
+        with db.connection() as conn:
+            load(conn, args.out)
+            if args.parquet:
+                import parquet_export
+                parquet_export.export_from_config(conn, config)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
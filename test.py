@@ -1,72 +1,66 @@
-import configparser
-import psycopg2
+import sys
+import time
 import pandas as pd
 from tabulate import tabulate
+import db
+import query_cache
+import query_runner
+import rollups
+from sql_queries import query1, query2
 
 
-def sql_runner(cur, conn, query):
-    """Runs an SQL query and returns a DataFrame
-    
+def cached_runner(cache, name, query):
+    """Runs an SQL query through the result cache and prints it
+
+    Args:
+        cache (query_cache.QueryCache): Result cache
+        name (string):                  Query name
+        query (string):                 SQL query
+
+    """
+    start = time.perf_counter()
+    columns, rows, hit = cache.run(route(query))
+    print(pd.DataFrame(rows, columns=columns))
+    print(f"{name}: {'cache hit' if hit else 'cache miss'} in {time.perf_counter() - start:.4f}s")
+
+
+def sql_runner(conn, name, query, mode):
+    """Runs an SQL query, prints its first rows and its rows/sec and peak memory
+
     Args:
-        cur (psycopg2.extensions.cursor:     Postgres cursor
         conn (psycopg2.exensions.connectoin: Postgres connection
+        name (string):                       Query name
         query (string):                      SQL query
+        mode (string):                       One of query_runner.MODES
 
     """
-    cur.execute(query)
-    conn.commit()
-    data = cur.fetchall()
-    df = pd.DataFrame(data, columns=list(map(lambda x: x[0], cur.description)))
-    print(df)
-    return df
+    head, stats = query_runner.run_query(conn, route(query), mode, config=db.get_config(), name=name)
+    if head is not None:
+        print(head)
+    print(f"{name}: {stats}")
+    return stats
 
 pd.set_option('display.max_rows',20)
 
-# Grab our configurations
-config_file='dwh.cfg'
-config=configparser.ConfigParser()
-config.read(config_file)
+# Analytic queries are answered from the rollup tables where possible, --no-rollups scans songplay
+route = (lambda query: query) if '--no-rollups' in sys.argv else rollups.rewrite
 
-# Create connection to Redshift
-conn = psycopg2.connect(dbname=config['CLUSTER']['DB_NAME'],
-                        user=config['CLUSTER']['DB_USER'],
-                        password=config['CLUSTER']['DB_PASSWORD'],
-                        host=config['CLUSTER']['HOST'],
-                        port=config['CLUSTER']['DB_PORT'],
-                        connect_timeout=5
-)
-cur = conn.cursor()
-
-# SQL Queries
-query1 = """
-    SELECT
-        DISTINCT sp.song_id AS song_id,
-        name AS artist_name,
-        title AS song_name,
-        count(*) as times_played
-    FROM songplay sp
-    JOIN artist a
-        ON sp.artist_id=a.artist_id
-    LEFT JOIN song s
-        ON sp.song_id=s.song_id
-    GROUP BY sp.song_id, name, title
-    ORDER BY sp.song_id DESC
-    LIMIT 100;
-    """
+# --mode fetchall|stream|chunks|unload, stream by default so large results never sit in memory
+mode = sys.argv[sys.argv.index('--mode') + 1] if '--mode' in sys.argv else 'stream'
 
-query2 = """SELECT 
-    (SELECT count(*)
-    FROM songplay) AS songplay,
-    (SELECT count(*) 
-    FROM time) AS time,
-    (SELECT count(*)
-    FROM artist) AS artist_,
-    (SELECT count(*)
-    FROM users) AS users_,
-    (SELECT count(*)
-    FROM song) AS song_"""
+# --cache answers the analytic queries from the result cache, only querying on a miss
+if '--cache' in sys.argv:
+    if not query_cache.enabled(db.get_config()):
+        # Loads only retire cached results while the cache is enabled, so they would go stale
+        sys.exit("--cache needs [CACHE] ENABLED=True and [S3] MY_BUCKET in dwh.cfg")
+    cache = query_cache.QueryCache(db.get_config())
+    cached_runner(cache, 'query1', query1)
+    cached_runner(cache, 'query2', query2)
+    sys.exit(0)
 
-# Run Queries
-sql_runner(cur, conn, query1)
-sql_runner(cur, conn, query2)
-sql_runner(cur, conn, "SELECT * FROM songplay")
\ No newline at end of file
+# Borrow a connection to Redshift, or to the local PostgreSQL stand-in
+with db.connection() as conn:
+    # Run Queries
+    sql_runner(conn, 'query1', query1, mode)
+    sql_runner(conn, 'query2', query2, mode)
+    sql_runner(conn, 'songplay', "SELECT * FROM songplay", mode)
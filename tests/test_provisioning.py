@@ -0,0 +1,180 @@
+import configparser
+import json
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import ANY, Stubber
+
+import provisioning
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/dwhRole'
+HOST = 'dwhcluster.abc123.us-west-2.redshift.amazonaws.com'
+
+
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'CLUSTER': {'DB_NAME': 'dwh', 'DB_USER': 'dwhuser', 'DB_PASSWORD': 'Passw0rd', 'DB_PORT': '5439',
+                    'DWH_CLUSTER_IDENTIFIER': 'dwhCluster', 'DWH_CLUSTER_TYPE': 'multi-node',
+                    'DWH_NUM_NODES': '4', 'DWH_NODE_TYPE': 'dc2.large', 'DWH_IAM_ROLE_NAME': 'dwhRole'},
+        'BOOT': {'LIFECYCLE': 'delete', 'WAITER_DELAY': '1', 'CLUSTER_TIMEOUT': '10'},
+    })
+    return config
+
+
+@pytest.fixture
+def clients():
+    """Stubbed IAM, Redshift and EC2 clients; each test queues the responses it expects"""
+    clients = {name: boto3.client(name, region_name='us-west-2',
+                                  aws_access_key_id='testing', aws_secret_access_key='testing')
+               for name in ('iam', 'redshift', 'ec2')}
+    stubbers = {name: Stubber(client) for name, client in clients.items()}
+    for stubber in stubbers.values():
+        stubber.activate()
+    yield clients, stubbers
+    for stubber in stubbers.values():
+        stubber.deactivate()
+
+
+@pytest.fixture
+def steps():
+    """provision_steps with the database connection test replaced, it needs a live cluster"""
+    calls = []
+
+    def test_connection(config, clients, state):
+        calls.append(state['host'])
+        return {}
+
+    steps = dict(provisioning.provision_steps)
+    steps['test_connection'] = (test_connection, steps['test_connection'][1])
+    return steps, calls
+
+
+def cluster(status: str, endpoint: bool = False):
+    description = {'ClusterIdentifier': 'dwhCluster', 'ClusterStatus': status, 'VpcId': 'vpc-123'}
+    if endpoint:
+        description['Endpoint'] = {'Address': HOST, 'Port': 5439}
+    return description
+
+
+def stub_role(stubbers, bucket: str = None):
+    stubbers['iam'].add_response('create_role', {'Role': {
+        'Path': '/', 'RoleName': 'dwhRole', 'RoleId': 'AROAEXAMPLE123456789', 'Arn': ROLE_ARN,
+        'CreateDate': '2026-01-01T00:00:00Z'}}, {'Path': '/', 'RoleName': 'dwhRole', 'AssumeRolePolicyDocument': ANY})
+    stubbers['iam'].add_response('get_role', {'Role': {
+        'Path': '/', 'RoleName': 'dwhRole', 'RoleId': 'AROAEXAMPLE123456789', 'Arn': ROLE_ARN,
+        'CreateDate': '2026-01-01T00:00:00Z'}}, {'RoleName': 'dwhRole'})
+    stubbers['iam'].add_response('attach_role_policy', {},
+                                 {'RoleName': 'dwhRole', 'PolicyArn': provisioning.S3_READ_ONLY_POLICY})
+    if bucket:
+        stubbers['iam'].add_response('put_role_policy', {}, {
+            'RoleName': 'dwhRole', 'PolicyName': provisioning.UNLOAD_POLICY_NAME,
+            'PolicyDocument': provisioning.unload_policy(bucket)})
+
+
+def stub_new_cluster(stubbers):
+    stubbers['redshift'].add_client_error('describe_clusters', service_error_code='ClusterNotFound',
+                                          http_status_code=404, expected_params={'ClusterIdentifier': 'dwhCluster'})
+    stubbers['redshift'].add_response('create_cluster', {'Cluster': cluster('creating')}, {
+        'ClusterType': 'multi-node', 'NodeType': 'dc2.large', 'NumberOfNodes': 4, 'DBName': 'dwh',
+        'ClusterIdentifier': 'dwhCluster', 'MasterUsername': 'dwhuser', 'MasterUserPassword': 'Passw0rd',
+        'IamRoles': [ROLE_ARN]})
+
+
+def stub_cluster_up(stubbers):
+    # The waiter's poll, then describe_cluster reading the endpoint
+    for _ in range(2):
+        stubbers['redshift'].add_response('describe_clusters', {'Clusters': [cluster('available', endpoint=True)]},
+                                          {'ClusterIdentifier': 'dwhCluster'})
+    stubbers['ec2'].add_response('describe_security_groups', {'SecurityGroups': [{'GroupId': 'sg-123'}]}, {
+        'Filters': [{'Name': 'vpc-id', 'Values': ['vpc-123']}, {'Name': 'group-name', 'Values': ['default']}]})
+    stubbers['ec2'].add_response('authorize_security_group_ingress', {}, {
+        'GroupId': 'sg-123', 'CidrIp': '0.0.0.0/0', 'IpProtocol': 'tcp', 'FromPort': 5439, 'ToPort': 5439})
+
+
+def assert_all_called(stubbers):
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+
+
+def test_fresh_create(config, clients, steps, tmp_path):
+    clients, stubbers = clients
+    steps, connections = steps
+    stub_role(stubbers)
+    stub_new_cluster(stubbers)
+    stub_cluster_up(stubbers)
+
+    state_path = str(tmp_path / 'boot_state.json')
+    values = provisioning.provision(config, clients, state_path, steps)
+
+    assert values == {'role_arn': ROLE_ARN, 'vpc_id': 'vpc-123', 'start': 'created', 'host': HOST}
+    assert connections == [HOST]
+    with open(state_path) as f:
+        assert json.load(f)['done'] == sorted(provisioning.provision_steps)
+    assert_all_called(stubbers)
+
+
+def test_unload_policy_for_my_bucket(config, clients, steps, tmp_path):
+    clients, stubbers = clients
+    steps, _ = steps
+    config['S3'] = {'MY_BUCKET': "'s3://my-bucket'"}
+    stub_role(stubbers, bucket='my-bucket')
+    stub_new_cluster(stubbers)
+    stub_cluster_up(stubbers)
+
+    provisioning.provision(config, clients, str(tmp_path / 'boot_state.json'), steps)
+
+    statement = json.loads(provisioning.unload_policy('my-bucket'))['Statement'][0]
+    assert statement['Resource'] == 'arn:aws:s3:::my-bucket/unload/*'
+    assert_all_called(stubbers)
+
+
+def test_resume_after_partial_create(config, clients, steps, tmp_path):
+    clients, stubbers = clients
+    steps, connections = steps
+    # An earlier run created the role and asked for the cluster, then died
+    state_path = tmp_path / 'boot_state.json'
+    state_path.write_text(json.dumps({'done': ['attach_policy', 'create_cluster', 'create_role'],
+                                      'role_arn': ROLE_ARN, 'vpc_id': 'vpc-123', 'start': 'created'}))
+    # No IAM call and no second create_cluster is queued, so either would fail the test
+    stub_cluster_up(stubbers)
+
+    values = provisioning.provision(config, clients, str(state_path), steps)
+
+    assert values == {'role_arn': ROLE_ARN, 'vpc_id': 'vpc-123', 'start': 'created', 'host': HOST}
+    assert connections == [HOST]
+    assert json.loads(state_path.read_text())['done'] == sorted(provisioning.provision_steps)
+    assert_all_called(stubbers)
+
+
+def test_failed_step_stops_dependents_and_resumes(config, clients, steps, tmp_path):
+    clients, stubbers = clients
+    steps, connections = steps
+    stub_role(stubbers)
+    stubbers['redshift'].add_client_error('describe_clusters', service_error_code='ClusterNotFound',
+                                          http_status_code=404, expected_params={'ClusterIdentifier': 'dwhCluster'})
+    stubbers['redshift'].add_client_error('create_cluster', service_error_code='ClusterQuotaExceeded',
+                                          service_message='Quota exceeded', http_status_code=400)
+
+    state_path = str(tmp_path / 'boot_state.json')
+    with pytest.raises(ClientError) as raised:
+        provisioning.provision(config, clients, state_path, steps)
+
+    assert raised.value.response['Error']['Code'] == 'ClusterQuotaExceeded'
+    assert connections == []
+    with open(state_path) as f:
+        state = json.load(f)
+    # The IAM steps are kept; nothing that needs the cluster was started
+    assert state['done'] == ['attach_policy', 'create_role']
+    assert 'vpc_id' not in state
+    assert_all_called(stubbers)
+
+    # The rerun only runs the steps that didn't finish
+    stub_new_cluster(stubbers)
+    stub_cluster_up(stubbers)
+    values = provisioning.provision(config, clients, state_path, steps)
+    assert values['host'] == HOST
+    assert connections == [HOST]
+    assert_all_called(stubbers)